@@ -8,6 +8,10 @@ MANIFEST_DIR = Path(os.path.join(MODULE_PATH, "manifests"))
 
 ARTIFACT_META_DIR = "meta"
 ARTIFACT_DESCRIPTION_FILE = "readme.txt"
+# Content-addressed artifact stores keep the files of all artifacts once under their hash in ARTIFACT_BLOB_DIR at the
+# root of the store, and every version as an ARTIFACT_MANIFEST_FILE in the version directory.
+ARTIFACT_BLOB_DIR = ".blobs"
+ARTIFACT_MANIFEST_FILE = ".manifest.json"
 
 RUNTIME_CFG_KEY: str = "runtime_cfg"
 
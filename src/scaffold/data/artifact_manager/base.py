@@ -6,8 +6,9 @@ import tempfile
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Any, Iterable, Optional, Union
+from typing import Any, Callable, Iterable, Optional, Union
 
+from scaffold.data.artifact_manager.cache import ArtifactCache, is_immutable_version
 from scaffold.data.fs import join_path
 
 logger = logging.getLogger(__name__)
@@ -39,7 +40,9 @@ class TmpArtifact:
             version (str): The artifact version.
         """
         self.artifact_manager = artifact_manager
-        self.tempdir = tempfile.mkdtemp()
+        # With an artifact cache, the files are hard-linked from the cache, which has to be on the same device
+        cache = artifact_manager.cache
+        self.tempdir = cache.mkdtemp() if cache is not None else tempfile.mkdtemp()
         self.artifact = Artifact(name=artifact_name, collection=collection, version=version)
 
     def __enter__(self) -> str:
@@ -110,9 +113,40 @@ class DirectoryLogger:
 
 
 class ArtifactManager(ABC):
-    def __init__(self, collection: str = "default"):
-        """Artifact manager interface for various backends."""
+    def __init__(self, collection: str = "default", cache: Optional[ArtifactCache] = None):
+        """Artifact manager interface for various backends.
+
+        Args:
+            collection (str): The default collection name. Defaults to "default".
+            cache (Optional[ArtifactCache]): A local cache of downloaded artifact versions. If None, every download
+                fetches the artifact from the backend.
+        """
         self._active_collection = collection
+        self.cache = cache
+
+    @property
+    def backend_id(self) -> str:
+        """Identifies the artifact store of the manager, e.g. in the keys of the artifact cache"""
+        return type(self).__name__
+
+    def _download_with_cache(
+        self, artifact: Artifact, to: str, download: Callable[[str], Any], version: Optional[str] = None
+    ) -> None:
+        """Place the files of `artifact` in `to`, through the artifact cache if there is one.
+
+        Args:
+            artifact (Artifact): The downloaded artifact.
+            to (str): The local destination directory.
+            download (Callable[[str], Any]): Downloads the files of the artifact into the directory it is called with.
+            version (Optional[str]): The fixed version that an alias in `artifact.version` resolved to, which keys the
+                cache. Defaults to `artifact.version`.
+        """
+        version = version or artifact.version
+        if self.cache is None or not is_immutable_version(version):
+            download(to)
+        else:
+            key = (self.backend_id, artifact.collection, artifact.name, version)
+            self.cache.fetch(key, download, to)
 
     @property
     def active_collection(self) -> str:
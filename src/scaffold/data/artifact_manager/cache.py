@@ -0,0 +1,199 @@
+"""
+A local read-through cache of downloaded artifacts that is shared by all processes on a machine, see
+:py:class:`ArtifactCache`.
+"""
+
+from __future__ import annotations
+
+import errno
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import stat
+import tempfile
+import time
+import typing as t
+import uuid
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+__all__ = ["ArtifactCache", "is_immutable_version"]
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "scaffold", "artifacts")
+
+
+def is_immutable_version(version: t.Optional[str]) -> bool:
+    """Whether `version` names a fixed version like "v3", as opposed to an alias like "latest" that can move"""
+    return version is not None and re.fullmatch(r"v\d+", version) is not None
+
+
+class ArtifactCache:
+    """A local cache of artifact versions with a size limit and least-recently-used eviction.
+
+    Every version is keyed by the backend, collection, name and version of the artifact, and only fixed versions are
+    cached, since they never change. A missing version is downloaded into a temporary directory, which is renamed into
+    place once complete, so concurrent processes never see a partial entry. The cached files are read-only and are
+    handed out as hard links instead of copies, so an evicted entry stays valid for the processes that still use it.
+    The processes are synchronized with `fcntl` file locks, so the cache is only available on POSIX systems.
+    """
+
+    ENTRY_FILE = "entry.json"
+    DATA_DIR = "data"
+    TMP_DIR = "tmp"
+    HANDOUT_DIR = "handout"
+    # Temporary directories of crashed processes are removed after this many seconds
+    STALE_TMP_SECONDS = 24 * 60 * 60
+
+    def __init__(self, root: str = DEFAULT_CACHE_DIR, max_bytes: t.Optional[int] = None) -> None:
+        """Init
+
+        Args:
+            root (str): Local directory of the cache.
+            max_bytes (Optional[int]): Size limit of the cache in bytes. The least recently used versions are evicted
+                once the limit is exceeded. If None, the size is not limited.
+        """
+        self.root = os.path.abspath(os.path.expanduser(root))
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.join(self.root, self.TMP_DIR), exist_ok=True)
+        os.makedirs(os.path.join(self.root, self.HANDOUT_DIR), exist_ok=True)
+
+    def mkdtemp(self) -> str:
+        """Create a temporary directory on the device of the cache, into which entries can be hard-linked. The caller
+        removes it.
+        """
+        return tempfile.mkdtemp(dir=os.path.join(self.root, self.HANDOUT_DIR))
+
+    @staticmethod
+    def entry_name(key: t.Tuple[str, ...]) -> str:
+        """Return the directory name of the entry with `key`"""
+        return hashlib.sha256(json.dumps(list(key)).encode()).hexdigest()[:32]
+
+    @contextmanager
+    def _lock(self, exclusive: bool) -> t.Iterator[None]:
+        """Hold the lock of the cache, which is exclusive while entries are evicted"""
+        # Imported here, so that the artifact managers can be imported without a cache on other systems
+        import fcntl
+
+        with open(os.path.join(self.root, ".lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def fetch(self, key: t.Tuple[str, ...], download: t.Callable[[str], t.Any], to: str) -> bool:
+        """Place the files of the entry with `key` in the local directory `to`, downloading them first if missing.
+
+        Args:
+            key (Tuple[str, ...]): The key of the artifact version, e.g. `(backend, collection, name, version)`.
+            download (Callable[[str], Any]): Downloads the files of the version into the directory it is called with.
+            to (str): The local destination directory.
+
+        Returns:
+            bool: True if the entry was already cached.
+        """
+        entry = os.path.join(self.root, self.entry_name(key))
+        with self._lock(exclusive=False):
+            if os.path.exists(os.path.join(entry, self.ENTRY_FILE)):
+                os.utime(os.path.join(entry, self.ENTRY_FILE))
+                _link_tree(os.path.join(entry, self.DATA_DIR), to)
+                return True
+
+        tmp = os.path.join(self.root, self.TMP_DIR, uuid.uuid4().hex)
+        try:
+            data = os.path.join(tmp, self.DATA_DIR)
+            os.makedirs(data)
+            download(data)
+            size = _make_read_only(data)
+            with open(os.path.join(tmp, self.ENTRY_FILE), "w") as f:
+                json.dump({"key": list(key), "size": size}, f)
+            with self._lock(exclusive=False):
+                try:
+                    os.rename(tmp, entry)
+                except OSError as e:
+                    # Another process has cached the same version first
+                    if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                        raise
+                os.utime(os.path.join(entry, self.ENTRY_FILE))
+                _link_tree(os.path.join(entry, self.DATA_DIR), to)
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        logger.info(f"Cached artifact {'/'.join(key)} in {entry}")
+        self.evict(keep=entry)
+        return False
+
+    def entries(self) -> t.List[t.Tuple[str, int, float]]:
+        """Return the `(directory, size, last_used)` of all complete entries, least recently used first"""
+        entries = []
+        for name in os.listdir(self.root):
+            entry_file = os.path.join(self.root, name, self.ENTRY_FILE)
+            try:
+                with open(entry_file) as f:
+                    size = json.load(f)["size"]
+                entries.append((os.path.join(self.root, name), size, os.stat(entry_file).st_mtime))
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+        return sorted(entries, key=lambda e: e[2])
+
+    def evict(self, keep: t.Optional[str] = None) -> None:
+        """Evict the least recently used entries until the cache is within its size limit. The entry directory `keep`
+        is never evicted.
+        """
+        with self._lock(exclusive=True):
+            tmp_root = os.path.join(self.root, self.TMP_DIR)
+            for name in os.listdir(tmp_root):
+                path = os.path.join(tmp_root, name)
+                try:
+                    if time.time() - os.stat(path).st_mtime > self.STALE_TMP_SECONDS:
+                        shutil.rmtree(path, ignore_errors=True)
+                except FileNotFoundError:
+                    # Removed by the process that fetched into it, which does not hold the lock
+                    continue
+            if self.max_bytes is None:
+                return
+            entries = self.entries()
+            total = sum(size for _, size, _ in entries)
+            for path, size, _ in entries:
+                if total <= self.max_bytes:
+                    break
+                if path == keep:
+                    continue
+                # Move the entry out of place first, so that it disappears atomically
+                tmp = os.path.join(tmp_root, uuid.uuid4().hex)
+                os.rename(path, tmp)
+                shutil.rmtree(tmp, ignore_errors=True)
+                total -= size
+                logger.info(f"Evicted {path} from the artifact cache")
+
+
+def _make_read_only(root: str) -> int:
+    """Make the files under `root` read-only and return their total size"""
+    size = 0
+    for dirpath, _, names in os.walk(root):
+        for name in names:
+            path = os.path.join(dirpath, name)
+            mode = os.stat(path).st_mode
+            os.chmod(path, mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+            size += os.path.getsize(path)
+    return size
+
+
+def _link_tree(src: str, dst: str) -> None:
+    """Hard-link the files under `src` into `dst`, or copy them if `dst` is on another device"""
+    for dirpath, _, names in os.walk(src):
+        target_dir = os.path.join(dst, os.path.relpath(dirpath, src))
+        os.makedirs(target_dir, exist_ok=True)
+        for name in names:
+            target = os.path.join(target_dir, name)
+            if os.path.lexists(target):
+                os.remove(target)
+            try:
+                os.link(os.path.join(dirpath, name), target)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                    raise
+                shutil.copy2(os.path.join(dirpath, name), target)
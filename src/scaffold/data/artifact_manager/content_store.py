@@ -0,0 +1,135 @@
+"""
+Content-addressed storage of the files of artifacts, used by
+:py:class:`FileSystemArtifactManager <scaffold.data.artifact_manager.filesystem.FileSystemArtifactManager>` with
+`deduplicate=True`.
+
+Every file is stored once under its SHA-256 hash in the blob directory at the root of the store, and every version of an
+artifact is a small manifest that maps the relative paths of its files to their hashes. Logging a new version only
+uploads the files whose hash is not stored yet.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import typing as t
+from concurrent.futures import ThreadPoolExecutor
+
+from fsspec.spec import AbstractFileSystem
+
+from scaffold.constants import ARTIFACT_BLOB_DIR, ARTIFACT_MANIFEST_FILE
+from scaffold.data.artifact_manager.transfer import TransferEngine, TransferStats
+from scaffold.data.fs import join_path
+
+__all__ = ["hash_file", "blob_path", "list_local_files", "upload_version", "read_version_manifest", "download_version"]
+
+MANIFEST_FORMAT = "content-addressed"
+MANIFEST_VERSION = 1
+
+
+def hash_file(path: str, chunk_size: int = 8 * 1024 * 1024) -> str:
+    """Return the SHA-256 hex digest of the local file at `path`"""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def blob_path(url: str, digest: str) -> str:
+    """Return the path of the blob with hash `digest` in the store at `url`"""
+    return join_path(url, ARTIFACT_BLOB_DIR, digest[:2], digest)
+
+
+def list_local_files(local_path: str, artifact_path: t.Optional[str] = None) -> t.List[t.Tuple[str, str]]:
+    """Return the pairs `(local_path, relative_path)` of the files of an artifact logged from `local_path`.
+
+    A single file is stored at `artifact_path` or under its own name, and the files of a folder at their paths
+    relative to the folder.
+    """
+    if artifact_path:
+        return [(local_path, artifact_path.strip("/"))]
+    if os.path.isfile(local_path):
+        return [(local_path, os.path.basename(local_path))]
+    files = []
+    for root, _, names in os.walk(local_path):
+        for name in names:
+            src = os.path.join(root, name)
+            files.append((src, os.path.relpath(src, local_path).replace(os.sep, "/")))
+    return sorted(files, key=lambda f: f[1])
+
+
+def _blob_exists(fs: AbstractFileSystem, path: str, size: int) -> bool:
+    try:
+        # A blob of the wrong size is a leftover of an interrupted upload and is replaced
+        return int(fs.info(path).get("size") or 0) == size
+    except FileNotFoundError:
+        return False
+
+
+def upload_version(
+    fs: AbstractFileSystem,
+    transfer: TransferEngine,
+    url: str,
+    version_dir: str,
+    files: t.List[t.Tuple[str, str]],
+) -> TransferStats:
+    """Upload the blobs of `files` that are not in the store at `url` yet, then write the manifest of the version.
+
+    Args:
+        fs (AbstractFileSystem): The filesystem of the store.
+        transfer (TransferEngine): The engine that uploads the blobs.
+        url (str): The root of the store.
+        version_dir (str): The directory of the new version.
+        files (List[Tuple[str, str]]): The pairs `(local_path, relative_path)` of the files of the version, see
+            :py:func:`list_local_files`.
+    """
+
+    def describe(file: t.Tuple[str, str]) -> t.Tuple[str, int, bool]:
+        digest, size = hash_file(file[0]), os.path.getsize(file[0])
+        return digest, size, _blob_exists(fs, blob_path(url, digest), size)
+
+    with ThreadPoolExecutor(max_workers=transfer.max_workers, thread_name_prefix="fs-hash") as pool:
+        described = list(pool.map(describe, files))
+
+    entries, missing = {}, {}
+    for (src, rel), (digest, size, exists) in zip(files, described):
+        entries[rel] = {"sha256": digest, "size": size}
+        if not exists:
+            missing[digest] = src
+    stats = transfer.upload_files(
+        fs, [(src, blob_path(url, digest)) for digest, src in missing.items()], name=f"upload of blobs to {url}"
+    )
+
+    # The manifest is written last, so that a version is never visible before all its blobs are stored
+    manifest = {"format": MANIFEST_FORMAT, "version": MANIFEST_VERSION, "files": entries}
+    fs.makedirs(version_dir, exist_ok=True)
+    fs.pipe_file(join_path(version_dir, ARTIFACT_MANIFEST_FILE), json.dumps(manifest, indent=1).encode())
+    return stats
+
+
+def read_version_manifest(fs: AbstractFileSystem, version_dir: str) -> t.Optional[t.Dict[str, t.Any]]:
+    """Return the manifest of the version in `version_dir`, or None if it is not a content-addressed version"""
+    try:
+        manifest = json.loads(fs.cat_file(join_path(version_dir, ARTIFACT_MANIFEST_FILE)))
+    except FileNotFoundError:
+        return None
+    if manifest.get("format") != MANIFEST_FORMAT:
+        return None
+    if manifest.get("version") != MANIFEST_VERSION:
+        raise ValueError(
+            f"Manifest of {version_dir} has version {manifest.get('version')}, expected {MANIFEST_VERSION}."
+        )
+    return manifest
+
+
+def download_version(
+    fs: AbstractFileSystem, transfer: TransferEngine, url: str, manifest: t.Dict[str, t.Any], to: str
+) -> TransferStats:
+    """Reconstruct the files of a version from its manifest in the local directory `to`"""
+    triples = [
+        (blob_path(url, entry["sha256"]), os.path.join(to, *rel.split("/")), entry["size"])
+        for rel, entry in manifest["files"].items()
+    ]
+    return transfer.download_files(fs, triples, name=f"download of blobs from {url}")
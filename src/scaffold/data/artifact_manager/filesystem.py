@@ -1,8 +1,20 @@
 import logging
+import os
 import typing as t
 
-from scaffold.constants import ARTIFACT_DESCRIPTION_FILE, ARTIFACT_META_DIR
+from fsspec.spec import AbstractFileSystem
+
+from scaffold.constants import ARTIFACT_BLOB_DIR, ARTIFACT_DESCRIPTION_FILE, ARTIFACT_META_DIR
 from scaffold.data.artifact_manager.base import Artifact, ArtifactManager, TmpArtifact
+from scaffold.data.artifact_manager.cache import ArtifactCache
+from scaffold.data.artifact_manager.content_store import (
+    download_version,
+    list_local_files,
+    read_version_manifest,
+    upload_version,
+)
+from scaffold.data.artifact_manager.transfer import TransferEngine
+from scaffold.data.artifact_manager.version_index import VersionIndex
 from scaffold.data.fs import get_fs_from_url, join_path
 
 logger = logging.getLogger(__name__)
@@ -14,17 +26,44 @@ class FileSystemArtifactManager(ArtifactManager):
     This implementation logs and retrieves artifacts from a specified URL.
     """
 
-    def __init__(self, url: str, collection: str = "default", **fs_kwargs: t.Any) -> None:
+    def __init__(
+        self,
+        url: str,
+        collection: str = "default",
+        transfer: t.Optional[TransferEngine] = None,
+        deduplicate: bool = False,
+        cache: t.Optional[ArtifactCache] = None,
+        **fs_kwargs: t.Any,
+    ) -> None:
         """Initialize a FileSystemArtifactManager.
 
         Args:
             url (str): The base URL of the artifact store.
             collection (str): The default collection name. Defaults to "default".
+            transfer (Optional[TransferEngine]): The engine that uploads and downloads the files of artifacts.
+                Defaults to a TransferEngine with default settings.
+            deduplicate (bool): If True, new versions are logged to content-addressed storage: every file is stored
+                once under its hash, and a version is a manifest of the hashes of its files, so that only files which
+                are not stored yet are uploaded. Versions of both kinds can be downloaded regardless of this setting.
+            cache (Optional[ArtifactCache]): A local cache of downloaded artifact versions, which are then handed out
+                as read-only hard links. If None, every download fetches the artifact from the store.
             **fs_kwargs (Any): Additional keyword arguments for the file system.
         """
-        super().__init__(collection=collection)
+        super().__init__(collection=collection, cache=cache)
         self.url = url.rstrip("/")
-        self.fs = get_fs_from_url(self.url, **fs_kwargs)
+        self.transfer = transfer if transfer is not None else TransferEngine()
+        self.deduplicate = deduplicate
+        self.fs_kwargs = fs_kwargs
+
+    @property
+    def backend_id(self) -> str:
+        """The url of the artifact store"""
+        return self.url
+
+    @property
+    def fs(self) -> AbstractFileSystem:
+        """The filesystem of the artifact store, taken from the pool of the current process"""
+        return get_fs_from_url(self.url, **self.fs_kwargs)
 
     def list_collection_names(self) -> t.Iterable[str]:
         """List all collections in the artifact store.
@@ -36,7 +75,8 @@ class FileSystemArtifactManager(ArtifactManager):
             items = self.fs.ls(self.url, detail=True)
         except FileNotFoundError:
             return []
-        return [item["name"].split("/")[-1] for item in items if item.get("type") == "directory"]
+        names = [item["name"].split("/")[-1] for item in items if item.get("type") == "directory"]
+        return [name for name in names if name != ARTIFACT_BLOB_DIR]
 
     def exists_in_collection(self, artifact_name: str, collection: t.Optional[str] = None) -> bool:
         """Check if an artifact exists in a specific collection.
@@ -46,11 +86,24 @@ class FileSystemArtifactManager(ArtifactManager):
             collection (Optional[str]): The collection name. Defaults to the active collection.
 
         Returns:
-            bool: True if the artifact exists, False otherwise.
+            bool: True if the artifact has a complete version, False otherwise.
+        """
+        index = self.version_index(artifact_name, collection)
+        entries = index.read()
+        if entries is None:
+            return self.fs.exists(index.artifact_dir)
+        # Versions that were claimed but never completed do not count
+        return entries["latest"] is not None
+
+    def version_index(self, artifact_name: str, collection: t.Optional[str] = None) -> VersionIndex:
+        """Return the index of the versions of an artifact.
+
+        Args:
+            artifact_name (str): The artifact name.
+            collection (Optional[str]): The collection name. Defaults to the active collection.
         """
         collection = collection or self.active_collection
-        artifact_dir = join_path(self.url, collection, artifact_name)
-        return self.fs.exists(artifact_dir)
+        return VersionIndex(self.fs, join_path(self.url, collection, artifact_name))
 
     def log_files(
         self,
@@ -80,20 +133,9 @@ class FileSystemArtifactManager(ArtifactManager):
         """
         collection = collection or self.active_collection
         base_artifact_path = join_path(self.url, collection, artifact_name)
-        # Determine new version; start at "v0"
-        if self.fs.exists(base_artifact_path):
-            try:
-                entries = self.fs.ls(base_artifact_path, detail=True)
-                version_nums: t.List[int] = []
-                for entry in entries:
-                    ver = entry["name"].split("/")[-1]
-                    if ver.startswith("v") and ver[1:].isdigit():
-                        version_nums.append(int(ver[1:]))
-                new_version = f"v{max(version_nums) + 1}" if version_nums else "v0"
-            except Exception:
-                new_version = "v0"
-        else:
-            new_version = "v0"
+        # Claim the next version in the index, so that concurrent writers never log to the same version
+        index = self.version_index(artifact_name, collection)
+        new_version = index.claim_version()
         target_dir = join_path(base_artifact_path, new_version)
 
         # write description
@@ -103,20 +145,16 @@ class FileSystemArtifactManager(ArtifactManager):
         with self.fs.open(desc_file, "w") as f:
             f.write(description)
 
-        if artifact_path:
-            # Upload a single file to target_dir/artifact_path.
-            target_file = join_path(target_dir, artifact_path)
-            fs = get_fs_from_url(target_file)
-            parent_dir = fs._parent(target_file)
-            self.fs.mkdirs(parent_dir, exist_ok=True)
-            self.fs.put(local_path, target_file, recursive=False)
-            logged_location = target_file
+        # A single file is uploaded to target_dir/artifact_path or under its own name, a folder with its contents
+        files = list_local_files(local_path, artifact_path)
+        if self.deduplicate:
+            upload_version(self.fs, self.transfer, self.url, target_dir, files)
         else:
-            # Upload an entire folder.
-            if not self.fs.exists(target_dir):
-                self.fs.mkdirs(target_dir, exist_ok=True)
-            self.fs.put(local_path, target_dir, recursive=True)
-            logged_location = target_dir
+            self.transfer.upload_files(
+                self.fs, [(src, join_path(target_dir, rel)) for src, rel in files], name=f"upload to {target_dir}"
+            )
+        index.complete_version(new_version, size=sum(os.path.getsize(src) for src, _ in files), files=len(files))
+        logged_location = join_path(target_dir, artifact_path) if artifact_path else target_dir
 
         logger.info(f"Logged artifact '{artifact_name}' to {logged_location}")
 
@@ -135,9 +173,6 @@ class FileSystemArtifactManager(ArtifactManager):
             collection = self.active_collection
 
         base_path = join_path(self.url, collection)
-        if not self.fs.exists(base_path):
-            return []
-
         try:
             entries = self.fs.ls(base_path, detail=True)
             entries = [entry["name"].split("/")[-1] for entry in entries if entry.get("type") == "directory"]
@@ -155,22 +190,8 @@ class FileSystemArtifactManager(ArtifactManager):
         Returns:
             List[str]: List of version strings sorted by version number (e.g., ["v0", "v1", "v2"]).
         """
-        if collection is None:
-            collection = self.active_collection
-
-        base_artifact_path = join_path(self.url, collection, artifact_name)
-        if not self.fs.exists(base_artifact_path):
-            return []
-
         try:
-            entries = self.fs.ls(base_artifact_path, detail=True)
-            versions: t.List[t.Tuple[int, str]] = []
-            for entry in entries:
-                ver = entry["name"].split("/")[-1]
-                if ver.startswith("v") and ver[1:].isdigit():
-                    versions.append((int(ver[1:]), ver))
-            versions.sort()
-            return [ver for _, ver in versions]
+            return self.version_index(artifact_name, collection).versions()
         except Exception:
             return []
 
@@ -199,20 +220,23 @@ class FileSystemArtifactManager(ArtifactManager):
         collection = collection or self.active_collection
         base_artifact_path = join_path(self.url, collection, artifact_name)
         if version is None or version == "latest":
-            if not self.fs.exists(base_artifact_path):
-                raise ValueError(f"Artifact {artifact_name} not found in collection {collection}")
-            entries = self.fs.ls(base_artifact_path, detail=True)
-            version_nums: t.List[int] = []
-            for entry in entries:
-                ver = entry["name"].split("/")[-1]
-                if ver.startswith("v") and ver[1:].isdigit():
-                    version_nums.append(int(ver[1:]))
-            if not version_nums:
+            version = self.version_index(artifact_name, collection).latest()
+            if version is None:
+                if not self.fs.exists(base_artifact_path):
+                    raise ValueError(f"Artifact {artifact_name} not found in collection {collection}")
                 raise ValueError(f"No version found for artifact {artifact_name} in collection {collection}")
-            version = f"v{max(version_nums)}"
         remote_artifact_path = join_path(base_artifact_path, version)
         if to is not None:
-            self.fs.get(join_path(remote_artifact_path, "*"), to, recursive=True)
-            return Artifact(name=artifact_name, collection=collection, version=version)
+            artifact = Artifact(name=artifact_name, collection=collection, version=version)
+            self._download_with_cache(artifact, to, lambda path: self._download_version(remote_artifact_path, path))
+            return artifact
         else:
             return TmpArtifact(self, collection, artifact_name, version)
+
+    def _download_version(self, remote_artifact_path: str, to: str) -> None:
+        """Download the files of the version at `remote_artifact_path` into `to`"""
+        manifest = read_version_manifest(self.fs, remote_artifact_path)
+        if manifest is not None:
+            download_version(self.fs, self.transfer, self.url, manifest, to)
+        else:
+            self.transfer.download(self.fs, remote_artifact_path, to)
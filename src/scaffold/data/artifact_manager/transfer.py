@@ -0,0 +1,176 @@
+"""
+Parallel transfers of files between a local directory and an fsspec filesystem, used by
+:py:class:`FileSystemArtifactManager <scaffold.data.artifact_manager.filesystem.FileSystemArtifactManager>`.
+
+Many files are transferred concurrently, and large files are downloaded in ranged parts which are fetched in parallel
+and written into place. Every file or part is retried on its own, so a transient error does not restart the whole
+transfer.
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import time
+import typing as t
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+
+from fsspec.spec import AbstractFileSystem
+
+logger = logging.getLogger(__name__)
+
+__all__ = ["TransferEngine", "TransferStats"]
+
+MB = 1024 * 1024
+
+
+@dataclass
+class TransferStats:
+    """Aggregate statistics of a transfer"""
+
+    files: int = 0
+    parts: int = 0
+    nbytes: int = 0
+    retries: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def bytes_per_sec(self) -> float:
+        """Aggregate throughput of the transfer"""
+        return self.nbytes / self.elapsed if self.elapsed > 0 else 0.0
+
+
+class TransferEngine:
+    """Transfers files concurrently, splitting large downloads into parallel ranged parts."""
+
+    def __init__(
+        self,
+        max_workers: int = 16,
+        part_size: int = 64 * MB,
+        multipart_threshold: int = 128 * MB,
+        max_retries: int = 3,
+        retry_delay: float = 1.0,
+    ) -> None:
+        """Init
+
+        Args:
+            max_workers (int): Number of files or parts that are transferred concurrently.
+            part_size (int): Size of the ranged parts of large downloads in bytes.
+            multipart_threshold (int): Files of at least this size are downloaded in parts.
+            max_retries (int): Number of times a failed file or part is retried.
+            retry_delay (float): Delay before the first retry in seconds, which is doubled for every further retry.
+        """
+        if part_size <= 0:
+            raise ValueError("part_size must be positive.")
+        self.max_workers = max_workers
+        self.part_size = part_size
+        self.multipart_threshold = multipart_threshold
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+
+    def upload(self, fs: AbstractFileSystem, local_path: str, remote_path: str) -> TransferStats:
+        """Upload the file `local_path` to `remote_path`, or the files of the directory `local_path` into the
+        directory `remote_path`, keeping their relative paths.
+        """
+        if os.path.isdir(local_path):
+            pairs = []
+            for root, _, files in os.walk(local_path):
+                for name in files:
+                    src = os.path.join(root, name)
+                    rel = os.path.relpath(src, local_path).replace(os.sep, "/")
+                    pairs.append((src, f"{remote_path.rstrip('/')}/{rel}"))
+        else:
+            pairs = [(local_path, remote_path)]
+        return self.upload_files(fs, pairs, name=f"upload to {remote_path}")
+
+    def upload_files(
+        self, fs: AbstractFileSystem, pairs: t.List[t.Tuple[str, str]], name: str = "upload"
+    ) -> TransferStats:
+        """Upload the local files to the remote paths given by the pairs `(local_path, remote_path)`"""
+        for parent in sorted({fs._parent(dst) for _, dst in pairs}):
+            fs.makedirs(parent, exist_ok=True)
+        tasks = [(self._put_file, (fs, src, dst), os.path.getsize(src)) for src, dst in pairs]
+        return self._run(tasks, files=len(pairs), name=name)
+
+    def download(self, fs: AbstractFileSystem, remote_path: str, local_path: str) -> TransferStats:
+        """Download the files under the directory `remote_path` into the local directory `local_path`, keeping their
+        relative paths.
+        """
+        root = fs._strip_protocol(remote_path).rstrip("/")
+        entries = fs.find(root, detail=True)
+        triples = [
+            (name, os.path.join(local_path, *name[len(root) + 1 :].split("/")), int(entry.get("size") or 0))
+            for name, entry in sorted(entries.items())
+        ]
+        return self.download_files(fs, triples, name=f"download from {remote_path}")
+
+    def download_files(
+        self, fs: AbstractFileSystem, triples: t.List[t.Tuple[str, str, int]], name: str = "download"
+    ) -> TransferStats:
+        """Download the remote files to the local paths given by the triples `(remote_path, local_path, size)`"""
+        tasks = []
+        for src, dst, size in triples:
+            os.makedirs(os.path.dirname(os.path.abspath(dst)), exist_ok=True)
+            if size < self.multipart_threshold:
+                tasks.append((self._get_file, (fs, src, dst), size))
+                continue
+            # Preallocate the file, so that the parts can be written into place in any order
+            with open(dst, "wb") as f:
+                f.truncate(size)
+            for start in range(0, size, self.part_size):
+                end = min(start + self.part_size, size)
+                tasks.append((self._get_range, (fs, src, dst, start, end), end - start))
+        return self._run(tasks, files=len(triples), name=name)
+
+    @staticmethod
+    def _put_file(fs: AbstractFileSystem, src: str, dst: str) -> None:
+        fs.put_file(src, dst)
+
+    @staticmethod
+    def _get_file(fs: AbstractFileSystem, src: str, dst: str) -> None:
+        fs.get_file(src, dst)
+
+    @staticmethod
+    def _get_range(fs: AbstractFileSystem, src: str, dst: str, start: int, end: int) -> None:
+        data = fs.cat_file(src, start=start, end=end)
+        if len(data) != end - start:
+            raise OSError(f"Expected {end - start} bytes of {src} at offset {start}, got {len(data)}.")
+        # Every part has its own file handle, so that the parts can be written concurrently on any system
+        with open(dst, "r+b") as f:
+            f.seek(start)
+            f.write(data)
+
+    def _retry(self, fn: t.Callable, args: t.Tuple) -> int:
+        """Call `fn(*args)` and return the number of retries it took"""
+        for attempt in range(self.max_retries + 1):
+            try:
+                fn(*args)
+                return attempt
+            except (FileNotFoundError, PermissionError, IsADirectoryError):
+                raise
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise
+                logger.warning(f"Retrying transfer of {args[1]} after error: {e!r}")
+                time.sleep(self.retry_delay * 2**attempt)
+
+    def _run(self, tasks: t.List[t.Tuple[t.Callable, t.Tuple, int]], files: int, name: str) -> TransferStats:
+        stats = TransferStats(files=files, parts=len(tasks))
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="fs-transfer") as pool:
+            futures = {pool.submit(self._retry, fn, args): size for fn, args, size in tasks}
+            try:
+                for future in as_completed(futures):
+                    stats.retries += future.result()
+                    stats.nbytes += futures[future]
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+        stats.elapsed = time.perf_counter() - start
+        logger.info(
+            f"Finished {name}: {stats.files} files in {stats.parts} parts, {stats.nbytes / MB:.1f} MB in "
+            f"{stats.elapsed:.1f}s ({stats.bytes_per_sec / MB:.1f} MB/s)"
+        )
+        return stats
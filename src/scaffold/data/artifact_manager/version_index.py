@@ -0,0 +1,192 @@
+"""
+A per-artifact index of the versions of an artifact in a
+:py:class:`FileSystemArtifactManager <scaffold.data.artifact_manager.filesystem.FileSystemArtifactManager>` store, so
+that reading the versions takes a single request instead of listing the artifact directory.
+
+Every update of the index is written as a new generation `meta/index/{generation}.json`, which is created exclusively
+(a conditional write that fails if the object exists). Of concurrent writers that start from the same generation, only
+one can create the next one, and the others retry from it, so no update is lost and no version is assigned twice. The
+latest generation is then copied to `meta/index.json`, which readers fetch in one request.
+
+A version is first claimed with the status "pending", then uploaded, and finally marked "complete" with its size.
+Only complete versions are listed, and a claimed version is never reused, even if its writer fails.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import time
+import typing as t
+import uuid
+
+from fsspec.spec import AbstractFileSystem
+
+from scaffold.constants import ARTIFACT_META_DIR
+from scaffold.data.fs import join_path
+
+logger = logging.getLogger(__name__)
+
+__all__ = ["VersionIndex", "parse_version"]
+
+INDEX_FILE = "index.json"
+INDEX_DIR = "index"
+INDEX_VERSION = 1
+PENDING = "pending"
+COMPLETE = "complete"
+
+
+def parse_version(name: str) -> t.Optional[int]:
+    """Return the number of a version name like "v3", or None if `name` is not a version"""
+    if name.startswith("v") and name[1:].isdigit():
+        return int(name[1:])
+    return None
+
+
+class VersionIndex:
+    """The index of the versions of the artifact in `artifact_dir`"""
+
+    def __init__(self, fs: AbstractFileSystem, artifact_dir: str, max_attempts: int = 100) -> None:
+        """Init
+
+        Args:
+            fs (AbstractFileSystem): The filesystem of the artifact store.
+            artifact_dir (str): The directory of the artifact, which contains its versions.
+            max_attempts (int): Number of generations a writer tries to create before giving up.
+        """
+        self.fs = fs
+        self.artifact_dir = artifact_dir
+        self.max_attempts = max_attempts
+
+    @property
+    def index_file(self) -> str:
+        """Path of the copy of the latest generation"""
+        return join_path(self.artifact_dir, ARTIFACT_META_DIR, INDEX_FILE)
+
+    def _generation_file(self, generation: int) -> str:
+        return join_path(self.artifact_dir, ARTIFACT_META_DIR, INDEX_DIR, f"{generation:010d}.json")
+
+    def _cat_json(self, path: str, attempts: int = 5) -> t.Optional[t.Dict[str, t.Any]]:
+        """Read the JSON file at `path`, or return None if it does not exist"""
+        for attempt in range(attempts):
+            try:
+                return json.loads(self.fs.cat_file(path))
+            except FileNotFoundError:
+                return None
+            except json.JSONDecodeError:
+                # A local file that is created exclusively is visible before its content is written
+                if attempt == attempts - 1:
+                    raise
+                time.sleep(0.05 * 2**attempt)
+
+    def read(self) -> t.Optional[t.Dict[str, t.Any]]:
+        """Return the index with a single request, or None if the artifact has no index yet"""
+        index = self._cat_json(self.index_file)
+        if index is not None and index.get("index_version") != INDEX_VERSION:
+            raise ValueError(
+                f"Index of {self.artifact_dir} has version {index.get('index_version')}, expected {INDEX_VERSION}."
+            )
+        return index
+
+    def versions(self) -> t.List[str]:
+        """Return the complete versions sorted by version number. Artifacts without an index are listed instead."""
+        index = self.read()
+        if index is None:
+            return self._list_versions()
+        versions = [version for version, entry in index["versions"].items() if entry["status"] == COMPLETE]
+        return sorted(versions, key=parse_version)
+
+    def latest(self) -> t.Optional[str]:
+        """Return the latest complete version, or None if there is none"""
+        versions = self.versions()
+        return versions[-1] if versions else None
+
+    def claim_version(self) -> str:
+        """Assign the next version number to a new version, which is pending until :py:meth:`complete_version`"""
+        claimed = []
+
+        def claim(index: t.Dict[str, t.Any]) -> None:
+            version = f"v{index['next']}"
+            index["versions"][version] = {"status": PENDING, "created": time.time()}
+            index["next"] += 1
+            claimed.append(version)
+
+        self._update(claim)
+        return claimed[-1]
+
+    def complete_version(self, version: str, size: int, files: int) -> None:
+        """Mark a claimed version as complete, which lists it as the latest version"""
+
+        def complete(index: t.Dict[str, t.Any]) -> None:
+            index["versions"][version].update(status=COMPLETE, completed=time.time(), size=size, files=files)
+            index["latest"] = max(
+                (v for v, entry in index["versions"].items() if entry["status"] == COMPLETE), key=parse_version
+            )
+
+        self._update(complete)
+
+    def _list_versions(self) -> t.List[str]:
+        """List the version directories of an artifact that has no index, e.g. one logged by an older release"""
+        try:
+            entries = self.fs.ls(self.artifact_dir, detail=True)
+        except FileNotFoundError:
+            return []
+        versions = [entry["name"].rstrip("/").split("/")[-1] for entry in entries]
+        return sorted((v for v in versions if parse_version(v) is not None), key=parse_version)
+
+    def _initial_index(self) -> t.Dict[str, t.Any]:
+        versions = self._list_versions()
+        return {
+            "index_version": INDEX_VERSION,
+            "generation": 0,
+            "versions": {v: {"status": COMPLETE} for v in versions},
+            "latest": versions[-1] if versions else None,
+            "next": parse_version(versions[-1]) + 1 if versions else 0,
+        }
+
+    def _update(self, update: t.Callable[[t.Dict[str, t.Any]], None]) -> None:
+        """Apply `update` to the latest generation of the index and write the result as the next generation"""
+        index = self.read()
+        if index is None:
+            # The first generation describes the versions that exist without an index
+            index = self._cat_json(self._generation_file(0)) or self._initial_index()
+        for _ in range(self.max_attempts):
+            # Catch up with generations that were created after the copy was written
+            newer = self._cat_json(self._generation_file(index["generation"] + 1))
+            if newer is not None:
+                index = newer
+                continue
+            if index["generation"] == 0 and not self.fs.exists(self._generation_file(0)):
+                if not self._create(self._generation_file(0), index):
+                    index = self._cat_json(self._generation_file(0))
+                    continue
+            new_index = json.loads(json.dumps(index))
+            update(new_index)
+            new_index["generation"] = index["generation"] + 1
+            if self._create(self._generation_file(new_index["generation"]), new_index):
+                self._publish(new_index)
+                return
+        raise RuntimeError(f"Could not update the index of {self.artifact_dir} after {self.max_attempts} attempts.")
+
+    def _create(self, path: str, index: t.Dict[str, t.Any]) -> bool:
+        """Create the file at `path` if it does not exist yet, and return whether it was created"""
+        self.fs.makedirs(self.fs._parent(path), exist_ok=True)
+        try:
+            with self.fs.open(path, "xb") as f:
+                f.write(json.dumps(index).encode())
+        except FileExistsError:
+            return False
+        return True
+
+    def _publish(self, index: t.Dict[str, t.Any]) -> None:
+        """Copy a generation to the index file, and then any newer generation, so that a writer that publishes an older
+        generation last does not leave a stale copy behind.
+        """
+        while index is not None:
+            current = self.read()
+            if current is None or current["generation"] < index["generation"]:
+                # Written under a temporary name first, so that readers never see a partial index
+                tmp_file = f"{self.index_file}.tmp-{uuid.uuid4().hex}"
+                self.fs.pipe_file(tmp_file, json.dumps(index, indent=1).encode())
+                self.fs.mv(tmp_file, self.index_file)
+            index = self._cat_json(self._generation_file(index["generation"] + 1))
@@ -2,6 +2,7 @@ import logging
 import typing as t
 
 from scaffold.data.artifact_manager.base import Artifact, ArtifactManager, TmpArtifact
+from scaffold.data.artifact_manager.cache import ArtifactCache
 from scaffold.data.fs import get_fs_from_url
 
 logger = logging.getLogger(__name__)
@@ -18,7 +19,11 @@ class WandbArtifactManager(ArtifactManager):
     """
 
     def __init__(
-        self, entity: t.Optional[str] = None, project: t.Optional[str] = None, collection: str = "default"
+        self,
+        entity: t.Optional[str] = None,
+        project: t.Optional[str] = None,
+        collection: str = "default",
+        cache: t.Optional[ArtifactCache] = None,
     ) -> None:
         """Initialize the WandbArtifactManager.
 
@@ -26,6 +31,8 @@ class WandbArtifactManager(ArtifactManager):
             entity (Optional[str]): If not provided, it's inferred from the active run / API settings.
             project (Optional[str]): If not provided, it's inferred from the active run / API settings.
             collection (str): The default collection (artifact type) name. Defaults to "default".
+            cache (Optional[ArtifactCache]): A local cache of downloaded artifact versions. Aliases like "latest" are
+                cached under the fixed version they resolve to, e.g. "v3".
 
         Raises:
             ValueError: If neither a project nor an active project can be identified.
@@ -33,7 +40,7 @@ class WandbArtifactManager(ArtifactManager):
         import wandb
 
         self._wandb = wandb
-        super().__init__(collection=collection)
+        super().__init__(collection=collection, cache=cache)
         if project is not None:
             self.project = project
         elif self._wandb.run is not None:
@@ -57,6 +64,11 @@ class WandbArtifactManager(ArtifactManager):
             self.entity = self._wandb.Api().project(self.project).entity
             logger.info(f"Using entity {self.entity} from wandb project.")
 
+    @property
+    def backend_id(self) -> str:
+        """The entity and project of the manager"""
+        return f"wandb://{self.entity}/{self.project}"
+
     def list_collection_names(self) -> t.Iterable[str]:
         """List all collections (artifact types) managed by WandB.
 
@@ -156,7 +168,9 @@ class WandbArtifactManager(ArtifactManager):
             )
 
         if to is not None:
-            art.download(to)
-            return Artifact(name=artifact_name, collection=collection, version=version)
+            artifact = Artifact(name=artifact_name, collection=collection, version=version)
+            # An alias like "latest" is cached under the version it currently resolves to
+            self._download_with_cache(artifact, to, art.download, version=art.version)
+            return artifact
         else:
             return TmpArtifact(self, collection, artifact_name, version)
@@ -1,9 +1,39 @@
+import os
+import threading
+from typing import Dict
+
 import fsspec
 from fsspec.core import split_protocol
+from fsspec.utils import tokenize
 
 from scaffold.data.constants import FILESYSTEM, URL
 
-__all__ = ["get_fs_from_url", "get_protocol"]
+__all__ = ["get_fs_from_url", "get_protocol", "clear_fs_pool"]
+
+# Filesystem instances of the current process by protocol and storage options
+_fs_pool: Dict[str, FILESYSTEM] = {}
+_fs_pool_lock = threading.Lock()
+
+
+def clear_fs_pool() -> None:
+    """Drop all pooled filesystem instances, so that :py:func:`get_fs_from_url` creates new ones, e.g. after the
+    credentials changed.
+    """
+    with _fs_pool_lock:
+        _fs_pool.clear()
+
+
+def _reset_fs_pool_after_fork() -> None:
+    """Forked processes must not use the connections of the parent, so the instances are dropped without closing them
+    and the lock, which may have been held by another thread while forking, is recreated.
+    """
+    global _fs_pool_lock
+    _fs_pool.clear()
+    _fs_pool_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_fs_pool_after_fork)
 
 
 def join_path(*parts: str) -> str:
@@ -31,13 +61,25 @@ def get_fs_from_url(url: URL, **storage_options) -> FILESYSTEM:
 
     The protocol can be overriden via the `storage_options`. This is important if people want to use the fsspec caching
     functionality, which requires the protocol to be, e.g., `simplecache`.
+
+    Instances are pooled per process by protocol and storage options, so that clients, credentials and connections are
+    reused by all callers. Forked processes, e.g. DataLoader workers, start with an empty pool. Pass
+    `skip_instance_cache=True` to get a new instance that is not pooled, and see :py:func:`clear_fs_pool`.
     """
 
     protocol, _ = split_protocol(url)
 
     # Provided storage_options take precedence
     storage_options = {"protocol": protocol, **storage_options}
-    return fsspec.filesystem(**storage_options)
+    if storage_options.get("skip_instance_cache"):
+        return fsspec.filesystem(**storage_options)
+    key = tokenize(storage_options)
+    with _fs_pool_lock:
+        fs = _fs_pool.get(key)
+        if fs is None:
+            # Bypass the instance cache of fsspec, so that the pool is the only reference and can be cleared
+            fs = _fs_pool[key] = fsspec.filesystem(skip_instance_cache=True, **storage_options)
+    return fs
 
 
 def get_protocol(url: str) -> str:
@@ -1,14 +1,42 @@
 from __future__ import annotations
 
+import asyncio
 import inspect
+import multiprocessing
 import queue
+import threading
 from abc import abstractmethod
-from concurrent.futures import Executor, ThreadPoolExecutor
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from copy import deepcopy
 from functools import partial
-from typing import Any, Callable, Generator, Iterable, Iterator, List, Optional, Type, Union
-
-from scaffold.data.iterstream.iterators import batched_, filter_, flatten_, map_, shuffle_, take_, tqdm_
+from itertools import chain, islice
+from typing import TYPE_CHECKING, Any, Callable, Dict, Generator, Iterable, Iterator, List, Optional, Type, Union
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+from scaffold.data.iterstream.cache import DiskCache, ItemCache, fingerprint
+from scaffold.data.iterstream.iterators import (
+    SeededCallback,
+    ShuffleBuffer,
+    Take,
+    batched_,
+    columnar_batched_,
+    filter_,
+    flatten_,
+    fused_,
+    get_shard_info,
+    getsize,
+    is_fusible,
+    map_,
+    tqdm_,
+    unbatched_,
+)
+from scaffold.data.iterstream.shared_memory import SharedMemoryCallback, from_shared_memory, release_shared_memory
+
+if TYPE_CHECKING:
+    from scaffold.data.iterstream.profiling import ProfiledPipeline
 
 __all__ = ["Composable", "AsyncContent"]
 
@@ -16,6 +44,10 @@ __all__ = ["Composable", "AsyncContent"]
 class Composable(Iterable):
     """A mix-in class that provides stream manipulation functionalities."""
 
+    #: Public attributes that hold the progress of an iteration rather than the configuration of the stage. They are
+    #: left out of the :py:func:`fingerprint <scaffold.data.iterstream.cache.fingerprint>` of the stream.
+    _runtime_attrs = ()
+
     def __init__(self, source: Optional[Union[Iterable, Callable]] = None):
         """Init"""
         self.source = source
@@ -25,6 +57,28 @@ class Composable(Iterable):
         """Abstract iter"""
         pass
 
+    def state_dict(self) -> Dict[str, Any]:
+        """Return the state of the stream, which allows resuming it with :py:meth:`load_state_dict`.
+
+        The state should be taken between two items, i.e. while the consumer holds the last yielded item. It describes
+        the stream as if all items yielded so far have been consumed. Stages without state only forward the state of
+        their source. The state must be pickled (e.g. with `torch.save`) to be persisted.
+        """
+        if isinstance(self.source, Composable):
+            return {"source": self.source.state_dict()}
+        return {}
+
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        """Restore a state obtained from :py:meth:`state_dict`. The next iteration continues where the state was
+        taken, without replaying the items that were consumed before.
+        """
+        if "source" in state and isinstance(self.source, Composable):
+            self.source.load_state_dict(state["source"])
+
+    def _occupancy(self) -> Optional[int]:
+        """Number of items buffered or in flight in the stage, for stages that read ahead of their consumer"""
+        return None
+
     def compose(self, constructor: Type[Composable], *args, **kw) -> Composable:
         """
         Apply the transformation expressed in the `__iter__` method of the `constructor` to items in the stream.
@@ -47,11 +101,52 @@ class Composable(Iterable):
         self.source = source
         return self
 
-    def map(self, callback: Callable, **kw) -> _Iterable:
-        """Applies the ``callback`` to each item in the stream. Specify key-word arguments for callback in ``kw``"""
+    def map(self, callback: Callable, item_seed: Optional[int] = None, **kw) -> _Iterable:
+        """Applies the ``callback`` to each item in the stream. Specify key-word arguments for callback in ``kw``.
+
+        If `item_seed` is provided, the callback is called as `callback(item, rng=rng, **kw)`, where `rng` is a
+        :py:class:`numpy.random.Generator` seeded with `item_seed` and the index of the item in the stream, see
+        :py:class:`SeededCallback <scaffold.data.iterstream.iterators.SeededCallback>`.
+        """
         partial_callback = partial(callback, **kw)
+        if item_seed is not None:
+            return self.zip_index().to(map_, SeededCallback(partial_callback, item_seed))
         return self.to(map_, partial_callback)
 
+    def map_batches(
+        self,
+        callback: Callable,
+        batch_size: int = 256,
+        keep_batched: bool = False,
+        asynchronous: bool = False,
+        buffer: int = 8,
+        max_workers: Optional[int] = None,
+        processes: bool = False,
+        **kw,
+    ) -> Composable:
+        """Apply a vectorized `callback` to batches of items, e.g. a NumPy function.
+
+        The items are collated column by column into batches of `batch_size`, see `columnar` in :py:meth:`batched`.
+        The last batch may be smaller. The `callback` is called once per batch and must return a batch with a
+        leading dimension of the same length, which is split back into items unless `keep_batched` is True.
+
+        Args:
+            callback (Callable): function applied to each batch
+            batch_size (int): number of items per batch
+            keep_batched (bool): if True, the results of `callback` are yielded as batches
+            asynchronous (bool): if True, the batches are processed concurrently with :py:meth:`async_map`
+            buffer (int): only used if `asynchronous` is True, the number of batches in flight
+            max_workers (int, optional): only used if `asynchronous` is True, passed to :py:meth:`async_map`
+            processes (bool): only used if `asynchronous` is True, passed to :py:meth:`async_map`
+            **kw (dict): key-word arguments for callback
+        """
+        batches = self.batched(batch_size, drop_last_if_not_full=False, columnar=True)
+        if asynchronous:
+            results = batches.async_map(callback, buffer=buffer, max_workers=max_workers, processes=processes, **kw)
+        else:
+            results = batches.map(callback, **kw)
+        return results if keep_batched else results.to(unbatched_)
+
     def filter(self, predicate: Callable) -> _Iterable:
         """Filters items by `predicate` callable"""
         return self.to(filter_, predicate)
@@ -62,6 +157,9 @@ class Composable(Iterable):
         buffer: int = 100,
         max_workers: Optional[int] = None,
         executor: Optional[Executor] = None,
+        processes: bool = False,
+        ordered: bool = True,
+        item_seed: Optional[int] = None,
         **kw,
     ) -> _AsyncMap:
         """
@@ -87,21 +185,119 @@ class Composable(Iterable):
 
                 Note: if executor is provided, the argument ``max_workers`` will be ignored. You should
                 specify this in the executor that is being passed.
+            processes (bool): If True, the `callback` runs in a
+                :py:class:`ProcessPoolExecutor <concurrent.futures.ProcessPoolExecutor>` with `max_workers` processes,
+                which is created lazily when iterating, also in the workers of a PyTorch DataLoader. NumPy arrays in the
+                results are handed back through shared memory instead of being pickled, which makes this a good choice
+                for cpu-bound stages such as decoding. The `callback` and the items must be picklable. Cannot be
+                combined with `executor`.
+            ordered (bool): If True (the default), results are returned in the order of the items in the stream. If
+                False, results are returned as soon as they are completed, so that a single slow item does not stall
+                the stream. The number of items in flight is still bounded by `buffer`.
+            item_seed (int, optional): If provided, the callback is called as `callback(item, rng=rng, **kw)`, where
+                `rng` is a :py:class:`numpy.random.Generator` seeded with `item_seed` and the index of the item in the
+                stream. Random augmentations are then reproducible, whatever the number of workers or the executor.
             **kw (dict): key-word arguments for callback
 
         Returns (_AsyncMap)
         """
         partial_callback = partial(callback, **kw)
+        if item_seed is not None:
+            return self.zip_index().async_map(
+                SeededCallback(partial_callback, item_seed),
+                buffer=buffer,
+                max_workers=max_workers,
+                executor=executor,
+                processes=processes,
+                ordered=ordered,
+            )
+        if processes:
+            if executor is not None:
+                raise ValueError("`executor` cannot be provided if `processes` is True.")
+            return _ProcessAsyncMap(
+                source=self, callback=partial_callback, buffer=buffer, max_workers=max_workers, ordered=ordered
+            )
         return _AsyncMap(
-            source=self, callback=partial_callback, buffer=buffer, max_workers=max_workers, executor=executor
+            source=self,
+            callback=partial_callback,
+            buffer=buffer,
+            max_workers=max_workers,
+            executor=executor,
+            ordered=ordered,
         )
 
+    def asyncio_map(self, callback: Callable, buffer: int = 1000, ordered: bool = True, **kw) -> _AsyncioMap:
+        """
+        Applies the coroutine function `callback` to the items in the stream on a private event loop.
+
+        The event loop runs in a single background thread, which is started lazily when iterating. This allows
+        thousands of concurrent I/O-bound operations, e.g. fetching objects with an asynchronous fsspec filesystem,
+        without a thread per operation. The loop is available inside the callback via
+        :py:func:`asyncio.get_running_loop`.
+
+        Args:
+            callback (Callable): an `async def` function to be applied to items in the stream
+            buffer (int): the maximum number of coroutines in flight
+            ordered (bool): If True (the default), results are returned in the order of the items in the stream. If
+                False, results are returned as soon as they are completed.
+            **kw (dict): key-word arguments for callback
+
+        Returns (_AsyncioMap)
+        """
+        partial_callback = partial(callback, **kw)
+        if not inspect.iscoroutinefunction(partial_callback):
+            raise TypeError(f"callback {callback} must be a coroutine function, i.e. defined with `async def`.")
+        return _AsyncioMap(source=self, callback=partial_callback, buffer=buffer, ordered=ordered)
+
+    def prefetch(self, n_items: Optional[int] = None, max_bytes: Optional[int] = None) -> _PrefetchIterable:
+        """Run all upstream stages in a background thread, which reads ahead of the consumer.
+
+        The thread pauses when `n_items` items are buffered, or when the estimated size of the buffered items reaches
+        `max_bytes`. Sizes are estimated with :py:func:`getsize <scaffold.data.iterstream.iterators.getsize>`. A
+        single item is always buffered, even if it is larger than `max_bytes`. Exceptions raised upstream are raised
+        in the consumer after the items buffered before.
+
+        Args:
+            n_items (int, optional): Maximum number of buffered items.
+            max_bytes (int, optional): Maximum estimated size of the buffered items in bytes.
+        """
+        if n_items is None and max_bytes is None:
+            raise ValueError("At least one of `n_items` and `max_bytes` must be provided.")
+        return _PrefetchIterable(self, n_items=n_items, max_bytes=max_bytes)
+
     def flatten(self) -> _Iterable:
         """When items in the stream are themselves iterables, flatten turn them back to individual items again"""
         return self.to(flatten_)
 
+    def interleave(
+        self, callback: Optional[Callable] = None, cycle_length: int = 8, prefetch: int = 16, ordered: bool = True
+    ) -> _InterleaveIterable:
+        """Interleave the items of the iterables `callback(item)` for the items in the stream, e.g. the samples of
+        shard files. `cycle_length` iterables are open at the same time, and each one is read in a background thread
+        into a queue of up to `prefetch` items, so that slow reads overlap.
+
+        Args:
+            callback (Callable, optional): Maps an item of the stream to an iterable. If None, the items of the stream
+                are iterables themselves.
+            cycle_length (int): Number of iterables that are read concurrently. When one is exhausted, the next item
+                of the stream is opened in its place.
+            prefetch (int): Number of items that are read ahead per open iterable.
+            ordered (bool): If True, items are taken from the open iterables in turn, which is deterministic. If False,
+                the next item is taken from whichever iterable has one ready, so that a slow iterable does not block
+                the stream.
+
+        Note: the state of the stream holds the items of the open iterables and the number of values yielded from
+        each. When resuming, these values are skipped, which requires reading them again.
+        """
+        return _InterleaveIterable(self, callback, cycle_length=cycle_length, prefetch=prefetch, ordered=ordered)
+
     def batched(
-        self, batchsize: int, collation_fn: Optional[Callable] = None, drop_last_if_not_full: bool = True
+        self,
+        batchsize: int,
+        collation_fn: Optional[Callable] = None,
+        drop_last_if_not_full: bool = True,
+        columnar: bool = False,
+        num_buffers: Optional[int] = None,
     ) -> _Iterable:
         """Batch items in the stream.
 
@@ -109,7 +305,24 @@ class Composable(Iterable):
             batchsize: number of items to be batched together
             collation_fn: Collation function to use.
             drop_last_if_not_full (bool): if the length of the last batch is less than the `batchsize`, drop it
+            columnar (bool): if True, the structure of the samples is inferred from the first one and each sample is
+                written directly into preallocated NumPy arrays or torch tensors of shape `(batchsize, ...)` per field,
+                instead of building a list of samples. See
+                :py:func:`columnar_batched_ <scaffold.data.iterstream.iterators.columnar_batched_>`.
+                Cannot be combined with `collation_fn`.
+            num_buffers (int, optional): only used if `columnar` is True. If provided, a ring of `num_buffers`
+                batches is reused instead of allocating new arrays for every batch. A batch is then overwritten
+                `num_buffers` batches later.
         """
+        if columnar:
+            if collation_fn is not None:
+                raise ValueError("`collation_fn` cannot be provided if `columnar` is True.")
+            return self.to(
+                columnar_batched_,
+                batchsize=batchsize,
+                drop_last_if_not_full=drop_last_if_not_full,
+                num_buffers=num_buffers,
+            )
         return self.to(
             batched_,
             batchsize=batchsize,
@@ -126,6 +339,7 @@ class Composable(Iterable):
         drop_last_if_not_full: bool = True,
         min_window_size: int = 1,
         fill_nan_on_partial: bool = False,
+        as_array: bool = False,
     ) -> Composable:
         """
         Apply sliding window over the stream.
@@ -143,6 +357,11 @@ class Composable(Iterable):
             fill_nan_on_partial (bool): If `drop_last_if_not_full` is False, the length of the last few windows
                 will be less than `window_size`. This argument fill the missing values with None if set to True.
                 This argument take precedence over If `min_window_size`.
+            as_array (bool): If True, items must be NumPy arrays or numbers of the same shape and dtype, and windows
+                are returned as read-only arrays of shape `(window_size, ...)`. Windows are strided views on
+                contiguous chunks of the stream, so there is no copy per step. Set `deepcopy` to True to get writable
+                copies instead. Partial windows are filled with NaN if `fill_nan_on_partial` is set, which promotes
+                integer dtypes to float.
 
         """
         if not window_size > 1:
@@ -152,7 +371,8 @@ class Composable(Iterable):
         if not window_size >= stride >= 1:
             raise ValueError("stride should be smaller or equal to window_size, and greater or equal to 1")
 
-        return _SlidingIter(
+        cls = _ArraySlidingIter if as_array else _SlidingIter
+        return cls(
             source=self,
             window_size=window_size,
             deepcopy=deepcopy,
@@ -173,11 +393,14 @@ class Composable(Iterable):
         - initial (int, optional): Minimum number of elements in the buffer before yielding the first element.
           Must be less than or equal to `size`, otherwise will be set to `size`. Defaults to 100.
 
-        - rng (random.Random, optional): Either `random` module or a :py:class:`random.Random` instance. If None,
-          a `random.Random()` is used.
+        - rng (Union[random.Random, numpy.random.Generator], optional): A :py:class:`numpy.random.Generator`, or
+          either `random` module or a :py:class:`random.Random` instance used to seed one. If None, a
+          `random.Random()` is used.
 
         - seed (Union[int, float, str, bytes, bytearray, None]): A data input that can be used for `random.seed()`.
+          For a given seed and input stream, the output order is identical across runs.
 
+        The buffered items and the random state are part of the :py:meth:`state_dict` of the stream.
         """
 
         if size is None:
@@ -185,24 +408,73 @@ class Composable(Iterable):
 
         if size < 2:
             return self
-        return self.to(shuffle_, size, **kw)
+        return self.to(ShuffleBuffer(size, **kw))
 
     def take(self, n: Optional[int]) -> Composable:
-        """Take n samples from iterable"""
+        """Take n samples from iterable. The number of samples taken so far is part of the state of the stage."""
         if n is None:
             return self
-        return self.to(take_, n)
+        return self.to(Take(n))
+
+    def shard(self, index: Optional[int] = None, count: Optional[int] = None) -> _ShardIterable:
+        """Only keep every `count`-th item of the stream, starting at `index`.
+
+        Items are assigned to shards by their position in the stream, so the stream must yield the same items in the
+        same order in all processes. Where possible, prefer sharding the source (e.g. `shard=True` for
+        :py:class:`IterableSource` and :py:class:`FilePathGenerator`), so that items of other shards are never fetched.
 
-    def loop(self, n: Optional[int] = None) -> Composable:
+        Args:
+            index (int, optional): Index of the shard to keep. If `index` and `count` are None, they are obtained from
+                the rank and world size of `torch.distributed` and the DataLoader worker info when iterating, see
+                :py:func:`get_shard_info <scaffold.data.iterstream.iterators.get_shard_info>`.
+            count (int, optional): Total number of shards.
+        """
+        if (index is None) != (count is None):
+            raise ValueError("`index` and `count` must either both be provided or both be None.")
+        if count is not None and not 0 <= index < count:
+            raise ValueError("`index` must satisfy 0 <= index < count.")
+        return _ShardIterable(self, index=index, count=count)
+
+    def loop(self, n: Optional[int] = None, copy: bool = True) -> Composable:
         """Repeat the iterable n times.
 
         Args:
             n (int, Optional): number of times that the iterable is looped over. If None (the default), it loops forever
+            copy (bool): if True (the default), each epoch iterates over a deepcopy of the `source` attribute, i.e. all
+                steps in the chain of Composables `before` the loop itself, which must be picklable. If False, `iter()`
+                is called on the source again for each epoch, which requires all steps to be re-iterable, but avoids
+                copying large in-memory sources, executors or filesystems.
+        """
+        return _LoopIterable(self, n, copy=copy)
+
+    def cache(
+        self, path: Optional[str] = None, spill: bool = False, key: Optional[str] = None, chunk_size: int = 1024
+    ) -> _CacheIterable:
+        """Keep the items of the first complete iteration and replay them in later iterations, e.g. the epochs of
+        :py:meth:`loop`, without iterating over the upstream stages again.
+
+        Items are only replayed once an iteration has been completed, an interrupted iteration is started over. When
+        resuming from a state taken while replaying in a new process, the cache is refilled from the start of the
+        stream, unless it is persistent.
 
-        Note: this method creates a deepcopy of the `source` attribute, i.e. all steps in the chain of Composables
-        `before` the loop itself, which must be picklable.
+        Args:
+            path (str, optional): If provided, the items are stored persistently in this local directory, so that
+                later runs of the same pipeline replay them without running the upstream stages at all. Each shard
+                (see :py:func:`get_shard_info <scaffold.data.iterstream.iterators.get_shard_info>`) is stored
+                separately, and concurrent writers are safe. See :py:class:`DiskCache
+                <scaffold.data.iterstream.cache.DiskCache>`.
+            spill (bool): Only used if `path` is None. If False, the items are kept in memory and the same objects are
+                yielded in each iteration, so they should not be modified downstream. If True, the items are pickled
+                into a local temporary file, which is memory-mapped when replaying. See :py:class:`ItemCache
+                <scaffold.data.iterstream.cache.ItemCache>`.
+            key (str, optional): Only used if `path` is provided. Key of the stored items, which defaults to the
+                :py:func:`fingerprint <scaffold.data.iterstream.cache.fingerprint>` of the upstream stages. Provide a
+                key if the items depend on data that the fingerprint does not cover, e.g. the content of a bucket.
+            chunk_size (int): Only used if `path` is provided. Number of items per file.
         """
-        return _LoopIterable(self, n)
+        if path is None:
+            return _CacheIterable(self, ItemCache(spill=spill))
+        return _CacheIterable(self, DiskCache(path, key or fingerprint(self), chunk_size=chunk_size))
 
     def zip_index(self, pad_length: int = None) -> Composable:
         """Zip the item in the stream with its index and yield Tuple[index, item]
@@ -226,6 +498,22 @@ class Composable(Iterable):
         """Add tqdm to iterator."""
         return self.to(tqdm_, **kw)
 
+    def profile(self, measure_bytes: bool = False) -> ProfiledPipeline:
+        """Profile all stages of the pipeline, which is modified in place. The returned pipeline yields the same items
+        and provides a report of the throughput of each stage, the time spent inside the stage and waiting on its
+        source, and the mean occupancy of the buffers of stages that read ahead, such as :py:meth:`async_map`.
+
+        Args:
+            measure_bytes (bool): If True, the bytes per second of each stage are reported, which are estimated with
+                :py:func:`getsize <scaffold.data.iterstream.iterators.getsize>` for every item.
+
+        Returns (ProfiledPipeline): see
+            :py:class:`ProfiledPipeline <scaffold.data.iterstream.profiling.ProfiledPipeline>`.
+        """
+        from scaffold.data.iterstream.profiling import ProfiledPipeline
+
+        return ProfiledPipeline(self, measure_bytes=measure_bytes)
+
 
 class _Iterable(Composable):
     """
@@ -250,11 +538,37 @@ class _Iterable(Composable):
         self.kw = kw
 
     def __iter__(self) -> Iterator:
-        """Returns the iterator that is obtained by applying `self.f` to `self.source`."""
+        """Returns the iterator that is obtained by applying `self.f` to `self.source`.
+
+        Consecutive map, filter and take stages are fused into a single generator, which avoids a generator frame
+        switch per stage and item. Their results and exceptions are the same as without fusing.
+        """
         assert self.source is not None, f"must set source before calling iter {self.f} {self.args} {self.kw}"
         assert callable(self.f), self.f
+        if is_fusible(self.f):
+            ops = []
+            stage = self
+            # Stateless stages of other types, e.g. the wrappers of `profile`, are not fused
+            while type(stage) is _Iterable and is_fusible(stage.f):
+                assert stage.source is not None, f"must set source before calling iter {stage.f}"
+                ops.append((stage.f, stage.args, stage.kw))
+                stage = stage.source
+            return fused_(iter(stage), ops[::-1])
         return self.f(iter(self.source), *self.args, **self.kw)
 
+    def state_dict(self) -> Dict[str, Any]:
+        """Return the state of the source, and of `f` if it is stateful like :py:class:`ShuffleBuffer`"""
+        state = super().state_dict()
+        if hasattr(self.f, "state_dict"):
+            state["f"] = self.f.state_dict()
+        return state
+
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        """Restore the state of the source and of `f`"""
+        super().load_state_dict(state)
+        if "f" in state:
+            self.f.load_state_dict(state["f"])
+
 
 class _SlidingIter(Composable):
     def __init__(
@@ -325,34 +639,235 @@ class _SlidingIter(Composable):
             return _win
 
 
+class _ArraySlidingIter(_SlidingIter):
+    def __init__(self, *args, chunk_size: int = 1024, **kw):
+        """A :py:class:`_SlidingIter` over arrays, which yields windows as read-only strided views.
+
+        Items are written into a contiguous buffer that holds at least `chunk_size` windows. Once all windows of a
+        buffer are yielded, the rows needed by the next windows are carried over into a new buffer. Buffers are never
+        overwritten, so windows remain valid after subsequent steps.
+        """
+        super().__init__(*args, **kw)
+        self.chunk_size = chunk_size
+
+    def __iter__(self) -> Iterator[np.ndarray]:
+        it = iter(self.source)
+        sentinel = object()
+        first = next(it, sentinel)
+        if first is sentinel:
+            return
+        first = np.asarray(first)
+        size, stride = self.window_size, self.stride
+        capacity = size + (max(self.chunk_size, size // stride) - 1) * stride
+
+        buf = np.empty((capacity, *first.shape), dtype=first.dtype)
+        buf[0] = first
+        filled = 1
+        while True:
+            exhausted = False
+            while filled < capacity:
+                item = next(it, sentinel)
+                if item is sentinel:
+                    exhausted = True
+                    break
+                buf[filled] = item
+                filled += 1
+
+            n_windows = (filled - size) // stride + 1 if filled >= size else 0
+            if n_windows > 0:
+                windows = as_strided(
+                    buf,
+                    shape=(n_windows, size, *buf.shape[1:]),
+                    strides=(buf.strides[0] * stride, *buf.strides),
+                    writeable=False,
+                )
+                for win in windows:
+                    yield from self._yield(win)
+
+            start = n_windows * stride
+            if exhausted:
+                if not self.drop_last_if_not_full:
+                    yield from self._partial(buf, start, filled)
+                return
+
+            carry = filled - start
+            new_buf = np.empty_like(buf)
+            new_buf[:carry] = buf[start:filled]
+            buf, filled = new_buf, carry
+
+    def _partial(self, buf: np.ndarray, start: int, filled: int) -> Iterator[np.ndarray]:
+        for pos in range(start, filled, self.stride):
+            win = buf[pos:filled]
+            if self.fill_nan_on_partial:
+                padded = np.full((self.window_size, *buf.shape[1:]), np.nan, np.result_type(buf.dtype, np.float64))
+                padded[: len(win)] = win
+                yield padded
+            elif len(win) >= self.min_window_size:
+                yield from self._yield(win.view())
+            else:
+                return
+
+    def _yield(self, _win: np.ndarray) -> Generator[np.ndarray, None, None]:
+        if self.deepcopy:
+            yield _win.copy()
+        else:
+            _win.flags.writeable = False
+            yield _win
+
+
+class _ShardIterable(Composable):
+    def __init__(self, source: Iterable, index: Optional[int] = None, count: Optional[int] = None) -> None:
+        """Init"""
+        super().__init__(source)
+        self.index = index
+        self.count = count
+        self._position = 0
+        self._resume_position = 0
+
+    def __iter__(self) -> Iterator:
+        """Yield the items of the shard"""
+        index, count = (self.index, self.count) if self.count is not None else get_shard_info()
+        self._position, self._resume_position = self._resume_position, 0
+        for item in self.source:
+            position = self._position
+            self._position += 1
+            if position % count == index:
+                yield item
+
+    def state_dict(self) -> Dict[str, Any]:
+        """Return the position in the stream and the state of the source"""
+        return {**super().state_dict(), "position": self._resume_position or self._position}
+
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        """Restore the position in the stream and the state of the source"""
+        super().load_state_dict(state)
+        self._resume_position = state["position"]
+
+
 class _LoopIterable(Composable):
-    def __init__(self, source: Iterable, n: Optional[int]):
+    _runtime_attrs = ("counter",)
+
+    def __init__(self, source: Iterable, n: Optional[int], copy: bool = True):
         """Init"""
         super().__init__(source=source)
         self.n = n
+        self.copy = copy
         self.counter = 0
+        self._current = None
+        self._resume = None
 
     def __iter__(self) -> Iterator:
         """Iterate over the iterable n times"""
         _started = False
+        # A restored epoch may already be exhausted, which must not be mistaken for an empty source
+        _resumed = self._resume is not None
         if self.n is None:
-            current_ = iter(deepcopy(self.source))
+            current_ = self._epoch()
             while True:
                 try:
                     yield next(current_)
                     _started = True
                 except StopIteration:
-                    if not _started:
+                    if not _started and not _resumed:
                         return
+                    _resumed = False
                     self.counter += 1
-                    current_ = iter(deepcopy(self.source))
+                    current_ = self._epoch()
         else:
-            for _ in range(self.n):
-                yield from iter(deepcopy(self.source))
+            start = self.counter if _resumed else 0
+            for _ in range(start, self.n):
+                yield from self._epoch()
                 self.counter += 1
 
+    def _epoch(self) -> Iterator:
+        """Copy the source for a new epoch, restoring the saved state of the source for a resumed epoch"""
+        self._current = deepcopy(self.source) if self.copy else self.source
+        if self._resume is not None:
+            if isinstance(self._current, Composable):
+                self._current.load_state_dict(self._resume)
+            self._resume = None
+        return iter(self._current)
+
+    def state_dict(self) -> Dict[str, Any]:
+        """Return the loop counter and the state of the current epoch"""
+        if self._resume is not None:
+            return {"counter": self.counter, "source": self._resume}
+        source_state = self._current.state_dict() if isinstance(self._current, Composable) else {}
+        return {"counter": self.counter, "source": source_state}
+
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        """Restore the loop counter, the next iteration resumes the saved epoch"""
+        self.counter = state["counter"]
+        self._resume = state["source"]
+
+
+class _CacheIterable(Composable):
+    def __init__(self, source: Iterable, store: Union[ItemCache, DiskCache]) -> None:
+        """Init"""
+        super().__init__(source)
+        self.store = store
+        self._position = 0
+        self._replaying = False
+        self._resume = None
+
+    def __iter__(self) -> Iterator:
+        """Replay the cached items if an iteration has been completed, otherwise iterate over the source and cache its
+        items
+        """
+        resume, self._resume = self._resume, None
+        position = resume["position"] if resume is not None else 0
+        self._replaying = self.store.complete
+        if self._replaying:
+            self._position = position
+            for item in self.store.replay(position):
+                self._position += 1
+                yield item
+            return
+
+        if resume is None:
+            record, skip, self._position = True, 0, 0
+        elif resume["cached"]:
+            # The state was taken while replaying, the cache is refilled from the start of the stream
+            record, skip, self._position = True, position, 0
+        else:
+            # The state of the source has been restored, the items before `position` cannot be cached anymore
+            record, skip, self._position = False, 0, position
+        if not record:
+            for item in self.source:
+                self._position += 1
+                yield item
+            return
+        self.store.reset()
+        try:
+            for item in self.source:
+                self.store.append(item)
+                self._position += 1
+                if self._position > skip:
+                    yield item
+        except BaseException:
+            # Includes GeneratorExit if the iteration is interrupted
+            self.store.close()
+            raise
+        self.store.finish()
+
+    def state_dict(self) -> Dict[str, Any]:
+        """Return the position in the stream, and the state of the source unless the cached items are replayed"""
+        if self._resume is not None:
+            return self._resume
+        if self._replaying:
+            return {"position": self._position, "cached": True}
+        return {**super().state_dict(), "position": self._position, "cached": False}
+
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        """Restore the position in the stream, and the state of the source unless the cached items are replayed"""
+        if not state["cached"]:
+            super().load_state_dict(state)
+        self._resume = state
+
 
 class _ZipIndexIterable(Composable):
+    _runtime_attrs = ("idx",)
+
     def __init__(self, source: Iterable, pad_length: int = None) -> None:
         """Init"""
         super().__init__(source)
@@ -364,6 +879,15 @@ class _ZipIndexIterable(Composable):
         for i in self.source:
             yield self._next_idx(), i
 
+    def state_dict(self) -> Dict[str, Any]:
+        """Return the next index and the state of the source"""
+        return {**super().state_dict(), "idx": self.idx}
+
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        """Restore the next index and the state of the source"""
+        super().load_state_dict(state)
+        self.idx = state["idx"]
+
     def _next_idx(self) -> Union[int, str]:
         _idx = None
         if self.pad_length is not None:
@@ -376,7 +900,242 @@ class _ZipIndexIterable(Composable):
         return _idx
 
 
+class _PrefetchIterable(Composable):
+    def __init__(self, source: Iterable, n_items: Optional[int] = None, max_bytes: Optional[int] = None) -> None:
+        """Init"""
+        super().__init__(source)
+        self.n_items = n_items
+        self.max_bytes = max_bytes
+        # Synchronization state is created lazily in __iter__, see _AsyncMap
+        self._cond = None
+        self._buffer = None
+        self._nbytes = 0
+        self._stop = False
+        self._done = True
+        self._busy = False
+        self._paused = False
+        self._error = None
+        self._resume = []
+
+    def __iter__(self) -> Iterator:
+        """Yield the items buffered by the background thread"""
+        self._cond = threading.Condition()
+        # Items buffered when a restored state was taken are yielded first
+        self._buffer = deque((item, self._size(item)) for item in self._resume)
+        self._resume = []
+        self._nbytes = sum(size for _, size in self._buffer)
+        self._stop, self._done, self._busy, self._paused, self._error = False, False, False, False, None
+        thread = threading.Thread(target=self._produce, args=(iter(self.source),), daemon=True)
+        thread.start()
+        try:
+            while True:
+                with self._cond:
+                    while not self._buffer and not self._done:
+                        self._cond.wait()
+                    if not self._buffer:
+                        break
+                    item, size = self._buffer.popleft()
+                    self._nbytes -= size
+                    self._cond.notify_all()
+                yield item
+            if self._error is not None:
+                raise self._error
+        finally:
+            with self._cond:
+                self._stop = True
+                self._cond.notify_all()
+            thread.join()
+
+    def _size(self, item: Any) -> int:
+        return getsize(item) if self.max_bytes is not None else 0
+
+    def _occupancy(self) -> Optional[int]:
+        return len(self._buffer) if self._buffer is not None else None
+
+    def _full(self) -> bool:
+        if self.n_items is not None and len(self._buffer) >= self.n_items:
+            return True
+        return self.max_bytes is not None and len(self._buffer) > 0 and self._nbytes >= self.max_bytes
+
+    def _produce(self, it: Iterator) -> None:
+        try:
+            while True:
+                with self._cond:
+                    while not self._stop and (self._paused or self._full()):
+                        self._cond.wait()
+                    if self._stop:
+                        break
+                    self._busy = True
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+                size = self._size(item)
+                with self._cond:
+                    self._buffer.append((item, size))
+                    self._nbytes += size
+                    self._busy = False
+                    self._cond.notify_all()
+            # The consumer stopped early. The upstream stages are closed right away rather than when they are garbage
+            # collected, e.g. to shut down the executor of an async_map.
+            if hasattr(it, "close"):
+                it.close()
+        except BaseException as e:
+            # E.g. a KeyboardInterrupt must not look like the end of the stream to the consumer
+            self._error = e
+        finally:
+            with self._cond:
+                self._done = True
+                self._busy = False
+                self._cond.notify_all()
+
+    def state_dict(self) -> Dict[str, Any]:
+        """Return the state of the source and the buffered items. The background thread is paused until the state is
+        taken, so that the state of the source matches the buffered items.
+        """
+        if self._cond is None or self._resume:
+            return {**super().state_dict(), "buffered": list(self._resume)}
+        with self._cond:
+            self._paused = True
+            try:
+                while self._busy:
+                    self._cond.wait()
+                return {**super().state_dict(), "buffered": [item for item, _ in self._buffer]}
+            finally:
+                self._paused = False
+                self._cond.notify_all()
+
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        """Restore the state of the source, the buffered items are yielded first in the next iteration"""
+        super().load_state_dict(state)
+        self._resume = list(state["buffered"])
+
+
+class _InterleaveSlot:
+    """An open iterable of :py:class:`_InterleaveIterable` and the queue its values are read into"""
+
+    def __init__(self, item: Any, count: int, maxsize: int) -> None:
+        """Init"""
+        self.item = item
+        # Number of values yielded so far, including those yielded before the stream was resumed
+        self.count = count
+        self.queue = queue.Queue(maxsize)
+
+
+class _InterleaveIterable(Composable):
+    def __init__(
+        self, source: Iterable, callback: Optional[Callable], cycle_length: int, prefetch: int, ordered: bool
+    ) -> None:
+        """Init"""
+        super().__init__(source)
+        assert cycle_length > 0, "cycle_length must be positive"
+        self.callback = callback
+        self.cycle_length = cycle_length
+        self.prefetch = prefetch
+        self.ordered = ordered
+        self._slots = None
+        self._pending = None
+        self._position = 0
+        self._resume = None
+
+    def __iter__(self) -> Iterator:
+        """Yield the interleaved values of the open iterables"""
+        resume, self._resume = self._resume, None
+        # Items that were open when the state was taken, which are opened before taking new items from the source
+        self._pending = deque(tuple(entry) for entry in resume["open"]) if resume is not None else deque()
+        self._position = resume["position"] if resume is not None else 0
+        self._slots = slots = []
+        it = iter(self.source)
+        # Slots that have a value (or their end) in their queue, only needed if not ordered
+        ready = None if self.ordered else queue.Queue()
+        stop = threading.Event()
+
+        with ThreadPoolExecutor(max_workers=self.cycle_length) as pool:
+
+            def open_next() -> Optional[_InterleaveSlot]:
+                if self._pending:
+                    item, count = self._pending.popleft()
+                else:
+                    sentinel = object()
+                    item, count = next(it, sentinel), 0
+                    if item is sentinel:
+                        return None
+                slot = _InterleaveSlot(item, count, self.prefetch)
+                pool.submit(self._read, slot, count, ready, stop)
+                return slot
+
+            try:
+                while len(slots) < self.cycle_length:
+                    slot = open_next()
+                    if slot is None:
+                        break
+                    slots.append(slot)
+
+                while slots:
+                    if self.ordered:
+                        self._position %= len(slots)
+                        slot = slots[self._position]
+                    else:
+                        slot = ready.get()
+                    has_value, value = slot.queue.get()
+                    if has_value:
+                        slot.count += 1
+                        if self.ordered:
+                            self._position += 1
+                        yield value
+                        continue
+                    if value is not None:
+                        raise value
+                    # The iterable is exhausted, open the next one in its place
+                    i = slots.index(slot)
+                    new_slot = open_next()
+                    if new_slot is None:
+                        del slots[i]
+                    else:
+                        slots[i] = new_slot
+            finally:
+                stop.set()
+
+    def _occupancy(self) -> Optional[int]:
+        return sum(slot.queue.qsize() for slot in self._slots) if self._slots is not None else None
+
+    def _read(self, slot: _InterleaveSlot, skip: int, ready: Optional[queue.Queue], stop: threading.Event) -> None:
+        """Read the values of the iterable of `slot` into its queue, skipping the first `skip` values"""
+
+        def put(entry: tuple) -> bool:
+            if not _put_until(slot.queue, entry, stop):
+                return False
+            if ready is not None:
+                ready.put(slot)
+            return True
+
+        try:
+            iterable = slot.item if self.callback is None else self.callback(slot.item)
+            for value in islice(iter(iterable), skip, None):
+                if not put((True, value)):
+                    return
+            put((False, None))
+        except Exception as e:
+            put((False, e))
+
+    def state_dict(self) -> Dict[str, Any]:
+        """Return the state of the source, the open items with the number of values yielded from each, and the
+        position of the next open item to take a value from
+        """
+        if self._resume is not None:
+            return self._resume
+        open_items = [(slot.item, slot.count) for slot in self._slots or []] + list(self._pending or [])
+        return {**super().state_dict(), "open": open_items, "position": self._position}
+
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        """Restore the state of the source, the open items are opened first in the next iteration"""
+        super().load_state_dict(state)
+        self._resume = state
+
+
 class _AsyncMap(Composable):
+    _runtime_attrs = ("queue",)
+
     def __init__(
         self,
         source: Iterable,
@@ -384,6 +1143,7 @@ class _AsyncMap(Composable):
         buffer: int = 100,
         max_workers: Optional[int] = None,
         executor: Optional[Executor] = None,
+        ordered: bool = True,
     ):
         """A class that applies a `callback` asynchronously to the items in the `dataset`, using thread pool executor"""
         super().__init__(source)
@@ -391,29 +1151,72 @@ class _AsyncMap(Composable):
         self.callback = callback
         self.max_workers = max_workers
         self.executor = executor
+        self.ordered = ordered
 
         # Instantiate queue lazily in the __iter__ method
         # This is necessary to be compatible with the thread forking of PyTorch multiprocessing context
         # when using a multi-worker dataloader.
         self.queue = None
+        self._pending = None
+        self._resume = []
 
     def __iter__(self) -> Iterator:
         """An iterator"""
 
         self.queue = queue.Queue(self.buffer)
-        it = iter(self.source)
+        it = self._source_iter()
 
         if self._executor_not_provided():
             with ThreadPoolExecutor(max_workers=self.max_workers) as exec_:
-                yield from self._iter(it, exec_)
+                yield from self._run(it, exec_)
         elif isinstance(self.executor, Executor):
-            yield from self._iter(it, self.executor)
+            yield from self._run(it, self.executor)
         else:
             raise ValueError(f"Executor {self.executor} not recognized")
 
     def _executor_not_provided(self) -> bool:
         return self.executor is None
 
+    def _occupancy(self) -> Optional[int]:
+        if self.queue is None:
+            return None
+        return self.queue.qsize() + len(self._pending or ())
+
+    def _source_iter(self) -> Iterator:
+        """Iterator over the source, starting with the items that were in flight when a restored state was taken"""
+        resume, self._resume = self._resume, []
+        return chain(resume, iter(self.source))
+
+    def state_dict(self) -> Dict[str, Any]:
+        """Return the state of the source and the items that have been submitted but not yet yielded"""
+        in_flight = list(self._resume)
+        if self.queue is not None:
+            in_flight.extend(content.item for content in list(self.queue.queue))
+        if self._pending:
+            in_flight.extend(self._pending.values())
+        return {**super().state_dict(), "in_flight": in_flight}
+
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        """Restore the state of the source, the items in flight are submitted first in the next iteration"""
+        super().load_state_dict(state)
+        self._resume = list(state["in_flight"])
+
+    def _run(self, it: Iterator, executor: Executor) -> Iterator:
+        if self.ordered:
+            return self._iter(it, executor)
+        return self._iter_unordered(it, executor)
+
+    def _outstanding(self) -> List[Future]:
+        """Futures that have been submitted but whose results have not been yielded"""
+        futures = []
+        if self.queue is not None:
+            while not self.queue.empty():
+                futures.append(self.queue.get().future)
+        if self._pending is not None:
+            futures.extend(self._pending)
+            self._pending = {}
+        return futures
+
     def _iter(self, it: Iterator, executor: Executor) -> Iterator:
         sentinel = object()
         while True:
@@ -431,6 +1234,28 @@ class _AsyncMap(Composable):
             # yield sample
             yield self.queue.get().value()
 
+    def _iter_unordered(self, it: Iterator, executor: Executor) -> Iterator:
+        sentinel = object()
+        exhausted = False
+        # Maps the futures to their items, which are needed for the state
+        self._pending = {}
+        while True:
+            # Fill up to `buffer` items in flight, a non-positive buffer is unbounded like in queue.Queue
+            while not exhausted and (self.buffer <= 0 or len(self._pending) < self.buffer):
+                item = next(it, sentinel)
+                if item is sentinel:
+                    exhausted = True
+                    break
+                self._pending[executor.submit(self.callback, item)] = item
+
+            if not self._pending:
+                break
+
+            done, _ = wait(list(self._pending), return_when=FIRST_COMPLETED)
+            for future in done:
+                del self._pending[future]
+                yield future.result()
+
     def _dask_iter(self, it: Iterator) -> Iterator:
         sentinel = object()
         while True:
@@ -446,6 +1271,125 @@ class _AsyncMap(Composable):
             yield self.queue.get().result()
 
 
+def _process_pool_context() -> Optional[multiprocessing.context.BaseContext]:
+    """Return a multiprocessing context for a process pool that is created in a daemonic process, e.g. a worker of a
+    PyTorch DataLoader, or None in other processes.
+
+    Daemonic processes must not have children, so the workers of the pool are started as non-daemonic processes. They
+    are shut down with the pool when the stream is exhausted or closed.
+    """
+    if not multiprocessing.current_process().daemon:
+        return None
+    ctx = multiprocessing.get_context()
+
+    class _NonDaemonicProcess(ctx.Process):
+        def start(self) -> None:
+            # The check of `Process.start` reads the daemon flag of the current process
+            config = multiprocessing.current_process()._config
+            config["daemon"] = False
+            try:
+                super().start()
+            finally:
+                config["daemon"] = True
+
+    return type("_NonDaemonicContext", (type(ctx),), {"Process": _NonDaemonicProcess})()
+
+
+class _ProcessAsyncMap(_AsyncMap):
+    def __init__(
+        self,
+        source: Iterable,
+        callback: Callable,
+        buffer: int = 100,
+        max_workers: Optional[int] = None,
+        ordered: bool = True,
+        min_nbytes: int = 64 * 1024,
+    ):
+        """An :py:class:`_AsyncMap` running in a process pool, which returns NumPy arrays through shared memory.
+
+        Args:
+            source (Iterable): The source of the items.
+            callback (Callable): A picklable callable to be applied to the items.
+            buffer (int): The maximum number of items in flight.
+            max_workers (int): Number of worker processes. Defaults to the number of cpus.
+            ordered (bool): If False, results are returned in the order of completion.
+            min_nbytes (int): Arrays smaller than this are pickled rather than put into shared memory.
+        """
+        super().__init__(
+            source, SharedMemoryCallback(callback, min_nbytes), buffer=buffer, max_workers=max_workers, ordered=ordered
+        )
+
+    def __iter__(self) -> Iterator:
+        """Iterate over the results, creating the process pool lazily."""
+        self.queue = queue.Queue(self.buffer)
+        it = self._source_iter()
+        with ProcessPoolExecutor(max_workers=self.max_workers, mp_context=_process_pool_context()) as exec_:
+            try:
+                for item in self._run(it, exec_):
+                    yield from_shared_memory(item)
+            finally:
+                # Free the shared memory of results that are not consumed, e.g. if the stream is closed early
+                for future in self._outstanding():
+                    try:
+                        release_shared_memory(future.result())
+                    except Exception:
+                        pass
+
+
+class _AsyncioMap(_AsyncMap):
+    def __init__(self, source: Iterable, callback: Callable, buffer: int = 1000, ordered: bool = True):
+        """An :py:class:`_AsyncMap` that runs coroutines on a private event loop instead of a thread pool."""
+        super().__init__(source, callback, buffer=buffer, ordered=ordered)
+
+    def __iter__(self) -> Iterator:
+        """Iterate over the results, starting the event loop lazily."""
+        self.queue = queue.Queue(self.buffer)
+        it = self._source_iter()
+        with _EventLoopExecutor() as exec_:
+            yield from self._run(it, exec_)
+
+
+class _EventLoopExecutor(Executor):
+    """An executor that runs coroutine functions on an event loop in a background thread."""
+
+    def __init__(self) -> None:
+        """Create the event loop and start its thread"""
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="iterstream-asyncio", daemon=True)
+        self._thread.start()
+
+    def submit(self, fn: Callable, /, *args, **kwargs) -> Future:
+        """Schedule the coroutine `fn(*args, **kwargs)` on the event loop"""
+        return asyncio.run_coroutine_threadsafe(fn(*args, **kwargs), self.loop)
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False) -> None:
+        """Cancel all remaining tasks, then stop and close the event loop"""
+        if self.loop.is_closed():
+            return
+        asyncio.run_coroutine_threadsafe(self._cancel_tasks(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+    async def _cancel_tasks(self) -> None:
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.loop.shutdown_asyncgens()
+
+
+def _put_until(q: queue.Queue, item: Any, stop: threading.Event) -> bool:
+    """Put `item` into the queue `q` unless `stop` is set before there is room. Returns whether it was put."""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
 class AsyncContent:
     """Represents content that can be fetched asynchronously."""
 
@@ -458,6 +1402,7 @@ class AsyncContent:
             executor (concurrent.futures.Executor): Executor to submit `func` with `item`.
         """
         self.stack = 1
+        self.item = item
         self.future = executor.submit(func, item)
 
     def value(self, timeout: int = None) -> Any:
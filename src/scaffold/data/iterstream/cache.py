@@ -0,0 +1,292 @@
+"""
+Stores for the items of a cached stream, see
+:py:meth:`Composable.cache <scaffold.data.iterstream.base.Composable.cache>`.
+"""
+
+from __future__ import annotations
+
+import functools
+import hashlib
+import inspect
+import json
+import mmap
+import os
+import pickle
+import shutil
+import tempfile
+import uuid
+from array import array
+from types import CodeType
+from typing import Any, Dict, Iterator, List, Optional
+
+import numpy as np
+
+from scaffold.data.iterstream.iterators import get_shard_info
+
+__all__ = ["ItemCache", "DiskCache", "fingerprint"]
+
+
+class ItemCache:
+    """The items of one epoch of a stream, kept in memory or spilled to a local temporary file.
+
+    Spilled items are pickled into the file, which is memory-mapped to replay them, so that only the pages that are
+    read are held in memory. Copies of the cache made with `deepcopy`, e.g. by :py:meth:`loop`, share the items.
+    """
+
+    _runtime_attrs = ("complete",)
+
+    def __init__(self, spill: bool = False) -> None:
+        """Init
+
+        Args:
+            spill (bool): If True, the items are pickled into a local temporary file instead of being kept in memory.
+        """
+        self.spill = spill
+        self.complete = False
+        self._items: Optional[List[Any]] = None
+        self._file = None
+        self._mmap: Optional[mmap.mmap] = None
+        # Offsets of the pickled items in the file, including the end of the last one
+        self._offsets: Optional[array] = None
+
+    def __deepcopy__(self, memo: Dict[int, Any]) -> ItemCache:
+        """Copies share the items"""
+        return self
+
+    def __len__(self) -> int:
+        """Number of cached items"""
+        if self.spill:
+            return len(self._offsets) - 1 if self._offsets is not None else 0
+        return len(self._items) if self._items is not None else 0
+
+    def reset(self) -> None:
+        """Drop all items and start a new epoch"""
+        self.close()
+        self.complete = False
+        if self.spill:
+            self._file = tempfile.TemporaryFile()
+            self._offsets = array("q", [0])
+        else:
+            self._items = []
+
+    def append(self, item: Any) -> None:
+        """Add an item to the epoch"""
+        if self.spill:
+            data = pickle.dumps(item, protocol=pickle.HIGHEST_PROTOCOL)
+            self._file.write(data)
+            self._offsets.append(self._offsets[-1] + len(data))
+        else:
+            self._items.append(item)
+
+    def finish(self) -> None:
+        """Mark the epoch as complete, after which it can be replayed"""
+        if self.spill:
+            self._file.flush()
+            if self._offsets[-1] > 0:
+                self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.complete = True
+
+    def replay(self, start: int = 0) -> Iterator[Any]:
+        """Yield the items of the complete epoch, starting at index `start`"""
+        assert self.complete, "only a complete epoch can be replayed"
+        if not self.spill:
+            items = self._items
+            for i in range(start, len(items)):
+                yield items[i]
+            return
+        offsets = self._offsets
+        for i in range(start, len(offsets) - 1):
+            with memoryview(self._mmap)[offsets[i] : offsets[i + 1]] as data:
+                item = pickle.loads(data)
+            yield item
+
+    def close(self) -> None:
+        """Release the items and the temporary file"""
+        if self._mmap is not None:
+            self._mmap.close()
+        if self._file is not None:
+            self._file.close()
+        self._items, self._file, self._mmap, self._offsets = None, None, None, None
+        self.complete = False
+
+
+class DiskCache:
+    """A persistent store for the items of a stream in a local directory, which has the same interface as
+    :py:class:`ItemCache`.
+
+    The items of each shard of the stream (see :py:func:`get_shard_info
+    <scaffold.data.iterstream.iterators.get_shard_info>`) are stored in the directory `{path}/{key}-{index}-of-{count}`,
+    in chunk files of pickled items, which are memory-mapped when replaying. The directory is written under a
+    temporary name and renamed once the iteration is complete, so concurrent writers of the same shard, e.g. runs of a
+    sweep, never see a partial store, and the first completed one is kept.
+    """
+
+    INDEX_FILE = "index.json"
+
+    def __init__(self, path: str, key: str, chunk_size: int = 1024) -> None:
+        """Init
+
+        Args:
+            path (str): Local directory of the stores.
+            key (str): Key of the stream, e.g. the :py:func:`fingerprint` of its configuration.
+            chunk_size (int): Number of items per chunk file.
+        """
+        self.path = path
+        self.key = key
+        self.chunk_size = chunk_size
+        self._tmp_dir: Optional[str] = None
+        self._chunks: Optional[List[int]] = None
+        self._file = None
+        self._offsets: Optional[array] = None
+
+    def __deepcopy__(self, memo: Dict[int, Any]) -> DiskCache:
+        """Copies share the store"""
+        return self
+
+    @property
+    def directory(self) -> str:
+        """Directory of the store of the shard read by the current process"""
+        index, count = get_shard_info()
+        return os.path.join(self.path, f"{self.key}-{index}-of-{count}")
+
+    @property
+    def complete(self) -> bool:
+        """Whether the store of the current shard has been completely written"""
+        return os.path.exists(os.path.join(self.directory, self.INDEX_FILE))
+
+    def __len__(self) -> int:
+        """Number of stored items of the current shard"""
+        return sum(self._read_index(self.directory)["chunks"]) if self.complete else 0
+
+    def reset(self) -> None:
+        """Start writing a new store for the current shard"""
+        self.close()
+        os.makedirs(self.path, exist_ok=True)
+        self._tmp_dir = f"{self.directory}.tmp-{uuid.uuid4().hex}"
+        os.makedirs(self._tmp_dir)
+        self._chunks = []
+        self._open_chunk()
+
+    def _open_chunk(self) -> None:
+        self._file = open(os.path.join(self._tmp_dir, f"chunk-{len(self._chunks)}.bin"), "wb")
+        self._offsets = array("q", [0])
+
+    def _close_chunk(self) -> None:
+        self._file.close()
+        np.save(os.path.join(self._tmp_dir, f"chunk-{len(self._chunks)}.npy"), np.asarray(self._offsets))
+        self._chunks.append(len(self._offsets) - 1)
+
+    def append(self, item: Any) -> None:
+        """Add an item to the store"""
+        if len(self._offsets) > self.chunk_size:
+            self._close_chunk()
+            self._open_chunk()
+        data = pickle.dumps(item, protocol=pickle.HIGHEST_PROTOCOL)
+        self._file.write(data)
+        self._offsets.append(self._offsets[-1] + len(data))
+
+    def finish(self) -> None:
+        """Complete the store and move it to its final directory, unless another writer has completed it first"""
+        self._close_chunk()
+        with open(os.path.join(self._tmp_dir, self.INDEX_FILE), "w") as f:
+            json.dump({"chunks": self._chunks}, f)
+        tmp_dir, self._tmp_dir, self._file = self._tmp_dir, None, None
+        try:
+            os.rename(tmp_dir, self.directory)
+        except OSError:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def _read_index(self, directory: str) -> Dict[str, Any]:
+        with open(os.path.join(directory, self.INDEX_FILE)) as f:
+            return json.load(f)
+
+    def replay(self, start: int = 0) -> Iterator[Any]:
+        """Yield the stored items of the current shard, starting at index `start`"""
+        directory = self.directory
+        for i, n_items in enumerate(self._read_index(directory)["chunks"]):
+            if start >= n_items:
+                start -= n_items
+                continue
+            offsets = np.load(os.path.join(directory, f"chunk-{i}.npy"))
+            if offsets[-1] == 0:
+                # Empty chunk, which cannot be memory-mapped
+                continue
+            with open(os.path.join(directory, f"chunk-{i}.bin"), "rb") as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    for j in range(start, n_items):
+                        with memoryview(mm)[offsets[j] : offsets[j + 1]] as data:
+                            item = pickle.loads(data)
+                        yield item
+            start = 0
+
+    def close(self) -> None:
+        """Remove the store that is being written, if any"""
+        if self._file is not None:
+            self._file.close()
+        if self._tmp_dir is not None:
+            shutil.rmtree(self._tmp_dir, ignore_errors=True)
+        self._tmp_dir, self._file = None, None
+
+
+def fingerprint(obj: Any) -> str:
+    """Return a hash of the configuration of `obj`, e.g. a pipeline of :py:class:`Composable` stages.
+
+    Objects defined in scaffold are described by their type and public attributes, functions by their code, constants,
+    defaults and closures, and containers by their pickled content. Other objects are only described by their type and
+    their repr, unless it is the default one. So a changed configuration of those, or of data that functions read from
+    elsewhere, may not be detected.
+    """
+    h = hashlib.sha256()
+    _update_fingerprint(h, obj, {})
+    return h.hexdigest()[:32]
+
+
+def _update_fingerprint(h: Any, obj: Any, seen: Dict[int, Any]) -> None:
+    if obj is None or isinstance(obj, (bool, int, float, complex, str, bytes)):
+        h.update(repr(obj).encode())
+        return
+    if id(obj) in seen:
+        h.update(b"<seen>")
+        return
+    # The objects are kept alive, so that their ids are not reused by temporary objects
+    seen[id(obj)] = obj
+    h.update(f"<{type(obj).__module__}.{type(obj).__qualname__}>".encode())
+    if isinstance(obj, (set, frozenset)):
+        # The iteration order of sets depends on the hash seed
+        for item in sorted(obj, key=repr):
+            _update_fingerprint(h, item, seen)
+    elif isinstance(obj, (list, tuple, dict, np.ndarray)):
+        try:
+            h.update(pickle.dumps(obj, protocol=4))
+        except Exception:
+            for item in obj.items() if isinstance(obj, dict) else obj:
+                _update_fingerprint(h, item, seen)
+    elif isinstance(obj, functools.partial):
+        for item in (obj.func, obj.args, obj.keywords):
+            _update_fingerprint(h, item, seen)
+    elif isinstance(obj, CodeType):
+        h.update(obj.co_code)
+        for item in (obj.co_consts, obj.co_names):
+            _update_fingerprint(h, item, seen)
+    elif inspect.isfunction(obj):
+        h.update(f"{obj.__module__}.{obj.__qualname__}".encode())
+        closure = tuple(cell.cell_contents for cell in obj.__closure__ or ())
+        for item in (obj.__code__, obj.__defaults__, obj.__kwdefaults__, closure):
+            _update_fingerprint(h, item, seen)
+    elif inspect.ismethod(obj):
+        _update_fingerprint(h, obj.__func__, seen)
+        _update_fingerprint(h, obj.__self__, seen)
+    elif inspect.isbuiltin(obj) or inspect.isclass(obj):
+        h.update(f"{getattr(obj, '__module__', None)}.{obj.__qualname__}".encode())
+    elif type(obj).__module__.startswith("scaffold.") and hasattr(obj, "__dict__"):
+        # Only the configuration counts, not the state of an iteration, see `Composable._runtime_attrs`
+        runtime_attrs = getattr(obj, "_runtime_attrs", ())
+        for name, value in sorted(vars(obj).items()):
+            if not name.startswith("_") and name not in runtime_attrs:
+                h.update(name.encode())
+                _update_fingerprint(h, value, seen)
+    else:
+        # E.g. ranges and paths, but not the default repr that contains the address of the object
+        text = repr(obj)
+        if " at 0x" not in text:
+            h.update(text.encode())
@@ -1,72 +1,168 @@
 import os
 import pickle
 import random
+import sys
 import time
-from itertools import islice
-from typing import Any, Callable, Iterable, Iterator, List, Optional
+from functools import singledispatch
+from itertools import chain, islice
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
 import numpy as np
 
 from scaffold.data.constants import SeedType
 
 
-def _pick(buf: List, rng: random.Random) -> Any:
-    """Pick a random element from a list.
+class ShuffleBuffer:
+    """The shuffle buffer behind :py:func:`shuffle_`.
 
-    Args:
-        buf (List): List of items.
-        rng (random.Random): Random number generator to use.
-
-    Returns:
-        Any: One random item from `buf`.
+    Calling the instance on an iterable shuffles it. The buffered elements, the position in the stream of random
+    numbers and the random generator state can be saved with :py:meth:`state_dict` and restored with
+    :py:meth:`load_state_dict`, in which case the next call continues exactly where the saved one stopped. Otherwise,
+    every call starts with an empty buffer, so that an interrupted iteration does not leak items into the next one.
     """
-    k = rng.randint(0, len(buf) - 1)
-    sample = buf[k]
-    buf[k] = buf[-1]
-    buf.pop()
-    return sample
+
+    _runtime_attrs = ("gen", "buf", "n", "draws", "d", "yield_next", "draining")
+
+    def __init__(
+        self,
+        bufsize: int = 1000,
+        initial: int = 100,
+        rng: Optional[Union[random.Random, np.random.Generator]] = None,
+        seed: SeedType = None,
+        block_size: int = 1024,
+    ) -> None:
+        """Initialize ShuffleBuffer. See :py:func:`shuffle_` for a description of the arguments."""
+        self.bufsize = bufsize
+        self.initial = max(min(initial, bufsize), 1)
+        self.block_size = block_size
+        self.rng = rng
+        self.seed = seed
+        # The generator is created lazily, so that forked processes do not share the state of an unseeded generator
+        self.gen = None
+        self.buf = None
+        self._resumed = False
+
+    def _reset(self) -> None:
+        self.buf = [None] * self.bufsize
+        self.n = 0
+        self.draws = self.gen.random(self.block_size)
+        self.d = 0
+        self.yield_next = True
+        self.draining = False
+
+    def __call__(self, iterable: Iterable) -> Iterator:
+        """Shuffle the items of `iterable`, starting with the buffered items of a restored state."""
+        if self.gen is None:
+            self.gen = get_random_generator(self.rng, self.seed)
+        if not self._resumed:
+            self._reset()
+        self._resumed = False
+        gen, bufsize, initial, block_size = self.gen, self.bufsize, self.initial, self.block_size
+        buf, n, draws, d, yield_next = self.buf, self.n, self.draws, self.d, self.yield_next
+
+        if not self.draining:
+            for sample in iterable:
+                if d == block_size:
+                    draws = gen.random(block_size)
+                    d = 0
+                if n == bufsize:
+                    # Steady state: replace a random element in place and yield it
+                    k = int(draws[d] * n)
+                    d += 1
+                    buf[k], sample = sample, buf[k]
+                    self.draws, self.d = draws, d
+                    yield sample
+                    continue
+
+                buf[n] = sample
+                n += 1
+                if n < initial:
+                    self.n = n
+                    continue
+                yield_next = not yield_next
+                if not yield_next:
+                    k = int(draws[d] * n)
+                    d += 1
+                    n -= 1
+                    sample = buf[k]
+                    buf[k] = buf[n]
+                    buf[n] = None
+                    self.n, self.draws, self.d, self.yield_next = n, draws, d, yield_next
+                    yield sample
+                else:
+                    self.n, self.yield_next = n, yield_next
+
+            buf[:n] = [buf[k] for k in gen.permutation(n)]
+            self.draining = True
+
+        while self.n > 0:
+            self.n -= 1
+            sample, buf[self.n] = buf[self.n], None
+            yield sample
+
+    def state_dict(self) -> Dict[str, Any]:
+        """Return the buffered items and the random state."""
+        if self.buf is None:
+            return {}
+        return {
+            "buf": self.buf[: self.n],
+            "draws": self.draws.copy(),
+            "d": self.d,
+            "yield_next": self.yield_next,
+            "draining": self.draining,
+            "rng": self.gen.bit_generator.state,
+        }
+
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        """Restore a state obtained from :py:meth:`state_dict`."""
+        if not state:
+            return
+        if self.gen is None:
+            self.gen = get_random_generator(self.rng, self.seed)
+        self.gen.bit_generator.state = state["rng"]
+        self.n = len(state["buf"])
+        self.buf = list(state["buf"]) + [None] * (self.bufsize - self.n)
+        self.draws = state["draws"].copy()
+        self.d = state["d"]
+        self.yield_next = state["yield_next"]
+        self.draining = state["draining"]
+        self._resumed = True
 
 
 def shuffle_(
     iterable: Iterable,
     bufsize: int = 1000,
     initial: int = 100,
-    rng: Optional[random.Random] = None,
+    rng: Optional[Union[random.Random, np.random.Generator]] = None,
     seed: SeedType = None,
+    block_size: int = 1024,
 ) -> Iterator:
     """Shuffle the data in the stream.
 
-    Uses a buffer of size `bufsize`. Shuffling at startup is less random; this is traded off against yielding samples
-    quickly.
+    Uses a preallocated buffer of size `bufsize`. Shuffling at startup is less random; this is traded off against
+    yielding samples quickly. Once at least `initial` elements are buffered, one element is yielded for every two
+    elements read until the buffer is full. From then on, every element read replaces a randomly chosen element of the
+    buffer, which is yielded. The remaining elements are yielded in a random order once `iterable` is exhausted.
+
+    Random indices are obtained from uniform numbers drawn in blocks of `block_size` from a
+    :py:class:`numpy.random.Generator`, so that the output only depends on the seed and the input stream.
 
     Args:
         iterable (Iterable): Iterable to shuffle.
         bufsize (int, optional): Buffer size for shuffling. Defaults to 1000.
         initial (int, optional): Minimum number of elements in the buffer before yielding the first element. Must be
             less than or equal to `bufsize`, otherwise will be set to `bufsize`. Defaults to 100.
-        rng (random.Random, optional): Either `random` module or a :py:class:`random.Random` instance. If None,
-            a `random.Random()` is used.
+        rng (Union[random.Random, numpy.random.Generator], optional): A :py:class:`numpy.random.Generator`, which is
+            used as is, or either `random` module or a :py:class:`random.Random` instance, which is used to seed a
+            generator. If None, a `random.Random()` is used.
         seed (Union[int, float, str, bytes, bytearray, None]): A data input that can be used for `random.seed()`.
+            Ignored if `rng` is a :py:class:`numpy.random.Generator`.
+        block_size (int, optional): Number of random numbers drawn at once. Defaults to 1024.
 
     Yields:
         Any: Shuffled items of `iterable`.
     """
-    rng = get_random_range(rng, seed)
-
-    iterator = iter(iterable)
-    initial = min(initial, bufsize)
-    buf = []
-    for sample in iterator:
-        buf.append(sample)
-        if len(buf) < bufsize:
-            try:
-                buf.append(next(iterator))
-            except StopIteration:
-                pass
-        if len(buf) >= initial:
-            yield _pick(buf, rng)
-    while len(buf) > 0:
-        yield _pick(buf, rng)
+    yield from ShuffleBuffer(bufsize, initial=initial, rng=rng, seed=seed, block_size=block_size)(iterable)
 
 
 def take_(iterable: Iterable, n: int) -> Iterator:
@@ -83,6 +179,41 @@ def take_(iterable: Iterable, n: int) -> Iterator:
     yield from islice(iterable, 0, n, 1)
 
 
+class Take:
+    """The stateful counterpart of :py:func:`take_` behind :py:meth:`Composable.take`.
+
+    Calling the instance on an iterable yields its first `n` items. The number of items yielded so far can be saved
+    with :py:meth:`state_dict` and restored with :py:meth:`load_state_dict`, in which case the next call only yields the
+    remaining items. Otherwise, every call starts counting from zero.
+    """
+
+    _runtime_attrs = ("count",)
+
+    def __init__(self, n: int) -> None:
+        """Init"""
+        self.n = n
+        self.count = 0
+        self._resumed = False
+
+    def __call__(self, iterable: Iterable) -> Iterator:
+        """Yield the first `n` items of `iterable`, less the ones yielded before a restored state"""
+        if not self._resumed:
+            self.count = 0
+        self._resumed = False
+        for item in islice(iterable, 0, max(self.n - self.count, 0), 1):
+            self.count += 1
+            yield item
+
+    def state_dict(self) -> Dict[str, Any]:
+        """Return the number of items yielded so far"""
+        return {"count": self.count}
+
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        """Restore a state obtained from :py:meth:`state_dict`"""
+        self.count = state["count"]
+        self._resumed = True
+
+
 def batched_(
     iterable: Iterable,
     batchsize: int = 20,
@@ -111,6 +242,139 @@ def batched_(
         yield batch
 
 
+def columnar_batched_(
+    iterable: Iterable,
+    batchsize: int = 20,
+    drop_last_if_not_full: bool = True,
+    num_buffers: Optional[int] = None,
+) -> Iterator[Any]:
+    """Yield batches of the given size, collated column by column into preallocated arrays.
+
+    The structure of the batches is inferred from the first sample. Dicts and tuples are traversed recursively.
+    NumPy arrays, NumPy scalars and Python numbers become a :py:class:`numpy.ndarray` of shape `(batchsize, ...)`, torch
+    tensors become a tensor of shape `(batchsize, ...)` on the same device, and any other value becomes a list. Each
+    sample is written directly into its slot, so there is no intermediate list of samples and no stacking copy. All
+    samples must have the same structure, shapes and dtypes as the first one.
+
+    Args:
+        iterable (Iterable): Iterable to be batched.
+        batchsize (int, optional): Target batch size. Defaults to 20.
+        drop_last_if_not_full (bool, optional): If the length of the last batch is less than `batchsize`, drop it.
+            Defaults to True. Otherwise, the last batch consists of views on the first rows of the buffers.
+        num_buffers (int, optional): If provided, a ring of `num_buffers` batches is allocated once and reused, which
+            avoids allocations per batch. A yielded batch is then overwritten `num_buffers` batches later, so it must
+            be consumed or copied by then. If None, new arrays are allocated for every batch. Defaults to None.
+
+    Yields:
+        Batches with the structure of the samples.
+    """
+    it = iter(iterable)
+    sentinel = object()
+    first = next(it, sentinel)
+    if first is sentinel:
+        return
+    it = chain([first], it)
+    ring = [_alloc_batch(first, batchsize) for _ in range(num_buffers)] if num_buffers else None
+
+    n_batches = 0
+    while True:
+        batch = ring[n_batches % num_buffers] if ring else _alloc_batch(first, batchsize)
+        n = 0
+        for sample in islice(it, batchsize):
+            _write_sample(batch, sample, n)
+            n += 1
+        if drop_last_if_not_full and n < batchsize or n == 0:
+            return
+        n_batches += 1
+        yield batch if n == batchsize else _slice_batch(batch, n)
+
+
+def _is_tensor(item: Any) -> bool:
+    """Check whether `item` is a torch tensor without importing torch."""
+    return "torch" in sys.modules and isinstance(item, sys.modules["torch"].Tensor)
+
+
+def _alloc_batch(template: Any, batchsize: int) -> Any:
+    if isinstance(template, dict):
+        return {k: _alloc_batch(v, batchsize) for k, v in template.items()}
+    if isinstance(template, tuple) and not hasattr(template, "_fields"):
+        return tuple(_alloc_batch(v, batchsize) for v in template)
+    if _is_tensor(template):
+        return template.new_empty((batchsize, *template.shape))
+    if isinstance(template, (np.ndarray, np.generic, int, float, complex)):
+        arr = np.asarray(template)
+        if not arr.dtype.hasobject:
+            return np.empty((batchsize, *arr.shape), dtype=arr.dtype)
+    return [None] * batchsize
+
+
+def _write_sample(batch: Any, sample: Any, idx: int) -> None:
+    if isinstance(batch, dict):
+        for k, v in batch.items():
+            _write_sample(v, sample[k], idx)
+    elif isinstance(batch, tuple):
+        for b, s in zip(batch, sample):
+            _write_sample(b, s, idx)
+    else:
+        batch[idx] = sample
+
+
+def _slice_batch(batch: Any, n: int) -> Any:
+    if isinstance(batch, dict):
+        return {k: _slice_batch(v, n) for k, v in batch.items()}
+    if isinstance(batch, tuple):
+        return tuple(_slice_batch(v, n) for v in batch)
+    return batch[:n]
+
+
+def unbatched_(iterable: Iterable) -> Iterator[Any]:
+    """Inverse of :py:func:`columnar_batched_`, yield the samples of each batch.
+
+    Dicts and tuples are traversed recursively, and the samples are taken from the rows of the arrays, tensors and
+    lists they contain. The samples of arrays and tensors are views on the rows of the batch.
+    """
+    for batch in iterable:
+        if isinstance(batch, (dict, tuple)):
+            for i in range(_batch_len(batch)):
+                yield _index_batch(batch, i)
+        else:
+            yield from batch
+
+
+def _batch_len(batch: Any) -> int:
+    if isinstance(batch, dict):
+        return _batch_len(next(iter(batch.values())))
+    if isinstance(batch, tuple) and not hasattr(batch, "_fields"):
+        return _batch_len(batch[0])
+    return len(batch)
+
+
+def _index_batch(batch: Any, idx: int) -> Any:
+    if isinstance(batch, dict):
+        return {k: _index_batch(v, idx) for k, v in batch.items()}
+    if isinstance(batch, tuple) and not hasattr(batch, "_fields"):
+        return tuple(_index_batch(v, idx) for v in batch)
+    return batch[idx]
+
+
+class SeededCallback:
+    """Picklable wrapper that calls `callback(item, rng=rng)` for items `(index, item)` as yielded by `zip_index`.
+
+    `rng` is a :py:class:`numpy.random.Generator` seeded with `seed` and `index`, so the random numbers drawn for an
+    item only depend on its position in the stream, and not on which worker processes it or when.
+    """
+
+    def __init__(self, callback: Callable, seed: int) -> None:
+        """Init"""
+        self.callback = callback
+        self.seed = seed
+
+    def __call__(self, indexed_item: Tuple[int, Any]) -> Any:
+        """Apply the callback to the item with its random generator"""
+        index, item = indexed_item
+        return self.callback(item, rng=np.random.default_rng([self.seed, index]))
+
+
 def map_(iterable: Iterable, callback: Callable) -> Iterator:
     """Apply the `callback` to each item in the `iterable` and yield the item."""
     for sample in iterable:
@@ -124,6 +388,53 @@ def filter_(iterable: Iterable, predicate: Callable) -> Iterator:
             yield sample
 
 
+def _reraise_stop_iteration(callback: Callable) -> Callable:
+    """Wrap `callback`, so that a StopIteration it raises becomes a RuntimeError like in the generator of an unfused
+    stage, instead of silently ending the builtin iterator that calls it.
+    """
+
+    def call(item: Any) -> Any:
+        try:
+            return callback(item)
+        except StopIteration as e:
+            raise RuntimeError("generator raised StopIteration") from e
+
+    return call
+
+
+# Builtin equivalents of the iterators that can be fused, which run without a generator per stage
+_FUSIBLE = (
+    (map_, lambda iterable, callback: map(_reraise_stop_iteration(callback), iterable)),
+    (filter_, lambda iterable, predicate: filter(_reraise_stop_iteration(predicate), iterable)),
+    (take_, lambda iterable, n: islice(iterable, 0, n, 1)),
+)
+
+
+def is_fusible(f: Callable) -> bool:
+    """Whether the iterator function `f` can be fused with :py:func:`fused_`"""
+    return isinstance(f, Take) or any(f is g for g, _ in _FUSIBLE)
+
+
+def fused_(iterable: Iterable, ops: List[Tuple[Callable, tuple, Dict[str, Any]]]) -> Iterator:
+    """Apply a chain of :py:func:`map_`, :py:func:`filter_`, :py:func:`take_` and :py:class:`Take` in a single
+    generator.
+
+    Args:
+        iterable (Iterable): Iterable to apply the chain to.
+        ops (List[Tuple[Callable, tuple, Dict[str, Any]]]): The iterator functions with their args and kwargs, in the
+            order in which they are applied.
+    """
+    it = iter(iterable)
+    for f, args, kw in ops:
+        if isinstance(f, Take):
+            # Counts the yielded items, so that the take stage keeps its state
+            it = f(it)
+            continue
+        builtin = next(b for g, b in _FUSIBLE if g is f)
+        it = builtin(it, *args, **kw)
+    yield from it
+
+
 def flatten_(iterables: Iterable[Iterable]) -> Iterator:
     """Iterate over iterables in the stream and yield their items."""
     for item in iterables:
@@ -155,11 +466,98 @@ def get_random_range(rng: Optional[random.Random] = None, seed: SeedType = None)
     return rng
 
 
+def get_shard_info() -> Tuple[int, int]:
+    """
+    Returns the index of the shard to be read by the current process and the total number of shards.
+
+    The shards are derived from the rank and world size of an initialized `torch.distributed` process group and from
+    the id and number of workers of a `torch.utils.data.DataLoader`, if called inside a worker. If torch is not
+    installed, there is a single shard. Must be called lazily, i.e. when iterating, to pick up the DataLoader worker.
+    """
+    try:
+        import torch.distributed as dist
+        from torch.utils.data import get_worker_info
+
+        from scaffold.torch.distributed.ddp import is_distributed
+    except ImportError:
+        return 0, 1
+
+    rank, world_size = (dist.get_rank(), dist.get_world_size()) if is_distributed() else (0, 1)
+    worker_info = get_worker_info()
+    worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+    return rank * num_workers + worker_id, world_size * num_workers
+
+
+def get_random_generator(
+    rng: Optional[Union[random.Random, np.random.Generator]] = None, seed: SeedType = None
+) -> np.random.Generator:
+    """
+    Returns a :py:class:`numpy.random.Generator`, calculated based on the input `rng` and `seed`.
+
+    Args:
+        rng (Union[random.Random, numpy.random.Generator], optional): If a :py:class:`numpy.random.Generator` is
+            passed, it is returned as is. Otherwise, the :py:class:`random.Random` obtained from
+            :py:func:`get_random_range` with `rng` and `seed` is used to seed a new generator.
+        seed (Union[int, float, str, bytes, bytearray, None]): An int or other acceptable types that works for
+            random.seed(). If None, a unique identifier will be used to seed.
+    """
+    if isinstance(rng, np.random.Generator):
+        return rng
+    return np.random.default_rng(get_random_range(rng, seed).getrandbits(128))
+
+
+@singledispatch
 def getsize(item: Any) -> int:
-    """Return estimated size (in terms of bytes) of a python object. Currently use numpy method to calculate size.
-    Otherwise, the size is estimated through its pickled size. This is considered a better performant option than e.g.
-    `zarr.storage.getsize()`.
+    """Return the estimated size (in terms of bytes) of a python object, without serializing it.
+
+    Arrays and tensors are measured by their number of bytes, bytes and strings by their length, PIL images by their
+    pixel data, and dicts, lists, tuples and sets recursively by the sum of the sizes of their elements. Other objects
+    are estimated through their pickled size, which is slow. Estimators for custom types can be registered with
+    `getsize.register`, e.g.:
+
+    .. code-block:: python
+
+        @getsize.register
+        def _(item: MyType) -> int:
+            return item.buffer.nbytes
     """
-    if isinstance(item, np.ndarray):
-        return item.nbytes
+    if _is_tensor(item):
+        return item.element_size() * item.nelement()
+    pil_image = sys.modules.get("PIL.Image")
+    if pil_image is not None and isinstance(item, pil_image.Image):
+        return item.width * item.height * len(item.getbands())
     return len(pickle.dumps(item))
+
+
+@getsize.register(np.ndarray)
+@getsize.register(np.generic)
+@getsize.register(memoryview)
+def _(item: Union[np.ndarray, np.generic, memoryview]) -> int:
+    return item.nbytes
+
+
+@getsize.register(bytes)
+@getsize.register(bytearray)
+@getsize.register(str)
+def _(item: Union[bytes, bytearray, str]) -> int:
+    return len(item)
+
+
+@getsize.register(int)
+@getsize.register(float)
+@getsize.register(type(None))
+def _(item: Union[int, float, None]) -> int:
+    return 8
+
+
+@getsize.register(dict)
+def _(item: dict) -> int:
+    return sum(getsize(k) + getsize(v) for k, v in item.items())
+
+
+@getsize.register(list)
+@getsize.register(tuple)
+@getsize.register(set)
+@getsize.register(frozenset)
+def _(item: Union[list, tuple, set, frozenset]) -> int:
+    return sum(getsize(v) for v in item)
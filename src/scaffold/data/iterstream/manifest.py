@@ -0,0 +1,91 @@
+"""
+A manifest is a persistent index of the files discovered under a url, which allows streaming the paths without listing
+the url again.
+
+The manifest is a text file with a JSON header line, followed by one line per file with the tab-separated path, size
+and etag (or modification time), sorted by path. If the url of the manifest ends with a compression suffix such as
+`.gz`, it is compressed. Uncompressed local manifests are memory-mapped when read.
+"""
+
+from __future__ import annotations
+
+import json
+import mmap
+import uuid
+from typing import Any, Dict, Iterable, Iterator, NamedTuple
+
+from fsspec.implementations.local import LocalFileSystem
+from fsspec.utils import infer_compression
+
+from scaffold.data.fs import get_fs_from_url
+
+__all__ = ["ManifestRecord", "entry_to_record", "read_manifest_header", "iter_manifest", "write_manifest"]
+
+MANIFEST_VERSION = 1
+
+
+class ManifestRecord(NamedTuple):
+    """A file in a manifest"""
+
+    path: str
+    size: int
+    etag: str
+
+
+def entry_to_record(entry: Dict[str, Any]) -> ManifestRecord:
+    """Convert an entry of `fs.ls(path, detail=True)` to a record. The etag falls back to the checksum or the
+    modification time for filesystems that do not report one.
+    """
+    etag = entry.get("etag") or entry.get("ETag") or entry.get("md5Hash") or entry.get("mtime") or ""
+    return ManifestRecord(entry["name"].rstrip("/"), int(entry.get("size") or 0), str(etag).strip('"'))
+
+
+def write_manifest(url: str, header: Dict[str, Any], records: Iterable[ManifestRecord]) -> None:
+    """Sort `records` by path and write them with `header` to the manifest at `url`.
+
+    The manifest is written to a temporary file first, which is then moved to `url`, so that concurrent readers never
+    see a partial manifest.
+    """
+    fs = get_fs_from_url(url)
+    # Keep the suffix of `url`, so that the compression is inferred correctly
+    name = url.rsplit("/", 1)[-1]
+    suffix = f".{name.rsplit('.', 1)[1]}" if "." in name else ""
+    tmp_url = f"{url}.tmp-{uuid.uuid4().hex}{suffix}"
+    with fs.open(tmp_url, "wt", compression="infer") as f:
+        f.write(json.dumps({**header, "version": MANIFEST_VERSION}) + "\n")
+        for record in sorted(records):
+            f.write(f"{record.path}\t{record.size}\t{record.etag}\n")
+    fs.mv(tmp_url, url)
+
+
+def _iter_lines(url: str) -> Iterator[str]:
+    fs = get_fs_from_url(url)
+    if isinstance(fs, LocalFileSystem) and infer_compression(url) is None:
+        with open(fs._strip_protocol(url), "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for line in iter(mm.readline, b""):
+                yield line.decode().rstrip("\n")
+    else:
+        with fs.open(url, "rt", compression="infer") as f:
+            for line in f:
+                yield line.rstrip("\n")
+
+
+def read_manifest_header(url: str) -> Dict[str, Any]:
+    """Read the header of the manifest at `url`"""
+    lines = _iter_lines(url)
+    try:
+        header = json.loads(next(lines))
+    finally:
+        lines.close()
+    if header.get("version") != MANIFEST_VERSION:
+        raise ValueError(f"Manifest {url} has version {header.get('version')}, expected {MANIFEST_VERSION}.")
+    return header
+
+
+def iter_manifest(url: str) -> Iterator[ManifestRecord]:
+    """Stream the records of the manifest at `url`, sorted by path"""
+    lines = _iter_lines(url)
+    next(lines)
+    for line in lines:
+        path, size, etag = line.split("\t")
+        yield ManifestRecord(path, int(size), etag)
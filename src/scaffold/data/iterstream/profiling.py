@@ -0,0 +1,176 @@
+"""
+Opt-in profiling of the stages of a :py:class:`Composable` pipeline, see
+:py:meth:`Composable.profile <scaffold.data.iterstream.base.Composable.profile>`.
+
+Every stage of the pipeline is wrapped, and the time spent in `next()` on the iterator of the stage is measured. The
+time a stage spends waiting on its source is the time measured for the source, and the remainder is spent inside the
+stage itself. Stages whose source runs in a background thread, such as :py:meth:`prefetch`, only wait for the items
+that are not ready yet.
+"""
+
+from __future__ import annotations
+
+import time
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List, Optional
+
+from scaffold.data.iterstream.base import Composable, _Iterable
+from scaffold.data.iterstream.iterators import getsize
+
+if TYPE_CHECKING:
+    from scaffold.system_monitor import AbstractBackendSender, StatsDict
+
+__all__ = ["StageStats", "ProfiledPipeline"]
+
+
+class StageStats:
+    """Counters of a single stage of a profiled pipeline"""
+
+    def __init__(self, name: str) -> None:
+        """Init"""
+        self.name = name
+        self.items = 0
+        self.nbytes = 0
+        # Time spent in `next()` on the iterator of the stage, including the time spent waiting on the source
+        self.total_time = 0.0
+        self.first = None
+        self.last = None
+        self.occupancy_sum = 0
+        self.occupancy_samples = 0
+        self.source = None
+
+    def __deepcopy__(self, memo: Dict[int, Any]) -> StageStats:
+        """Counters are shared by copies of the pipeline, e.g. by the epochs of :py:meth:`loop`"""
+        return self
+
+    @property
+    def wait_time(self) -> float:
+        """Time spent waiting on the source of the stage"""
+        return self.source.total_time if self.source is not None else 0.0
+
+    @property
+    def own_time(self) -> float:
+        """Time spent inside the stage"""
+        return max(self.total_time - self.wait_time, 0.0)
+
+    def stats(self) -> Dict[str, float]:
+        """Return the throughput and timings of the stage"""
+        elapsed = self.last - self.first if self.items > 0 else 0.0
+        stats = {
+            "items": self.items,
+            "items_per_sec": self.items / elapsed if elapsed > 0 else 0.0,
+            "own_time": self.own_time,
+            "wait_time": self.wait_time,
+        }
+        if self.nbytes > 0:
+            stats["bytes_per_sec"] = self.nbytes / elapsed if elapsed > 0 else 0.0
+        if self.occupancy_samples > 0:
+            stats["queue_occupancy"] = self.occupancy_sum / self.occupancy_samples
+        return stats
+
+
+def _stage_name(stage: Composable) -> str:
+    if isinstance(stage, _Iterable):
+        return getattr(stage.f, "__name__", type(stage.f).__name__).strip("_")
+    return type(stage).__name__.strip("_")
+
+
+class _ProfiledStage(Composable):
+    """Transparent wrapper of a stage that updates its :py:class:`StageStats`"""
+
+    _runtime_attrs = ("stage_stats",)
+
+    def __init__(self, source: Composable, stats: StageStats, measure_bytes: bool) -> None:
+        """Init"""
+        super().__init__(source)
+        self.stage_stats = stats
+        self.measure_bytes = measure_bytes
+
+    def __iter__(self) -> Iterator:
+        """Yield the items of the stage, measuring the time spent in `next()`"""
+        stats, stage = self.stage_stats, self.source
+        it = iter(stage)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(it)
+            except StopIteration:
+                stats.total_time += time.perf_counter() - start
+                return
+            end = time.perf_counter()
+            stats.total_time += end - start
+            if stats.first is None:
+                stats.first = start
+            stats.last = end
+            stats.items += 1
+            if self.measure_bytes:
+                stats.nbytes += getsize(item)
+            occupancy = stage._occupancy()
+            if occupancy is not None:
+                stats.occupancy_sum += occupancy
+                stats.occupancy_samples += 1
+            yield item
+
+    def state_dict(self) -> Dict[str, Any]:
+        """Return the state of the wrapped stage, so that profiling does not change the state"""
+        return self.source.state_dict()
+
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        """Restore the state of the wrapped stage"""
+        self.source.load_state_dict(state)
+
+
+class ProfiledPipeline(_ProfiledStage):
+    """A pipeline whose stages are profiled. It is returned by :py:meth:`Composable.profile` and yields the same items
+    as the pipeline.
+    """
+
+    _runtime_attrs = ("stage_stats", "stages")
+
+    def __init__(self, source: Composable, measure_bytes: bool = False) -> None:
+        """Wrap all stages of the pipeline `source`, which is modified in place.
+
+        Args:
+            source (Composable): The last stage of the pipeline.
+            measure_bytes (bool): If True, the size of every item is estimated with
+                :py:func:`getsize <scaffold.data.iterstream.iterators.getsize>` to report the bytes per second.
+        """
+        # The stages from the first to the last one, without the wrappers of a previous profiling
+        stages: List[Composable] = [source]
+        while isinstance(stages[-1].source, Composable):
+            if isinstance(stages[-1].source, _ProfiledStage):
+                stages[-1].source = stages[-1].source.source
+            stages.append(stages[-1].source)
+        stages.reverse()
+        self.stages = [StageStats(f"{i}.{_stage_name(stage)}") for i, stage in enumerate(stages)]
+        for i in range(1, len(stages)):
+            self.stages[i].source = self.stages[i - 1]
+            stages[i].source = _ProfiledStage(stages[i - 1], self.stages[i - 1], measure_bytes)
+        super().__init__(source, self.stages[-1], measure_bytes)
+
+    def stats(self, prefix: str = "iterstream.") -> StatsDict:
+        """Return the stats of all stages, with keys of the form `{prefix}{index}.{stage}.{stat}`"""
+        return {
+            f"{prefix}{stage.name}.{key}": float(value) for stage in self.stages for key, value in stage.stats().items()
+        }
+
+    def report(self) -> str:
+        """Return a table with the stats of all stages, from the source to the last stage"""
+        columns = ["items", "items_per_sec", "own_time", "wait_time", "bytes_per_sec", "queue_occupancy"]
+        rows = [["stage"] + columns]
+        for stage in self.stages:
+            stats = stage.stats()
+            rows.append([stage.name] + [_format(stats.get(c)) for c in columns])
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        return "\n".join("  ".join(cell.rjust(w) for cell, w in zip(row, widths)) for row in rows)
+
+    def publish(self, backend_sender: AbstractBackendSender, prefix: str = "iterstream.", **kwargs) -> None:
+        """Send the stats to a backend sender, like the ones used by :py:class:`SystemMonitor`"""
+        backend_sender.publish(self.stats(prefix), **kwargs)
+
+
+def _format(value: Optional[float]) -> str:
+    if value is None:
+        return "-"
+    if isinstance(value, int):
+        return str(value)
+    return f"{value:.3g}"
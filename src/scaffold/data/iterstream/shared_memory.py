@@ -0,0 +1,116 @@
+"""
+Helpers to move NumPy arrays between processes through shared memory instead of pickling their content.
+
+A worker process copies each large array of a result into a fresh :py:class:`SharedMemory` block and returns a small
+picklable handle instead. The consuming process maps the block and wraps it in an array without copying. The block is
+unlinked as soon as it is mapped, so the memory is freed by the OS once the last array referencing it is collected.
+"""
+
+from __future__ import annotations
+
+import weakref
+from dataclasses import dataclass
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Callable, Tuple
+
+import numpy as np
+
+__all__ = ["SharedArray", "SharedMemoryCallback", "to_shared_memory", "from_shared_memory", "release_shared_memory"]
+
+DEFAULT_MIN_NBYTES = 64 * 1024
+
+
+@dataclass(frozen=True)
+class SharedArray:
+    """Picklable handle to a NumPy array stored in a named shared memory block."""
+
+    name: str
+    shape: Tuple[int, ...]
+    dtype: str
+
+
+def _create_block(size: int) -> SharedMemory:
+    """Create a shared memory block whose lifetime is not tied to the creating process."""
+    shm = SharedMemory(create=True, size=size)
+    # The consumer unlinks the block. Without unregistering, the resource tracker of the worker would unlink it
+    # (and warn about a leak) as soon as the worker process shuts down.
+    resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+
+def to_shared_memory(obj: Any, min_nbytes: int = DEFAULT_MIN_NBYTES) -> Any:
+    """Replace NumPy arrays in `obj` by :py:class:`SharedArray` handles.
+
+    Dicts, lists and tuples are traversed recursively. Arrays smaller than `min_nbytes` and arrays of object dtype are
+    left untouched, since pickling them is cheaper or the only option.
+    """
+    if isinstance(obj, np.ndarray):
+        if obj.dtype.hasobject or obj.nbytes < max(min_nbytes, 1):
+            return obj
+        shm = _create_block(obj.nbytes)
+        try:
+            np.ndarray(obj.shape, dtype=obj.dtype, buffer=shm.buf)[...] = obj
+            return SharedArray(name=shm.name, shape=obj.shape, dtype=obj.dtype.str)
+        finally:
+            shm.close()
+    if isinstance(obj, dict):
+        return {k: to_shared_memory(v, min_nbytes) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [to_shared_memory(v, min_nbytes) for v in obj]
+    if isinstance(obj, tuple) and not hasattr(obj, "_fields"):
+        return tuple(to_shared_memory(v, min_nbytes) for v in obj)
+    return obj
+
+
+def _attach(handle: SharedArray) -> np.ndarray:
+    shm = SharedMemory(name=handle.name)
+    arr = np.ndarray(handle.shape, dtype=np.dtype(handle.dtype), buffer=shm.buf)
+    # The mapping stays valid after unlinking. Closing it has to wait until the array is gone, because the array
+    # holds an export of the underlying buffer.
+    shm.unlink()
+    weakref.finalize(arr, shm.close)
+    return arr
+
+
+def from_shared_memory(obj: Any) -> Any:
+    """Inverse of :py:func:`to_shared_memory`. Arrays are backed by the shared memory blocks and are not copied."""
+    if isinstance(obj, SharedArray):
+        return _attach(obj)
+    if isinstance(obj, dict):
+        return {k: from_shared_memory(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [from_shared_memory(v) for v in obj]
+    if isinstance(obj, tuple) and not hasattr(obj, "_fields"):
+        return tuple(from_shared_memory(v) for v in obj)
+    return obj
+
+
+def release_shared_memory(obj: Any) -> None:
+    """Unlink all shared memory blocks referenced by handles in `obj` without mapping them."""
+    if isinstance(obj, SharedArray):
+        try:
+            shm = SharedMemory(name=obj.name)
+        except FileNotFoundError:
+            return
+        shm.close()
+        shm.unlink()
+    elif isinstance(obj, dict):
+        for v in obj.values():
+            release_shared_memory(v)
+    elif isinstance(obj, (list, tuple)):
+        for v in obj:
+            release_shared_memory(v)
+
+
+class SharedMemoryCallback:
+    """Picklable wrapper that applies `callback` and moves the arrays of its result into shared memory."""
+
+    def __init__(self, callback: Callable, min_nbytes: int = DEFAULT_MIN_NBYTES) -> None:
+        """Init"""
+        self.callback = callback
+        self.min_nbytes = min_nbytes
+
+    def __call__(self, item: Any) -> Any:
+        """Apply the callback to `item` and return the result with arrays replaced by handles."""
+        return to_shared_memory(self.callback(item), self.min_nbytes)
@@ -1,12 +1,19 @@
+import os
+import queue
 import random
+import threading
+import zlib
+from collections import deque
 from concurrent.futures import ThreadPoolExecutor
-from typing import Callable, Iterable, Iterator, List, Optional, Union
+from itertools import accumulate, islice
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Union
 
-from fsspec.core import url_to_fs
+from fsspec.implementations.local import LocalFileSystem
 
-from scaffold.data.fs import get_protocol
-from scaffold.data.iterstream.base import AsyncContent, Composable
-from scaffold.data.iterstream.iterators import get_random_range
+from scaffold.data.fs import get_fs_from_url, get_protocol
+from scaffold.data.iterstream.base import Composable, _put_until
+from scaffold.data.iterstream.iterators import get_random_range, get_shard_info
+from scaffold.data.iterstream.manifest import entry_to_record, iter_manifest, read_manifest_header, write_manifest
 
 __all__ = ["IterableSource", "IterableSamplerSource"]
 
@@ -24,21 +31,43 @@ class IterableSource(Composable):
     For the detailed description of each, please refer to the corresponding docstring in :py:class:`Composable`.
     """
 
-    def __init__(self, source: Optional[Union[Iterable, Callable]] = ()):
+    def __init__(self, source: Optional[Union[Iterable, Callable]] = (), shard: bool = False):
         """Initialize IterableSource.
 
         Args:
             source (Union[Iterable, Callable], Optional): An Iterable that the IterableSource is
                 built based on, or a callable that generates items when called.
+            shard (bool): If True, only every n-th item is yielded, where the shard index and n are obtained from the
+                rank and world size of `torch.distributed` and the DataLoader worker info when iterating, see
+                :py:func:`get_shard_info <scaffold.data.iterstream.iterators.get_shard_info>`. Items of other shards
+                are skipped without being yielded.
         """
         super().__init__(source=source)
+        self.sharded = shard
+        self._offset = 0
+        self._resume_offset = 0
 
     def __iter__(self) -> Iterator:
         """Iterates over the items in the iterable"""
-        if isinstance(self.source, Callable):
-            yield from self.source()
-        else:
-            yield from self.source
+        source = self.source() if isinstance(self.source, Callable) else self.source
+        index, count = get_shard_info() if self.sharded else (0, 1)
+        # The offset is the position in the source after the last yielded item
+        offset, self._resume_offset = self._resume_offset, 0
+        self._offset = position = offset + (index - offset) % count
+        for item in islice(source, position, None, count):
+            self._offset = position + 1
+            position += count
+            yield item
+
+    def state_dict(self) -> Dict[str, Any]:
+        """Return the number of items yielded so far"""
+        return {"offset": self._resume_offset or self._offset}
+
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        """Restore the offset. The next iteration skips the items before it without yielding them, which still
+        requires iterating over them if the source is a generator.
+        """
+        self._resume_offset = state["offset"]
 
 
 class IterableSamplerSource(Composable):
@@ -50,15 +79,25 @@ class IterableSamplerSource(Composable):
         probs: Optional[List[float]] = None,
         rng: Optional[random.Random] = None,
         seed: Optional[int] = None,
+        temperature: float = 1.0,
+        balanced: bool = False,
+        block_size: int = 1024,
     ):
         """Initialize IterableSamplerSource.
 
         Args:
             iterables (List[Iterable]): List of iterables to sample from.
-            probs (Optional[List[float]], optional): [description]. Defaults to None.
+            probs (Optional[List[float]], optional): Probability of sampling from each iterable. When an iterable is
+                exhausted, the probabilities of the remaining ones are renormalized. Defaults to None, which samples
+                uniformly.
             rng (random.Random, optional): Random number generator to use.
             seed (Optional[int]): An int or other acceptable types that works for random.seed(). Will be used to seed
                 `rng`. If None, a unique identifier will be used to seed.
+            temperature (float): The iterables are sampled with weights proportional to `probs ** (1 / temperature)`.
+                Values larger than 1 flatten the distribution towards uniform sampling.
+            balanced (bool): If True, `probs` are taken proportional to the lengths of the iterables, which must be
+                sized, so that all iterables are exhausted at about the same time. Cannot be combined with `probs`.
+            block_size (int): Number of random choices drawn at once.
         """
         super().__init__(source=())
         self.rng = get_random_range(rng, seed)
@@ -67,23 +106,84 @@ class IterableSamplerSource(Composable):
             assert len(probs) == len(self.iterables), "number of iterables and probs must be equal"
             assert sum(probs) == 1, "sum of probs must add up to 1"
             assert all(p > 0 for p in probs), "probability for each iterable must be positive"
+        assert not (balanced and probs is not None), "probs cannot be combined with balanced"
+        assert temperature > 0, "temperature must be positive"
         self.probs = probs
+        self.temperature = temperature
+        self.balanced = balanced
+        self.block_size = block_size
+        self._active = None
+        self._counts = None
+        self._block = None
+        self._resume = None
+
+    def _weights(self) -> List[float]:
+        """Sampling weights of the iterables, before renormalization over the iterables that are not exhausted"""
+        if self.balanced:
+            weights = [len(it) for it in self.iterables]
+        else:
+            weights = self.probs if self.probs is not None else [1.0] * len(self.iterables)
+        return [w ** (1 / self.temperature) for w in weights]
 
     def __iter__(self) -> Iterator:
         """Samples items from the iterables, returns all samples until all iterables are exhausted."""
-        iterators = [iter(it) for it in self.iterables]
-        while True:
-            idx = self.rng.choices(range(len(iterators)), weights=self.probs)[0]
-            try:
-                yield next(iterators[idx])
-            except StopIteration:
-                iterators = iterators[:idx] + iterators[idx + 1 :]
-                if self.probs is not None:
-                    probs = self.probs[:idx] + self.probs[idx + 1 :]
-                    s = sum(probs)
-                    self.probs = [p / s for p in probs]
-            if len(iterators) == 0:
-                break
+        resume, self._resume = self._resume, None
+        # Indices of the iterables that are not exhausted, number of items taken from each iterable, and random
+        # choices drawn but not yet used, which are popped from the end
+        weights = self._weights()
+        self._active = [i for i, w in enumerate(weights) if w > 0]
+        self._counts = [0] * len(self.iterables)
+        self._block = []
+        if resume is not None:
+            self._active, self._counts, self._block = list(resume["active"]), list(resume["counts"]), resume["block"]
+            self.rng.setstate(resume["rng"])
+        iterators = {i: self._iter_from(i, resume) for i in self._active}
+        active, counts, block = self._active, self._counts, self._block
+        while active:
+            cum_weights = list(accumulate(weights[i] for i in active))
+            while True:
+                if not block:
+                    block.extend(self.rng.choices(active, cum_weights=cum_weights, k=self.block_size))
+                i = block[-1]
+                try:
+                    item = next(iterators[i])
+                except StopIteration:
+                    # The remaining choices were drawn with the weights of the exhausted iterable
+                    active.remove(i)
+                    block.clear()
+                    del iterators[i]
+                    break
+                block.pop()
+                counts[i] += 1
+                yield item
+
+    def _iter_from(self, i: int, resume: Optional[Dict[str, Any]]) -> Iterator:
+        """Iterator over the i-th iterable, continuing from the restored state if there is one"""
+        iterable = self.iterables[i]
+        if resume is None:
+            return iter(iterable)
+        if isinstance(iterable, Composable):
+            iterable.load_state_dict(resume["iterables"][i])
+            return iter(iterable)
+        return islice(iter(iterable), self._counts[i], None)
+
+    def state_dict(self) -> Dict[str, Any]:
+        """Return the remaining iterables and their states, the unused random choices and the random state"""
+        if self._resume is not None:
+            return self._resume
+        if self._active is None:
+            return {}
+        return {
+            "active": list(self._active),
+            "counts": list(self._counts),
+            "block": list(self._block),
+            "rng": self.rng.getstate(),
+            "iterables": [it.state_dict() if isinstance(it, Composable) else None for it in self.iterables],
+        }
+
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        """Restore a state obtained from :py:meth:`state_dict`"""
+        self._resume = state or None
 
 
 class FilePathGenerator(Composable):
@@ -91,8 +191,18 @@ class FilePathGenerator(Composable):
     A specialized version of `Composable` that accepts a url without instantiating a filesystem instance in the init.
     It simply generates directories under the given `url` by instantiating a fsspec filesystem and yielding the result
     of fs.ls(url).
+
+    Only local directories are listed page by page (see :py:attr:`page_size`), so that the first paths are yielded
+    before a large directory is fully listed. On object stores, every directory is listed with a single `fs.ls` call,
+    which returns once all its pages have been fetched, so a large flat prefix delays the first path until its whole
+    listing is done. Directories are still listed concurrently if `nested` is True, and a `manifest` avoids listing
+    on later runs. Subclasses can override `_ls_pages` to stream the paginated listing of a specific backend.
     """
 
+    #: Number of entries per page when listing a local directory
+    page_size: int = 1000
+    _runtime_attrs = ("fs",)
+
     def __init__(
         self,
         url: str,
@@ -100,18 +210,38 @@ class FilePathGenerator(Composable):
         max_workers: Optional[int] = None,
         max_keys: int = 1_000_000,
         max_dirs: int = 10,
+        shard: bool = False,
+        manifest: Optional[str] = None,
+        refresh: bool = False,
         **storage_options,
     ):
         """
         Args:
             url: the url for which, ls is performed
             nested: if True, it attempts to make ls on each directory that it encounters. Otherwise, it will only yields
-                the top-level paths and will not expand if the path is a directory
+                the top-level paths and will not expand if the path is a directory. Directories are listed
+                concurrently and paths are yielded as soon as a listing (or a page of it) arrives, so the order of the
+                paths is not deterministic if `max_dirs` > 1.
             max_workers (int): passed to the ThreadPoolExecutor. Only applicable if nested==True
             max_keys (int): maximum number of keys to keep in memory at the same time. If this number is reached, no new
                 expansion on the currently discovered directories is done, until enough keys are yielded to make room
                 for the new ones.
             max_dirs (int): maximum number of parallel ls operation.
+            shard (bool): if True, only every n-th path is yielded, where the shard index and n are obtained from the
+                rank and world size of `torch.distributed` and the DataLoader worker info when iterating, see
+                :py:func:`get_shard_info <scaffold.data.iterstream.iterators.get_shard_info>`. If nested is False,
+                the listing itself is sharded. Otherwise, paths are assigned to shards by a hash of the path.
+            manifest (str, Optional): url of a manifest file, see :py:mod:`scaffold.data.iterstream.manifest`. If it
+                exists, the paths are streamed from it in sorted order without listing `url`. Otherwise, the paths,
+                sizes and etags discovered by the listing are written to it once the listing has been fully consumed
+                (by shard 0 if sharded). Use a `.gz` suffix to compress the manifest.
+            refresh (bool): if True and the manifest exists, `url` is listed without recursion before streaming from
+                the manifest. Top-level entries that are new are listed (recursively if nested) and added, those that
+                were removed are dropped, and the manifest is rewritten if anything changed. Changes inside known
+                top-level directories are not detected. Note that every process that iterates, i.e. every rank and
+                DataLoader worker, lists `url` at the start of every iteration. For many processes or a large
+                top-level, prefer calling :py:meth:`refresh_manifest` once in a single process before the training
+                starts, and `refresh=False`.
             **storage_options (dict): kwargs to pass onto the fsspec filesystem initialization.
         """
         super().__init__()
@@ -121,29 +251,229 @@ class FilePathGenerator(Composable):
         self.max_workers = max_workers
         self.max_keys = max_keys
         self.max_dirs = max_dirs
+        self.sharded = shard
+        self.manifest = manifest
+        self.refresh = refresh
         self.storage_options = storage_options
+        self._records = None
+        self._position = None
+        self._urls = None
+        self._files = None
+        self._dirs = None
+        self._listing = None
+        self._resume = None
 
     def __iter__(self) -> Iterator[str]:
         """Iterator that does ls and yield filepaths under the given url"""
-        self.fs, _ = url_to_fs(self.url, **self.storage_options)
-        urls = self.fs.ls(self.url, detail=False) if self.fs.exists(self.url) else []
-        urls.sort()
+        self.fs = get_fs_from_url(self.url, **self.storage_options)
+        index, count = get_shard_info() if self.sharded else (0, 1)
+        resume, self._resume = self._resume, None
+        self._position = None
+        if self.manifest is not None and (resume is None or "position" in resume):
+            if get_fs_from_url(self.manifest).exists(self.manifest):
+                if self.refresh and resume is None:
+                    self._refresh_manifest()
+                yield from self._iter_manifest(resume, index, count)
+                return
+        if resume is not None and "position" in resume:
+            raise ValueError(
+                f"The state was saved while streaming from the manifest {self.manifest}, which does not exist anymore."
+            )
+        # Records of all discovered files, regardless of the shard, if a manifest needs to be written
+        self._records = [] if self.manifest is not None and resume is None else None
+
         if self.nested:
-            dirs = []
-            with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
-                while len(urls) > 0 or dirs:
-                    if len(urls) > 0:
-                        url = urls.pop()
-                        if self.fs.isdir(path=url):
-                            future = AsyncContent(url, self.fs.ls, pool)
-
-                            dirs.append(future)
-                        else:
-                            yield f"{self.protocol}{url}"
-                    if (len(dirs) >= self.max_dirs and len(urls) < self.max_keys) or len(urls) == 0 and dirs:
-                        d = dirs.pop(0).value()
-                        urls.extend(d)
+            yield from self._iter_nested(resume, index, count)
+        else:
+            yield from self._iter_top_level(resume, index, count)
 
+        if self._records is not None and index == 0:
+            write_manifest(self.manifest, {"url": self.url, "nested": self.nested}, self._records)
+        self._records = None
+
+    def _iter_top_level(self, resume: Optional[Dict[str, Any]], index: int, count: int) -> Iterator[str]:
+        if resume is not None:
+            urls = list(resume["urls"])
         else:
-            for url in urls:
-                yield f"{self.protocol}{url}"
+            if not self.fs.exists(self.url):
+                urls = []
+            elif self._records is not None:
+                entries = self.fs.ls(self.url, detail=True)
+                self._records.extend(entry_to_record(e) for e in entries)
+                urls = [e["name"] for e in entries]
+            else:
+                urls = self.fs.ls(self.url, detail=False)
+            urls.sort()
+            urls = urls[index::count]
+            # Paths are popped from the end
+            urls.reverse()
+        self._urls = urls
+        while len(urls) > 0:
+            yield f"{self.protocol}{urls.pop()}"
+
+    def _iter_manifest(self, resume: Optional[Dict[str, Any]], index: int, count: int) -> Iterator[str]:
+        header = read_manifest_header(self.manifest)
+        if header.get("url") != self.url or header.get("nested") != self.nested:
+            raise ValueError(
+                f"Manifest {self.manifest} was written for url={header.get('url')} and nested={header.get('nested')}, "
+                f"but got url={self.url} and nested={self.nested}."
+            )
+        # The position is the number of records consumed so far, over all shards
+        position = 0 if resume is None else resume["position"]
+        self._position = position
+        for record in islice(iter_manifest(self.manifest), position, None):
+            self._position = position = position + 1
+            if (position - 1) % count == index:
+                yield f"{self.protocol}{record.path}"
+
+    def refresh_manifest(self) -> None:
+        """Refresh the existing manifest as described for the `refresh` argument, without iterating"""
+        self.fs = get_fs_from_url(self.url, **self.storage_options)
+        self._refresh_manifest()
+
+    def _refresh_manifest(self) -> None:
+        """Add the files under new top-level entries of `url` to the manifest and drop those of removed ones"""
+        root = self.fs._strip_protocol(self.url).rstrip("/")
+
+        def top_level(path: str) -> str:
+            return f"{root}/{path[len(root) :].lstrip('/').split('/')[0]}"
+
+        records = list(iter_manifest(self.manifest))
+        entries = {e["name"].rstrip("/"): e for e in self.fs.ls(self.url, detail=True)}
+        known = {top_level(r.path) for r in records}
+        n_records = len(records)
+        records = [r for r in records if top_level(r.path) in entries]
+        new = [entries[name] for name in sorted(entries.keys() - known)]
+        if not self.nested:
+            records.extend(entry_to_record(e) for e in new)
+        else:
+            records.extend(entry_to_record(e) for e in new if e["type"] != "directory")
+            new_dirs = [e["name"].rstrip("/") for e in new if e["type"] == "directory"]
+            if new_dirs:
+                self._records = []
+                for _ in self._iter_nested({"files": [], "dirs": new_dirs, "listing": {}}, 0, 1):
+                    pass
+                records.extend(self._records)
+                self._records = None
+        # Every process that refreshes the manifest lists `url`, but only the first one to see a change rewrites it
+        if new or len(records) != n_records:
+            write_manifest(self.manifest, {"url": self.url, "nested": self.nested}, records)
+
+    def _iter_nested(self, resume: Optional[Dict[str, Any]], index: int, count: int) -> Iterator[str]:
+        # Files not yet yielded, directories not yet listed, and the number of entries received so far for the
+        # directories that are being listed
+        if resume is not None:
+            files, dirs, listing = deque(resume["files"]), deque(resume["dirs"]), dict(resume["listing"])
+        else:
+            files, dirs, listing = deque(), deque(), {}
+            if self.fs.exists(self.url):
+                root = self.fs._strip_protocol(self.url)
+                (dirs if self.fs.isdir(root) else files).append(root)
+        self._files, self._dirs, self._listing = files, dirs, listing
+
+        pages = queue.Queue(maxsize=2 * self.max_dirs)
+        stop = threading.Event()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            try:
+                for path, n_received in listing.items():
+                    pool.submit(self._list_dir, path, n_received, pages, stop)
+                while True:
+                    while dirs and len(listing) < self.max_dirs and len(files) < self.max_keys:
+                        path = dirs.popleft()
+                        listing[path] = 0
+                        pool.submit(self._list_dir, path, 0, pages, stop)
+
+                    page = None
+                    if not files and listing:
+                        page = pages.get()
+                    elif len(files) < self.max_keys:
+                        try:
+                            page = pages.get_nowait()
+                        except queue.Empty:
+                            pass
+                    if page is not None:
+                        self._add_page(*page)
+                        continue
+
+                    if not files:
+                        break
+                    path = files.popleft()
+                    if count == 1 or zlib.crc32(path.encode()) % count == index:
+                        yield f"{self.protocol}{path}"
+            finally:
+                stop.set()
+
+    def _add_page(self, path: str, entries: Optional[Union[List[Dict[str, Any]], Exception]]) -> None:
+        if isinstance(entries, Exception):
+            raise entries
+        if entries is None:
+            # The listing of `path` is complete
+            del self._listing[path]
+            return
+        self._listing[path] += len(entries)
+        for entry in entries:
+            name = entry["name"].rstrip("/")
+            if entry["type"] == "directory":
+                # Some object stores return the prefix itself as an entry
+                if name != path.rstrip("/"):
+                    self._dirs.append(name)
+            else:
+                self._files.append(name)
+                if self._records is not None:
+                    self._records.append(entry_to_record(entry))
+
+    def _list_dir(self, path: str, skip: int, pages: queue.Queue, stop: threading.Event) -> None:
+        """Put the pages of the listing of `path` into `pages`, skipping the first `skip` entries"""
+        try:
+            for page in self._ls_pages(path):
+                if skip >= len(page):
+                    skip -= len(page)
+                    continue
+                page, skip = page[skip:], 0
+                if not _put_until(pages, (path, page), stop):
+                    return
+            _put_until(pages, (path, None), stop)
+        except Exception as e:
+            _put_until(pages, (path, e), stop)
+
+    def _ls_pages(self, path: str) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Yield the entries of the directory `path` in pages. Each entry is a dict with the keys "name" and "type",
+        as returned by `fs.ls(path, detail=True)`, so that no additional request per entry is needed to tell files and
+        directories apart. Local directories are streamed in pages of :py:attr:`page_size` entries, other filesystems
+        return a single page. Override this method to use the paginated listing of a specific backend.
+        """
+        if isinstance(self.fs, LocalFileSystem):
+            with os.scandir(path) as it:
+                while True:
+                    page = [
+                        {"name": e.path, "type": "directory" if e.is_dir() else "file"}
+                        for e in islice(it, self.page_size)
+                    ]
+                    if self._records is not None:
+                        # Sizes and modification times are only needed to write a manifest
+                        for entry in page:
+                            if entry["type"] == "file":
+                                stat = os.stat(entry["name"])
+                                entry.update(size=stat.st_size, mtime=stat.st_mtime)
+                    if not page:
+                        return
+                    yield page
+        else:
+            yield self.fs.ls(path, detail=True)
+
+    def state_dict(self) -> Dict[str, Any]:
+        """Return the listing cursor, i.e. the paths not yet yielded and the directories not yet listed"""
+        if self._resume is not None:
+            return self._resume
+        if self._position is not None:
+            return {"position": self._position}
+        if self.nested and self._files is not None:
+            return {"files": list(self._files), "dirs": list(self._dirs), "listing": dict(self._listing)}
+        if not self.nested and self._urls is not None:
+            return {"urls": list(self._urls)}
+        return {}
+
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        """Restore the listing cursor, the next iteration continues without listing the url again"""
+        self._resume = state or None
@@ -0,0 +1,116 @@
+import importlib
+import os
+import stat
+import sys
+import time
+from unittest import mock
+
+from scaffold.data.artifact_manager.cache import ArtifactCache, is_immutable_version
+from scaffold.data.artifact_manager.filesystem import FileSystemArtifactManager
+from scaffold.data.artifact_manager.wandb import WandbArtifactManager
+
+
+def _writer(content: bytes, calls: list):
+    def download(path: str) -> None:
+        calls.append(path)
+        os.makedirs(os.path.join(path, "sub"))
+        with open(os.path.join(path, "sub", "file.bin"), "wb") as f:
+            f.write(content)
+
+    return download
+
+
+def test_fetch_hard_links(tmp_path):
+    """Test that a cached version is downloaded once and handed out as read-only hard links"""
+    cache = ArtifactCache(str(tmp_path / "cache"))
+    calls = []
+    key = ("store", "collection", "name", "v0")
+    assert not cache.fetch(key, _writer(b"abc", calls), str(tmp_path / "a"))
+    assert cache.fetch(key, _writer(b"abc", calls), str(tmp_path / "b"))
+    assert len(calls) == 1
+
+    stat_a, stat_b = os.stat(tmp_path / "a" / "sub" / "file.bin"), os.stat(tmp_path / "b" / "sub" / "file.bin")
+    assert stat_a.st_ino == stat_b.st_ino
+    assert stat_a.st_nlink == 3
+    assert not stat_a.st_mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH)
+    assert (tmp_path / "b" / "sub" / "file.bin").read_bytes() == b"abc"
+
+
+def test_lru_eviction(tmp_path):
+    """Test that the least recently used versions are evicted once the size limit is exceeded"""
+    cache = ArtifactCache(str(tmp_path / "cache"), max_bytes=25)
+    calls = []
+    for version in ["v0", "v1"]:
+        cache.fetch(("store", "c", "name", version), _writer(b"0123456789", calls), str(tmp_path / version))
+        time.sleep(0.01)
+    # Using v0 makes v1 the least recently used version
+    cache.fetch(("store", "c", "name", "v0"), _writer(b"0123456789", calls), str(tmp_path / "v0"))
+    time.sleep(0.01)
+    cache.fetch(("store", "c", "name", "v2"), _writer(b"0123456789", calls), str(tmp_path / "v2"))
+    assert len(calls) == 3
+    names = {os.path.basename(path) for path, _, _ in cache.entries()}
+    assert names == {cache.entry_name(("store", "c", "name", v)) for v in ["v0", "v2"]}
+    # Handed out files stay valid after eviction
+    assert (tmp_path / "v1" / "sub" / "file.bin").read_bytes() == b"0123456789"
+
+
+def test_evict_removed_tmp_dir(tmp_path):
+    """Test that eviction skips temporary directories that are removed concurrently"""
+    cache = ArtifactCache(str(tmp_path / "cache"))
+    os.makedirs(os.path.join(cache.root, cache.TMP_DIR, "fetching"))
+    stat_ = os.stat
+
+    def removed(path, *args, **kwargs):
+        if os.path.basename(path) == "fetching":
+            raise FileNotFoundError(path)
+        return stat_(path, *args, **kwargs)
+
+    with mock.patch("os.stat", removed):
+        cache.evict()
+
+
+def test_manager_cache(tmp_path):
+    """Test that repeated downloads of an artifact version are served from the cache"""
+    src = tmp_path / "src"
+    src.mkdir()
+    (src / "state.pt").write_bytes(b"state")
+    manager = FileSystemArtifactManager(str(tmp_path / "store"), cache=ArtifactCache(str(tmp_path / "cache")))
+    manager.log_files("model", str(src), "description")
+
+    with mock.patch.object(manager.transfer, "download", wraps=manager.transfer.download) as download:
+        for _ in range(3):
+            with manager.download_artifact("model") as tmp_dir:
+                with open(os.path.join(tmp_dir, "state.pt"), "rb") as f:
+                    assert f.read() == b"state"
+            assert not os.path.exists(tmp_dir)
+    assert download.call_count == 1
+
+
+def test_wandb_cache_resolves_alias(tmp_path):
+    """Test that an alias of a wandb artifact is cached under the version it resolves to"""
+    wandb = mock.MagicMock(run=None)
+    art = wandb.Api.return_value.artifact.return_value
+    art.version = "v3"
+    calls = []
+    art.download.side_effect = _writer(b"abc", calls)
+    with mock.patch.dict(sys.modules, {"wandb": wandb}):
+        manager = WandbArtifactManager(entity="e", project="p", cache=ArtifactCache(str(tmp_path / "cache")))
+    for i in range(2):
+        artifact = manager.download_artifact("model", to=str(tmp_path / str(i)))
+        assert artifact.version == "latest"
+        assert (tmp_path / str(i) / "sub" / "file.bin").read_bytes() == b"abc"
+    assert len(calls) == 1
+
+
+def test_import_without_fcntl():
+    """Test that the artifact managers can be imported on systems without fcntl"""
+    with mock.patch.dict(sys.modules, {"fcntl": None}):
+        for name in [name for name in sys.modules if name.startswith("scaffold.data.artifact_manager")]:
+            del sys.modules[name]
+        importlib.import_module("scaffold.data.artifact_manager.filesystem")
+
+
+def test_is_immutable_version():
+    assert is_immutable_version("v12")
+    assert not is_immutable_version("latest")
+    assert not is_immutable_version(None)
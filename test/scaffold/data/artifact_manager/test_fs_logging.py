@@ -1,10 +1,11 @@
 import shutil
 import tempfile
 import uuid
+from unittest import mock
 
 import pytest
 
-from scaffold.constants import ARTIFACT_DESCRIPTION_FILE, ARTIFACT_META_DIR
+from scaffold.constants import ARTIFACT_BLOB_DIR, ARTIFACT_DESCRIPTION_FILE, ARTIFACT_META_DIR
 from scaffold.data.artifact_manager.base import Artifact
 from scaffold.data.artifact_manager.filesystem import FileSystemArtifactManager
 from scaffold.data.fs import get_fs_from_url, join_path
@@ -231,3 +232,34 @@ def test_download_tmp(temp_src_dir, artifact_manager):
             with fs_temp.open(file_path, "rt") as f:
                 file_content = f.read()
             assert file_content == test_files.get(base)
+
+
+def test_deduplicated_versions(temp_store_dir, temp_src_dir):
+    """Test that content-addressed versions only upload new files and are reconstructed on download."""
+    manager = FileSystemArtifactManager(url=temp_store_dir, deduplicate=True)
+    fs = get_fs_from_url(temp_store_dir)
+    blob_dir = join_path(temp_store_dir, ARTIFACT_BLOB_DIR)
+    contents = {"a.txt": "A", "sub/b.txt": "B", "sub/c.txt": "A"}
+    fs.makedirs(join_path(temp_src_dir, "sub"))
+    for filename, content in contents.items():
+        fs.pipe_file(join_path(temp_src_dir, filename), content.encode())
+
+    assert manager.log_files("ckpt", temp_src_dir, "description").version == "v0"
+    assert len(fs.find(blob_dir)) == 2
+    fs.pipe_file(join_path(temp_src_dir, "sub/b.txt"), b"B2")
+    with mock.patch.object(manager.transfer, "_put_file", wraps=manager.transfer._put_file) as put_file:
+        assert manager.log_files("ckpt", temp_src_dir, "description").version == "v1"
+    assert put_file.call_count == 1
+    assert len(fs.find(blob_dir)) == 3
+    assert manager.list_collection_names() == ["default"]
+
+    for version, expected in [("v0", contents), ("v1", {**contents, "sub/b.txt": "B2"})]:
+        with manager.download_artifact("ckpt", version=version) as tmp_dir:
+            downloaded = {p[len(tmp_dir) + 1 :]: fs.cat_file(p).decode() for p in fs.find(tmp_dir)}
+        assert downloaded == expected
+
+    # Versions logged without deduplication can still be downloaded
+    manager.deduplicate = False
+    assert manager.log_files("ckpt", temp_src_dir, "description").version == "v2"
+    with manager.download_artifact("ckpt", version="v2") as tmp_dir:
+        assert sorted(p[len(tmp_dir) + 1 :] for p in fs.find(tmp_dir)) == sorted(contents)
@@ -0,0 +1,62 @@
+import os
+from unittest import mock
+
+import pytest
+
+from scaffold.data.artifact_manager.transfer import TransferEngine
+from scaffold.data.fs import get_fs_from_url
+
+
+@pytest.fixture
+def src_dir(tmp_path):
+    src = tmp_path / "src"
+    (src / "sub").mkdir(parents=True)
+    (src / "small.txt").write_text("small")
+    (src / "sub" / "large.bin").write_bytes(os.urandom(10_000))
+    return str(src)
+
+
+def test_upload_download_parts(tmp_path, src_dir):
+    """Test that large files are downloaded in ranged parts and the relative paths are kept"""
+    fs = get_fs_from_url(str(tmp_path))
+    engine = TransferEngine(max_workers=4, part_size=1024, multipart_threshold=4096)
+    stats = engine.upload(fs, src_dir, str(tmp_path / "remote"))
+    assert (stats.files, stats.parts, stats.nbytes) == (2, 2, 10_005)
+
+    stats = engine.download(fs, str(tmp_path / "remote"), str(tmp_path / "dst"))
+    assert (stats.files, stats.parts, stats.nbytes) == (2, 11, 10_005)
+    assert stats.bytes_per_sec > 0
+    for name in ["small.txt", "sub/large.bin"]:
+        assert (tmp_path / "dst" / name).read_bytes() == (tmp_path / "src" / name).read_bytes()
+
+
+def test_retry_parts(tmp_path, src_dir):
+    """Test that a failed part is retried on its own"""
+    fs = get_fs_from_url(str(tmp_path))
+    engine = TransferEngine(part_size=1024, multipart_threshold=4096, retry_delay=0)
+    engine.upload(fs, src_dir, str(tmp_path / "remote"))
+
+    cat_file = fs.cat_file
+    with mock.patch.object(fs, "cat_file", side_effect=_fail_once(cat_file)):
+        stats = engine.download(fs, str(tmp_path / "remote"), str(tmp_path / "dst"))
+    assert stats.retries == 1
+    assert (tmp_path / "dst" / "sub" / "large.bin").read_bytes() == (
+        tmp_path / "src" / "sub" / "large.bin"
+    ).read_bytes()
+
+    engine.max_retries = 0
+    with mock.patch.object(fs, "cat_file", side_effect=_fail_once(cat_file)):
+        with pytest.raises(ConnectionError):
+            engine.download(fs, str(tmp_path / "remote"), str(tmp_path / "dst"))
+
+
+def _fail_once(fn):
+    calls = []
+
+    def wrapper(*args, **kwargs):
+        calls.append(args)
+        if len(calls) == 1:
+            raise ConnectionError("reset")
+        return fn(*args, **kwargs)
+
+    return wrapper
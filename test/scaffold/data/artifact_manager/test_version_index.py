@@ -0,0 +1,53 @@
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from scaffold.data.artifact_manager.filesystem import FileSystemArtifactManager
+from scaffold.data.artifact_manager.version_index import VersionIndex
+from scaffold.data.fs import get_fs_from_url
+
+
+def test_concurrent_writers(tmp_path):
+    """Test that concurrent writers are assigned distinct versions and that no update of the index is lost"""
+    src = tmp_path / "file.txt"
+    src.write_text("content")
+    manager = FileSystemArtifactManager(str(tmp_path / "store"))
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        artifacts = list(pool.map(lambda _: manager.log_files("art", str(src), "description"), range(8)))
+    expected = [f"v{i}" for i in range(8)]
+    assert sorted((a.version for a in artifacts), key=lambda v: int(v[1:])) == expected
+
+    index = manager.version_index("art").read()
+    assert index["latest"] == "v7"
+    assert index["versions"]["v3"]["size"] == len("content")
+    with mock.patch.object(manager.fs, "ls") as ls:
+        assert manager.list_versions("art") == expected
+        assert manager.exists_in_collection("art")
+    ls.assert_not_called()
+
+
+def test_pending_and_legacy_versions(tmp_path):
+    """Test that versions logged without an index are kept and that pending versions are neither listed nor reused"""
+    fs = get_fs_from_url(str(tmp_path))
+    for version in ["v0", "v1"]:
+        (tmp_path / "art" / version).mkdir(parents=True)
+        fs.pipe_file(str(tmp_path / "art" / version / "file.txt"), b"content")
+    index = VersionIndex(fs, str(tmp_path / "art"))
+    assert index.read() is None
+    assert index.versions() == ["v0", "v1"]
+
+    assert index.claim_version() == "v2"
+    assert index.claim_version() == "v3"
+    index.complete_version("v3", size=1, files=1)
+    assert index.versions() == ["v0", "v1", "v3"]
+    assert index.latest() == "v3"
+    assert index.claim_version() == "v4"
+
+
+def test_exists_with_pending_version(tmp_path):
+    """Test that an artifact whose only version is pending does not exist"""
+    manager = FileSystemArtifactManager(str(tmp_path / "store"))
+    index = manager.version_index("art")
+    version = index.claim_version()
+    assert not manager.exists_in_collection("art")
+    index.complete_version(version, size=1, files=1)
+    assert manager.exists_in_collection("art")
@@ -1,6 +1,8 @@
 from typing import Any, Dict, List
 
+import numpy as np
 import pytest
+import torch
 from pytest import FixtureRequest
 
 from scaffold.data.iterstream.iterators import getsize
@@ -11,6 +13,29 @@ def test_getsize(mock_object: Any) -> None:
     assert getsize(mock_object) > 0
 
 
+def test_getsize_nested() -> None:
+    """Test that arrays and tensors in nested structures are measured by their number of bytes"""
+    sample = {
+        "image": np.zeros((32, 32, 3), dtype=np.uint8),
+        "features": [torch.zeros(100, dtype=torch.float32), (b"abc", "de")],
+    }
+    assert getsize(sample) == len("image") + 32 * 32 * 3 + len("features") + 400 + 3 + 2
+
+
+def test_getsize_register() -> None:
+    """Test registering the size estimator of a custom type"""
+
+    class Blob:
+        def __init__(self, n: int) -> None:
+            self.data = np.zeros(n, dtype=np.uint8)
+
+    @getsize.register
+    def _(item: Blob) -> int:
+        return item.data.nbytes
+
+    assert getsize([Blob(10), Blob(20)]) == 30
+
+
 @pytest.fixture
 def mock_dictionary() -> Dict[int, str]:
     """A mock dictionary."""
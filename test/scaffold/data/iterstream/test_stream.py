@@ -1,18 +1,25 @@
 from __future__ import annotations
 
 import os
+import pickle
+import shutil
 import tempfile
+import threading
+import time
 import typing as t
 import uuid
 from concurrent.futures import ThreadPoolExecutor
 from functools import partial
+from unittest import mock
 
 import numpy as np
 import pytest
 
 from scaffold.data.fs import get_fs_from_url
-from scaffold.data.iterstream import Composable, FilePathGenerator, IterableSource
-from scaffold.data.iterstream.iterators import take_
+from scaffold.data.iterstream import Composable, FilePathGenerator, IterableSamplerSource, IterableSource
+from scaffold.data.iterstream.cache import fingerprint
+from scaffold.data.iterstream.iterators import map_, take_
+from scaffold.data.iterstream.manifest import iter_manifest
 
 if t.TYPE_CHECKING:
     from scaffold.data.constants import SampleType
@@ -242,6 +249,35 @@ def test_batched(samples: t.List[SampleType]) -> None:
     assert all(len(batch) == 3 for batch in res_drop)
 
 
+def test_batched_columnar() -> None:
+    """Test columnar batching into preallocated arrays"""
+    import torch
+
+    samples = [
+        {"image": np.full((2, 2), i, dtype=np.uint8), "label": i, "key": f"_{i}", "t": torch.full((3,), float(i))}
+        for i in range(7)
+    ]
+    res = IterableSource(samples).batched(3, columnar=True, drop_last_if_not_full=False).collect()
+    assert len(res) == 3
+    assert res[0]["image"].shape == (3, 2, 2) and res[0]["image"].dtype == np.uint8
+    np.testing.assert_array_equal(res[1]["label"], [3, 4, 5])
+    assert res[1]["key"] == ["_3", "_4", "_5"]
+    assert torch.equal(res[1]["t"], torch.tensor([[3.0] * 3, [4.0] * 3, [5.0] * 3]))
+    assert res[2]["image"].shape == (1, 2, 2) and res[2]["key"] == ["_6"]
+
+    ref = IterableSource(samples).batched(3, collation_fn=lambda b: np.stack([s["image"] for s in b])).collect()
+    for r, c in zip(ref, IterableSource(samples).batched(3, columnar=True).collect()):
+        np.testing.assert_array_equal(r, c["image"])
+
+    # tuples and reused buffers
+    res = IterableSource([(np.ones(2) * i, i) for i in range(4)]).batched(2, columnar=True, num_buffers=1)
+    batches = [b[1].copy() for b in res]
+    np.testing.assert_array_equal(batches[1], [2, 3])
+
+    with pytest.raises(ValueError):
+        IterableSource(samples).batched(3, collation_fn=list, columnar=True)
+
+
 @pytest.mark.parametrize(
     "window_size,deepcopy,stride,drop_last_if_not_full,min_window_size,fill_nan_on_partial,expected",
     [
@@ -382,6 +418,41 @@ def test_sliding(
     )
 
 
+@pytest.mark.parametrize("window_size,stride", [(5, 1), (5, 2), (5, 5), (3, 3), (20, 1)])
+@pytest.mark.parametrize("drop_last_if_not_full,min_window_size", [(True, 1), (False, 1), (False, 3)])
+@pytest.mark.parametrize("deepcopy", [True, False])
+def test_sliding_as_array(
+    window_size: int, stride: int, drop_last_if_not_full: bool, min_window_size: int, deepcopy: bool
+) -> None:
+    """Test that sliding with as_array returns the same windows as the list based sliding"""
+    inp = [np.array([i, -i]) for i in range(3000)]
+    kw = dict(
+        window_size=window_size,
+        deepcopy=deepcopy,
+        stride=stride,
+        drop_last_if_not_full=drop_last_if_not_full,
+        min_window_size=min(min_window_size, window_size - 1),
+    )
+    expected = IterableSource(inp).sliding(**kw).map(np.stack).collect()
+    res = IterableSource(inp).sliding(**kw, as_array=True).collect()
+    assert len(res) == len(expected)
+    for r, e in zip(res, expected):
+        np.testing.assert_array_equal(r, e)
+        assert r.flags.writeable == deepcopy
+
+
+def test_sliding_as_array_fill_nan() -> None:
+    """Test that partial windows are filled with NaN when sliding with as_array"""
+    res = (
+        IterableSource(range(10))
+        .sliding(5, deepcopy=False, stride=2, drop_last_if_not_full=False, fill_nan_on_partial=True, as_array=True)
+        .collect()
+    )
+    assert len(res) == 5
+    np.testing.assert_array_equal(res[0], [0, 1, 2, 3, 4])
+    np.testing.assert_array_equal(res[-1], [8, 9, np.nan, np.nan, np.nan])
+
+
 def test_sliding_raise() -> None:
     """Test sliding exception for invalid arguments"""
     inp = list(range(10))
@@ -425,6 +496,83 @@ def test_async_map_executor() -> None:
     assert res_1 == res_2
 
 
+def test_async_map_unordered() -> None:
+    """Test that async_map with ordered=False returns results in completion order"""
+    import time
+
+    def _sleep(x: int) -> int:
+        time.sleep(0.5 if x == 0 else 0.01)
+        return x
+
+    res = IterableSource(range(10)).async_map(_sleep, buffer=5, max_workers=5, ordered=False).collect()
+    assert sorted(res) == list(range(10))
+    assert res[0] != 0
+    assert IterableSource(range(5)).async_map(_sleep, buffer=1, ordered=False).collect() == list(range(5))
+
+
+def test_asyncio_map() -> None:
+    """Test asyncio_map with many concurrent coroutines on the private event loop"""
+    import asyncio
+
+    async def _sleep_add(x: int, offset: int) -> int:
+        await asyncio.sleep(0.2 if x == 0 else 0.01)
+        return x + offset
+
+    res = IterableSource(range(1000)).asyncio_map(_sleep_add, offset=1).collect()
+    assert res == list(range(1, 1001))
+    res_unordered = IterableSource(range(100)).asyncio_map(_sleep_add, offset=1, ordered=False).collect()
+    assert sorted(res_unordered) == list(range(1, 101))
+    assert res_unordered[0] != 1
+    assert IterableSource(range(1000)).asyncio_map(_sleep_add, buffer=10, offset=0).take(3).collect() == [0, 1, 2]
+
+    with pytest.raises(TypeError):
+        IterableSource(range(3)).asyncio_map(lambda x: x)
+
+
+def test_async_map_processes() -> None:
+    """Test async_map in a process pool with arrays returned through shared memory"""
+    res = IterableSource(range(5)).async_map(_make_arrays, processes=True, max_workers=2, size=100_000).collect()
+    assert [r["index"] for r in res] == list(range(5))
+    for i, r in enumerate(res):
+        np.testing.assert_array_equal(r["large"], np.full(100_000, i, dtype=np.float32))
+        np.testing.assert_array_equal(r["small"], np.arange(3) + i)
+
+    res = IterableSource(range(5)).async_map(_make_arrays, processes=True, ordered=False).collect()
+    assert sorted(r["index"] for r in res) == list(range(5))
+
+    # stopping early must not leave unconsumed results behind
+    assert (
+        IterableSource(range(20)).async_map(_make_arrays, processes=True, buffer=4).take(2).collect()[1]["index"] == 1
+    )
+
+    with pytest.raises(ValueError):
+        IterableSource(range(5)).async_map(_make_arrays, processes=True, executor=ThreadPoolExecutor())
+
+
+def test_async_map_processes_in_dataloader() -> None:
+    """Test async_map in a process pool inside the daemonic worker processes of a DataLoader"""
+    from torch.utils.data import DataLoader, IterableDataset
+
+    class Dataset(IterableDataset):
+        def __init__(self, stream: Composable) -> None:
+            self.stream = stream
+
+        def __iter__(self) -> t.Iterator:
+            return iter(self.stream)
+
+    it = IterableSource(range(4)).async_map(_make_arrays, processes=True, max_workers=2, size=100_000)
+    res = list(DataLoader(Dataset(it), num_workers=1, batch_size=None))
+    assert [int(r["index"]) for r in res] == list(range(4))
+    for i, r in enumerate(res):
+        np.testing.assert_array_equal(r["large"].numpy(), np.full(100_000, i, dtype=np.float32))
+
+    # stopping early shuts down the pool of the worker
+    it = IterableSource(range(100)).async_map(_make_arrays, processes=True, max_workers=2, buffer=4)
+    loader = iter(DataLoader(Dataset(it), num_workers=2, batch_size=None))
+    assert int(next(loader)["index"]) in (0, 1)
+    del loader
+
+
 def test_different_maps() -> None:
     """Test mapping a value with map, async_map"""
 
@@ -508,6 +656,567 @@ def test_shuffle_size_parameter(size: t.Optional[int]) -> None:
     assert sorted(iter) == list(range(100))
 
 
+@pytest.mark.parametrize("size,initial", [(10, 1), (10, 10), (100, 5), (500, 100)])
+def test_shuffle_seed(size: int, initial: int) -> None:
+    """Test that shuffle is a reproducible permutation for a given seed"""
+    items = list(range(200))
+    res_1 = IterableSource(items).shuffle(size, initial=initial, seed=42).collect()
+    res_2 = IterableSource(items).shuffle(size, initial=initial, seed=42).collect()
+    res_3 = IterableSource(items).shuffle(size, initial=initial, seed=43).collect()
+    assert sorted(res_1) == items
+    assert res_1 == res_2
+    assert res_1 != res_3
+    res_4 = IterableSource(items).shuffle(size, initial=initial, rng=np.random.default_rng(0)).collect()
+    res_5 = IterableSource(items).shuffle(size, initial=initial, rng=np.random.default_rng(0)).collect()
+    assert res_4 == res_5 and sorted(res_4) == items
+
+
+def test_shard() -> None:
+    """Test that the shards of a stream are disjoint and complete"""
+    shards = [IterableSource(range(10)).shard(i, 3).collect() for i in range(3)]
+    assert shards == [[0, 3, 6, 9], [1, 4, 7], [2, 5, 8]]
+    assert IterableSource(range(10)).shard().collect() == list(range(10))
+    with pytest.raises(ValueError):
+        IterableSource(range(10)).shard(index=1)
+    with pytest.raises(ValueError):
+        IterableSource(range(10)).shard(3, 3)
+
+
+def test_get_shard_info(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test that sources are sharded by DataLoader workers"""
+    import torch.utils.data
+
+    from scaffold.data.iterstream.iterators import get_shard_info
+
+    assert get_shard_info() == (0, 1)
+    monkeypatch.setattr(torch.utils.data, "get_worker_info", lambda: type("Info", (), {"id": 1, "num_workers": 4}))
+    assert get_shard_info() == (1, 4)
+    assert IterableSource(range(10), shard=True).collect() == [1, 5, 9]
+    assert IterableSource(range(10)).shard().collect() == [1, 5, 9]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for i in range(10):
+            os.makedirs(f"{tmp_dir}/{i}")
+            with open(f"{tmp_dir}/{i}/file.csv", mode="x") as f:
+                f.write("")
+        assert FilePathGenerator(url=tmp_dir, shard=True).collect() == [f"{tmp_dir}/{i}" for i in [1, 5, 9]]
+        shards = []
+        for worker_id in range(4):
+            info = type("Info", (), {"id": worker_id, "num_workers": 4})
+            monkeypatch.setattr(torch.utils.data, "get_worker_info", lambda info=info: info)
+            shards.append(set(FilePathGenerator(url=tmp_dir, nested=True, shard=True).collect()))
+        assert set.union(*shards) == {f"{tmp_dir}/{i}/file.csv" for i in range(10)}
+        assert sum(len(shard) for shard in shards) == 10
+
+
+def test_sharded_source_state_dict(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test resuming a sharded IterableSource"""
+    import torch.utils.data
+
+    monkeypatch.setattr(torch.utils.data, "get_worker_info", lambda: type("Info", (), {"id": 1, "num_workers": 3}))
+    source = IterableSource(range(20), shard=True)
+    it = iter(source)
+    consumed = [next(it) for _ in range(3)]
+    resumed = IterableSource(range(20), shard=True)
+    resumed.load_state_dict(source.state_dict())
+    assert consumed + resumed.collect() == list(range(1, 20, 3))
+
+
+def test_sampler_source_weights() -> None:
+    """Test that IterableSamplerSource renormalizes without modifying probs, and the temperature and balanced modes"""
+    probs = [0.9, 0.1]
+    sampler = IterableSamplerSource([[0] * 10, [1] * 1000], probs=probs, seed=0)
+    for _ in range(2):
+        res = sampler.collect()
+        assert res.count(0) == 10 and res.count(1) == 1000
+        # Items of the first iterable are drawn much more often, until it is exhausted
+        assert res[:10].count(0) >= 5
+    assert sampler.probs == probs
+
+    def first_half_counts(**kwargs: t.Any) -> t.List[int]:
+        res = IterableSamplerSource([[0] * 1000, [1] * 3000], seed=1, **kwargs).collect()[:1000]
+        return [res.count(0), res.count(1)]
+
+    assert abs(first_half_counts()[0] - 500) < 100
+    assert abs(first_half_counts(balanced=True)[0] - 250) < 100
+    # Temperature flattens the distribution towards uniform sampling
+    assert abs(first_half_counts(probs=[0.1, 0.9], temperature=1e6)[0] - 500) < 100
+
+
+def test_interleave() -> None:
+    """Test interleaving the iterables of the items in the stream"""
+    shards = IterableSource(range(5))
+
+    def read_shard(i: int) -> t.Iterator[int]:
+        return iter(range(i * 10, i * 10 + i + 1))
+
+    res = shards.interleave(read_shard, cycle_length=2, prefetch=2).collect()
+    assert res == [0, 10, 20, 11, 21, 30, 22, 31, 40, 32, 41, 33, 42, 43, 44]
+    assert shards.interleave(read_shard, cycle_length=1).collect() == shards.map(read_shard).flatten().collect()
+    assert IterableSource([[1, 2], [], [3]]).interleave().collect() == [1, 3, 2]
+
+    def slow_shard(i: int) -> t.Iterator[int]:
+        for j in range(3):
+            if i == 0:
+                time.sleep(0.2)
+            yield i * 10 + j
+
+    res = shards.interleave(slow_shard, cycle_length=5, ordered=False).collect()
+    assert sorted(res) == sorted(shards.map(slow_shard).flatten().collect())
+    # The slow shard does not block the others
+    assert res[-3:] == [0, 1, 2]
+
+    def failing_shard(i: int) -> t.Iterator[int]:
+        yield i
+        raise RuntimeError("read failed")
+
+    with pytest.raises(RuntimeError):
+        shards.interleave(failing_shard).collect()
+
+
+@pytest.mark.parametrize("n_consumed", [0, 3, 7, 14])
+def test_interleave_state_dict(n_consumed: int) -> None:
+    """Test resuming an interleaved stream"""
+
+    def build() -> Composable:
+        return IterableSource(range(5)).interleave(lambda i: range(i * 10, i * 10 + i + 1), cycle_length=2)
+
+    expected = build().collect()
+    pipeline = build()
+    it = iter(pipeline)
+    consumed = [next(it) for _ in range(n_consumed)]
+    resumed = build()
+    resumed.load_state_dict(pipeline.state_dict())
+    assert consumed + resumed.collect() == expected
+
+
+def test_prefetch() -> None:
+    """Test that prefetch runs the upstream stages in a background thread, bounded by items and bytes"""
+    threads = set()
+
+    def record_thread(x: int) -> int:
+        threads.add(threading.get_ident())
+        return x
+
+    assert IterableSource(range(100)).map(record_thread).prefetch(n_items=5).collect() == list(range(100))
+    assert threads and threading.get_ident() not in threads
+
+    produced = []
+    source = IterableSource(range(100)).map(lambda x: produced.append(x) or np.zeros(x % 3 + 1, dtype=np.uint8))
+    it = iter(source.prefetch(max_bytes=4))
+    next(it)
+    time.sleep(0.1)
+    # One item has been consumed, the buffered ones are just above the limit
+    assert 2 <= len(produced) <= 5
+    it.close()
+
+    def failing(x: int) -> int:
+        if x == 3:
+            raise RuntimeError("failed")
+        return x
+
+    it = iter(IterableSource(range(5)).map(failing).prefetch(n_items=10))
+    assert [next(it) for _ in range(3)] == [0, 1, 2]
+    with pytest.raises(RuntimeError):
+        next(it)
+
+    with pytest.raises(ValueError):
+        IterableSource(range(5)).prefetch()
+
+
+@pytest.mark.parametrize("n_consumed", [0, 1, 10, 50])
+def test_prefetch_state_dict(n_consumed: int) -> None:
+    """Test resuming a stream with prefetched items"""
+
+    def build() -> Composable:
+        return IterableSource(range(50)).shuffle(10, seed=0).prefetch(n_items=8).map(lambda x: x * 2)
+
+    expected = build().collect()
+    pipeline = build()
+    it = iter(pipeline)
+    consumed = [next(it) for _ in range(n_consumed)]
+    time.sleep(0.01)
+    resumed = build()
+    resumed.load_state_dict(pickle.loads(pickle.dumps(pipeline.state_dict())))
+    assert consumed + resumed.collect() == expected
+
+
+def test_prefetch_upstream_exit() -> None:
+    """Test that prefetch reraises any exception of the source and closes the source when stopped early"""
+
+    def interrupt(items: t.Iterable[int]) -> t.Iterator[int]:
+        for x in items:
+            if x == 3:
+                raise KeyboardInterrupt
+            yield x
+
+    with pytest.raises(KeyboardInterrupt):
+        IterableSource(range(10)).to(interrupt).prefetch(n_items=2).collect()
+
+    closed = threading.Event()
+
+    def track(items: t.Iterable[int]) -> t.Iterator[int]:
+        try:
+            yield from items
+        finally:
+            closed.set()
+
+    it = iter(IterableSource(range(100)).to(track).prefetch(n_items=2))
+    assert next(it) == 0
+    it.close()
+    assert closed.is_set()
+
+
+def test_profile() -> None:
+    """Test profiling the stages of a pipeline"""
+    published = []
+
+    class Sender:
+        def publish(self, event: t.Dict[str, float], **kwargs) -> None:
+            published.append(event)
+
+    def slow(x: int) -> int:
+        time.sleep(0.002)
+        return x
+
+    pipeline = IterableSource(range(20)).map(slow).async_map(lambda x: x, buffer=4).loop(2).profile(measure_bytes=True)
+    assert pipeline.collect() == list(range(20)) * 2
+    stats = pipeline.stats()
+    assert stats["iterstream.0.IterableSource.items"] == 20 * 2
+    assert stats["iterstream.1.map.own_time"] >= 0.002 * 20 * 2
+    assert stats["iterstream.1.map.own_time"] > stats["iterstream.2.AsyncMap.own_time"]
+    assert stats["iterstream.3.LoopIterable.items"] == 40
+    assert stats["iterstream.3.LoopIterable.bytes_per_sec"] > 0
+    assert "iterstream.2.AsyncMap.queue_occupancy" in stats
+    assert len(pipeline.report().splitlines()) == 5
+
+    pipeline.publish(Sender(), prefix="")
+    assert published == [{k[len("iterstream.") :]: v for k, v in stats.items()}]
+
+    # Profiling does not change the state
+    unprofiled = IterableSource(range(20)).shuffle(5, seed=0)
+    profiled = IterableSource(range(20)).shuffle(5, seed=0).profile()
+    it1, it2 = iter(unprofiled), iter(profiled)
+    assert [next(it1) for _ in range(5)] == [next(it2) for _ in range(5)]
+    assert pickle.dumps(unprofiled.state_dict()) == pickle.dumps(profiled.state_dict())
+
+
+def test_fused_stages() -> None:
+    """Test that fused map, filter and take stages behave like separate stages"""
+    calls = []
+
+    def record(x: int) -> int:
+        calls.append(x)
+        return x
+
+    pipeline = IterableSource(range(100)).map(record).filter(lambda x: x % 3 == 0).take(5).map(lambda x: x * 2)
+    assert pipeline.collect() == [0, 6, 12, 18, 24]
+    # Items after the last taken one are not fetched
+    assert calls == list(range(13))
+    assert pipeline.take(2).batched(2).map(sum).collect() == [6]
+
+    def fail(x: int) -> int:
+        if x == 2:
+            raise RuntimeError("failed")
+        return x
+
+    it = iter(IterableSource(range(5)).map(fail).map(lambda x: x + 1))
+    assert [next(it) for _ in range(2)] == [1, 2]
+    with pytest.raises(RuntimeError):
+        next(it)
+    # The stream ends after an exception, like a generator
+    assert next(it, None) is None
+
+    def stop(x: int) -> int:
+        if x == 2:
+            raise StopIteration
+        return x
+
+    # A StopIteration raised by a callback is an error, not the end of the stream
+    with pytest.raises(RuntimeError) as unfused:
+        list(map_(range(5), stop))
+    for pipeline in [
+        IterableSource(range(5)).map(stop).map(lambda x: x + 1),
+        IterableSource(range(5)).filter(stop).take(4),
+    ]:
+        with pytest.raises(RuntimeError) as fused:
+            pipeline.collect()
+        assert str(fused.value) == str(unfused.value)
+
+
+@pytest.mark.parametrize("asynchronous", [False, True])
+def test_map_batches(asynchronous: bool) -> None:
+    """Test applying a vectorized callback to batches of items"""
+    samples = [{"x": np.full(3, i, dtype=np.float32), "y": i} for i in range(10)]
+    calls = []
+
+    def scale(batch: t.Dict[str, np.ndarray], factor: int) -> t.Dict[str, np.ndarray]:
+        calls.append(len(batch["y"]))
+        return {"x": batch["x"] * factor, "y": batch["y"] + 1}
+
+    res = IterableSource(samples).map_batches(scale, batch_size=4, asynchronous=asynchronous, factor=2).collect()
+    assert sorted(calls) == [2, 4, 4]
+    assert len(res) == 10
+    for i, item in enumerate(res):
+        np.testing.assert_array_equal(item["x"], np.full(3, 2 * i))
+        assert item["y"] == i + 1
+
+    batches = IterableSource(range(10)).map_batches(np.square, batch_size=4, keep_batched=True).collect()
+    assert [b.tolist() for b in batches] == [[0, 1, 4, 9], [16, 25, 36, 49], [64, 81]]
+
+
+def test_loop_copy() -> None:
+    """Test looping over a source that cannot be copied"""
+    source = IterableSource(range(3)).map(partial(lambda x, lock: x, lock=threading.Lock()))
+    with pytest.raises(TypeError):
+        source.loop(2).collect()
+    assert source.loop(2, copy=False).collect() == [0, 1, 2] * 2
+
+
+@pytest.mark.parametrize("spill", [False, True])
+def test_cache(spill: bool) -> None:
+    """Test replaying the cached items of the first iteration"""
+    fetched = []
+    samples = [{"x": np.arange(i), "i": i} for i in range(10)]
+
+    def fetch(sample: t.Dict) -> t.Dict:
+        fetched.append(sample["i"])
+        return sample
+
+    pipeline = IterableSource(samples).map(fetch).cache(spill=spill)
+    # An interrupted iteration is started over
+    assert len(pipeline.take(3).collect()) == 3
+    res = pipeline.loop(3).collect()
+    assert [s["i"] for s in res] == list(range(10)) * 3
+    np.testing.assert_array_equal(res[-1]["x"], np.arange(9))
+    assert fetched == list(range(3)) + list(range(10))
+
+    def build() -> Composable:
+        return IterableSource(samples).map(fetch).cache(spill=spill).loop(3)
+
+    for n_consumed in [5, 15, 25]:
+        pipeline = build()
+        it = iter(pipeline)
+        consumed = [next(it)["i"] for _ in range(n_consumed)]
+        resumed = build()
+        resumed.load_state_dict(pickle.loads(pickle.dumps(pipeline.state_dict())))
+        assert consumed + [s["i"] for s in resumed.collect()] == list(range(10)) * 3
+
+
+def test_disk_cache() -> None:
+    """Test persisting the items of a pipeline and replaying them in later runs"""
+    # The closure must not change with the calls, since it is part of the fingerprint
+    fetched = mock.Mock()
+
+    def fetch(i: int, offset: int = 0) -> t.Dict:
+        fetched(i)
+        return {"x": np.full(2, i + offset), "i": i + offset}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+
+        def build(offset: int = 0) -> Composable:
+            return IterableSource(range(10)).map(fetch, offset=offset).cache(tmp_dir, chunk_size=3)
+
+        # Interrupted and concurrent writers of the same shard
+        assert len(build().take(4).collect()) == 4
+        it1, it2 = iter(build()), iter(build())
+        for _ in range(10):
+            next(it1), next(it2)
+        assert next(it1, None) is None and next(it2, None) is None
+        assert os.listdir(tmp_dir) == [f"{fingerprint(IterableSource(range(10)).map(fetch, offset=0))}-0-of-1"]
+
+        fetched.reset_mock()
+        res = build().collect()
+        assert fetched.call_count == 0 and [s["i"] for s in res] == list(range(10))
+        np.testing.assert_array_equal(res[7]["x"], [7, 7])
+
+        pipeline = build()
+        it = iter(pipeline)
+        consumed = [next(it)["i"] for _ in range(4)]
+        resumed = build()
+        resumed.load_state_dict(pickle.loads(pickle.dumps(pipeline.state_dict())))
+        assert consumed + [s["i"] for s in resumed.collect()] == list(range(10))
+        assert fetched.call_count == 0
+
+        # A different configuration is stored separately
+        assert [s["i"] for s in build(offset=1).collect()] == list(range(1, 11))
+        assert fetched.call_count == 10
+        assert len(os.listdir(tmp_dir)) == 2
+
+
+def test_fingerprint() -> None:
+    """Test that the fingerprint of a pipeline depends on its configuration"""
+
+    def build(n: int, factor: int, seed: int) -> Composable:
+        return IterableSource(range(n)).map(lambda x: x * factor).shuffle(10, seed=seed).batched(2)
+
+    assert fingerprint(build(10, 2, 0)) == fingerprint(build(10, 2, 0))
+    assert len({fingerprint(build(10, 2, 0)), fingerprint(build(11, 2, 0)), fingerprint(build(10, 3, 0))}) == 3
+    assert fingerprint(build(10, 2, 0)) != fingerprint(build(10, 2, 1))
+    assert fingerprint(IterableSource(range(3)).map(lambda x: x + 1)) != fingerprint(
+        IterableSource(range(3)).map(lambda x: x + 2)
+    )
+
+
+def test_fingerprint_ignores_iteration_state() -> None:
+    """Test that iterating over a pipeline does not change its fingerprint"""
+    it = (
+        IterableSource(range(20))
+        .shuffle(5, seed=0)
+        .async_map(lambda x: x + 1, buffer=3)
+        .zip_index()
+        .take(15)
+        .loop(2)
+        .cache()
+    )
+    before = fingerprint(it)
+    assert len(list(it)) == 30
+    assert fingerprint(it) == before
+
+    profiled = it.profile()
+    before = fingerprint(profiled)
+    assert len(list(profiled)) == 30
+    assert fingerprint(profiled) == before
+
+
+def _augment(x: int, rng: np.random.Generator, scale: float = 1.0) -> float:
+    """A random augmentation"""
+    time.sleep(rng.random() * 0.001)
+    return x + scale * rng.random()
+
+
+def test_item_seed() -> None:
+    """Test that the random numbers of each item do not depend on the workers"""
+    expected = IterableSource(range(50)).map(_augment, item_seed=3, scale=2.0).collect()
+    assert len(set(expected)) == 50
+    assert expected != IterableSource(range(50)).map(_augment, item_seed=4, scale=2.0).collect()
+    for kwargs in [{"max_workers": 1}, {"max_workers": 8}, {"max_workers": 8, "ordered": False}, {"processes": True}]:
+        res = IterableSource(range(50)).async_map(_augment, item_seed=3, scale=2.0, **kwargs).collect()
+        assert sorted(res) == sorted(expected) if kwargs.get("ordered") is False else res == expected
+
+    pipeline = IterableSource(range(50)).async_map(_augment, item_seed=3, buffer=5)
+    it = iter(pipeline)
+    consumed = [next(it) for _ in range(10)]
+    resumed = IterableSource(range(50)).async_map(_augment, item_seed=3, buffer=5)
+    resumed.load_state_dict(pipeline.state_dict())
+    assert consumed + resumed.collect() == IterableSource(range(50)).map(_augment, item_seed=3).collect()
+
+
+def _build_resumable_pipeline() -> Composable:
+    """A pipeline with all stateful stages"""
+    sampler = IterableSamplerSource(
+        [IterableSource(range(0, 50)).shuffle(8, seed=1), list(range(100, 150))], probs=[0.5, 0.5], seed=2
+    )
+    return sampler.async_map(lambda x: x * 2, buffer=5).map(lambda x: x + 1).shuffle(10, seed=3).loop(2).zip_index()
+
+
+@pytest.mark.parametrize("n_consumed", [0, 1, 17, 100, 199, 200])
+def test_state_dict_resume(n_consumed: int) -> None:
+    """Test that a stream restored from a state continues exactly where the state was taken"""
+    import pickle
+
+    expected = _build_resumable_pipeline().collect()
+    assert len(expected) == 200
+
+    pipeline = _build_resumable_pipeline()
+    it = iter(pipeline)
+    consumed = [next(it) for _ in range(n_consumed)]
+    state = pickle.loads(pickle.dumps(pipeline.state_dict()))
+
+    resumed = _build_resumable_pipeline()
+    resumed.load_state_dict(state)
+    assert consumed + resumed.collect() == expected
+
+
+@pytest.mark.parametrize("nested", [True, False])
+def test_filepathgenerator_state_dict(nested: bool) -> None:
+    """Test resuming a FilePathGenerator from its listing cursor"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for d in range(3):
+            os.makedirs(f"{tmp_dir}/{d}")
+            for sub in range(3):
+                with open(f"{tmp_dir}/{d}/{sub}.csv", mode="x") as f:
+                    f.write("")
+
+        expected = FilePathGenerator(url=tmp_dir, nested=nested, max_dirs=1).collect()
+        gen = FilePathGenerator(url=tmp_dir, nested=nested, max_dirs=1)
+        it = iter(gen)
+        consumed = [next(it) for _ in range(2)]
+        resumed = FilePathGenerator(url=tmp_dir, nested=nested, max_dirs=1)
+        resumed.load_state_dict(gen.state_dict())
+        assert consumed + resumed.collect() == expected
+
+
+def test_filepathgenerator_pages(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Test nested listing of large directories in pages, with resuming in the middle of a listing"""
+    monkeypatch.setattr(FilePathGenerator, "page_size", 3)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        expected = set()
+        for d in range(3):
+            os.makedirs(f"{tmp_dir}/{d}/sub")
+            for i in range(10):
+                for path in [f"{tmp_dir}/{d}/{i}.csv", f"{tmp_dir}/{d}/sub/{i}.csv"]:
+                    open(path, mode="x").close()
+                    expected.add(path)
+
+        assert set(FilePathGenerator(url=tmp_dir, nested=True, max_dirs=4, max_keys=5).collect()) == expected
+        for n_consumed in [1, 7, 35]:
+            gen = FilePathGenerator(url=tmp_dir, nested=True, max_dirs=2, max_keys=5)
+            it = iter(gen)
+            consumed = [next(it) for _ in range(n_consumed)]
+            resumed = FilePathGenerator(url=tmp_dir, nested=True, max_dirs=2, max_keys=5)
+            resumed.load_state_dict(gen.state_dict())
+            rest = resumed.collect()
+            assert len(consumed) + len(rest) == len(expected)
+            assert set(consumed + rest) == expected
+
+
+@pytest.mark.parametrize("nested", [True, False])
+@pytest.mark.parametrize("suffix", ["tsv", "tsv.gz"])
+def test_filepathgenerator_manifest(nested: bool, suffix: str) -> None:
+    """Test writing, streaming from and refreshing a manifest"""
+    with tempfile.TemporaryDirectory() as tmp_dir, tempfile.TemporaryDirectory() as manifest_dir:
+        data_dir, manifest = f"{tmp_dir}/data", f"{manifest_dir}/manifest.{suffix}"
+        for d in range(3):
+            os.makedirs(f"{data_dir}/{d}")
+            for sub in range(3):
+                open(f"{data_dir}/{d}/{sub}.csv", mode="x").close()
+
+        expected = sorted(FilePathGenerator(url=data_dir, nested=nested).collect())
+        assert sorted(FilePathGenerator(url=data_dir, nested=nested, manifest=manifest).collect()) == expected
+        assert [r.path for r in iter_manifest(manifest)] == expected
+
+        # The manifest is streamed without listing, so changes are only picked up by a refresh
+        os.makedirs(f"{data_dir}/new")
+        open(f"{data_dir}/new/0.csv", mode="x").close()
+        shutil.rmtree(f"{data_dir}/0")
+        assert FilePathGenerator(url=data_dir, nested=nested, manifest=manifest).collect() == expected
+        refreshed = FilePathGenerator(url=data_dir, nested=nested, manifest=manifest, refresh=True).collect()
+        assert refreshed == sorted(FilePathGenerator(url=data_dir, nested=nested).collect())
+
+        gen = FilePathGenerator(url=data_dir, nested=nested, manifest=manifest)
+        it = iter(gen)
+        consumed = [next(it) for _ in range(2)]
+        resumed = FilePathGenerator(url=data_dir, nested=nested, manifest=manifest)
+        resumed.load_state_dict(gen.state_dict())
+        assert consumed + resumed.collect() == refreshed
+
+        with pytest.raises(ValueError):
+            FilePathGenerator(url=data_dir, nested=not nested, manifest=manifest).collect()
+
+        # An unchanged url does not rewrite the manifest
+        mtime = os.stat(manifest).st_mtime_ns
+        FilePathGenerator(url=data_dir, nested=nested, manifest=manifest).refresh_manifest()
+        assert os.stat(manifest).st_mtime_ns == mtime
+
+        # A state taken from the manifest cannot be resumed without it
+        os.remove(manifest)
+        resumed = FilePathGenerator(url=data_dir, nested=nested, manifest=manifest)
+        resumed.load_state_dict(gen.state_dict())
+        with pytest.raises(ValueError, match="does not exist"):
+            resumed.collect()
+
+
 @pytest.fixture
 def samples() -> t.List[SampleType]:
     """A fixture to get a list of samples"""
@@ -533,6 +1242,36 @@ def _f(sample: SampleType, value: int) -> SampleType:
     return sample
 
 
+def _make_arrays(index: int, size: int = 10) -> t.Dict[str, t.Any]:
+    """Return a sample with a large and a small array"""
+    return {"index": index, "large": np.full(size, index, dtype=np.float32), "small": np.arange(3) + index}
+
+
 def multiply(value: float, factor: float) -> float:
     """Simply multiply value by given factor"""
     return value * factor
+
+
+def test_interrupted_iteration_restarts() -> None:
+    """Test that stateful stages start over when an interrupted stream is iterated again"""
+    pipeline = IterableSource(range(20)).shuffle(10, initial=5, seed=0)
+    it = iter(pipeline)
+    [next(it) for _ in range(3)]
+    res = list(pipeline)
+    assert sorted(res) == list(range(20))
+
+    pipeline = IterableSource(range(20)).take(10)
+    it = iter(pipeline)
+    [next(it) for _ in range(3)]
+    assert pipeline.collect() == list(range(10))
+
+
+@pytest.mark.parametrize("n_consumed", [0, 4, 10])
+def test_take_state_dict(n_consumed: int) -> None:
+    """Test that a restored take stage only yields the remaining items"""
+    pipeline = IterableSource(range(20)).map(lambda x: x).take(10)
+    it = iter(pipeline)
+    consumed = [next(it) for _ in range(n_consumed)]
+    resumed = IterableSource(range(20)).map(lambda x: x).take(10)
+    resumed.load_state_dict(pipeline.state_dict())
+    assert consumed + resumed.collect() == list(range(10))
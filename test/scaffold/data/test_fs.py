@@ -0,0 +1,37 @@
+import multiprocessing
+
+import pytest
+
+from scaffold.data import fs as fs_module
+from scaffold.data.fs import clear_fs_pool, get_fs_from_url
+
+
+def test_fs_pool() -> None:
+    """Test that filesystem instances are pooled by protocol and storage options"""
+    clear_fs_pool()
+    fs = get_fs_from_url("memory://bucket/a")
+    assert get_fs_from_url("memory://bucket/b") is fs
+    assert get_fs_from_url("file:///tmp") is not fs
+    assert get_fs_from_url("file:///tmp", auto_mkdir=True) is not get_fs_from_url("file:///tmp")
+    assert get_fs_from_url("memory://bucket/a", skip_instance_cache=True) is not fs
+
+    clear_fs_pool()
+    assert len(fs_module._fs_pool) == 0
+    assert get_fs_from_url("memory://bucket/a") is not fs
+
+
+def _pool_size(queue: multiprocessing.Queue) -> None:
+    queue.put(len(fs_module._fs_pool))
+
+
+@pytest.mark.skipif("fork" not in multiprocessing.get_all_start_methods(), reason="fork is not available")
+def test_fs_pool_after_fork() -> None:
+    """Test that forked processes start with an empty pool"""
+    get_fs_from_url("memory://bucket")
+    assert len(fs_module._fs_pool) > 0
+    ctx = multiprocessing.get_context("fork")
+    queue = ctx.Queue()
+    process = ctx.Process(target=_pool_size, args=(queue,))
+    process.start()
+    process.join()
+    assert queue.get(timeout=10) == 0